@@ -15,6 +15,31 @@ if is_torch_xla_available():
 else:
     XLA_AVAILABLE = False
 
+# linear projection of the 16 FLUX latent channels to RGB, used for cheap step previews
+FLUX_LATENT_RGB_FACTORS = [
+    [-0.0346, 0.0244, 0.0681],
+    [0.0034, 0.0210, 0.0687],
+    [0.0275, -0.0668, -0.0433],
+    [-0.0174, 0.0160, 0.0617],
+    [0.0859, 0.0721, 0.0329],
+    [0.0004, 0.0383, 0.0115],
+    [0.0405, 0.0861, 0.0915],
+    [-0.0236, -0.0185, -0.0259],
+    [-0.0245, 0.0250, 0.1180],
+    [0.1008, 0.0755, -0.0421],
+    [-0.0515, 0.0201, 0.0011],
+    [0.0428, -0.0012, -0.0036],
+    [0.0817, 0.0765, 0.0749],
+    [-0.1264, -0.0522, -0.1103],
+    [-0.0280, -0.0881, -0.0499],
+    [-0.1262, -0.0982, -0.0778],
+]
+FLUX_LATENT_RGB_BIAS = [-0.0329, -0.0718, -0.0851]
+
+# tiny autoencoder with the FLUX latent space (decoder="tiny")
+TINY_VAE_REPO = "madebyollin/taef1"
+LATENT_DECODERS = ("vae", "tiny")
+
 def map_SAP_dict(pf_prompts, num_inference_steps):
     prompts_list = pf_prompts['prompts_list']
     switch_prompts_steps = pf_prompts['switch_prompts_steps']
@@ -50,6 +75,77 @@ def verify_SAP_prompts(prompts_list, switch_prompts_steps, num_inference_steps):
                 )
 
 class SapFlux(FluxPipeline):
+    @torch.no_grad()
+    def encode_sap_prompts(
+        self,
+        sap_prompts,
+        max_sequence_length: int = 512,
+        prompt_2: Optional[Union[str, List[str]]] = None,
+        prompt_embeds: Optional[torch.FloatTensor] = None,
+        pooled_prompt_embeds: Optional[torch.FloatTensor] = None,
+        lora_scale: Optional[float] = None,
+        prompt_embeds_by_text: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+    ):
+        # encodes every distinct prompt of the SAP dicts once; already encoded texts are reused.
+        # embeddings are kept per text (batch of one) and expanded by num_images_per_prompt at use,
+        # so the same dict serves calls with any number of images
+        if isinstance(sap_prompts, dict):
+            sap_prompts = [sap_prompts]
+        prompt_embeds_by_text = dict(prompt_embeds_by_text or {})
+        device = self._execution_device
+        for d in sap_prompts:
+            for text in d['prompts_list']:
+                if text in prompt_embeds_by_text:
+                    continue
+                embeds = dict()
+                (
+                    embeds["prompt_embeds"],
+                    embeds["pooled_prompt_embeds"],
+                    embeds["text_ids"],
+                ) = self.encode_prompt(
+                    prompt=text,
+                    prompt_2=prompt_2,
+                    prompt_embeds=prompt_embeds,
+                    pooled_prompt_embeds=pooled_prompt_embeds,
+                    device=device,
+                    num_images_per_prompt=1,
+                    max_sequence_length=max_sequence_length,
+                    lora_scale=lora_scale,
+                )
+                prompt_embeds_by_text[text] = embeds
+        return prompt_embeds_by_text
+
+    def load_tiny_vae(self, repo: str = TINY_VAE_REPO):
+        # loaded on first use and kept next to the full VAE (not a registered component, not offloaded)
+        if getattr(self, "tiny_vae", None) is None:
+            from diffusers import AutoencoderTiny
+            self.tiny_vae = AutoencoderTiny.from_pretrained(repo, torch_dtype=self.vae.dtype)
+        self.tiny_vae.to(self._execution_device)
+        return self.tiny_vae
+
+    @torch.no_grad()
+    def decode_latents(self, latents: torch.Tensor, height: int, width: int, output_type: str = "pil",
+                       decoder: str = "vae"):
+        # packed latents (output_type="latent") -> images
+        # decoder="tiny" decodes with TAEF1 at a fraction of the full VAE cost (previews, thumbnails, sweeps)
+        if decoder not in LATENT_DECODERS:
+            raise ValueError(f"decoder must be one of {LATENT_DECODERS}, got {decoder}")
+        vae = self.load_tiny_vae() if decoder == "tiny" else self.vae
+        latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
+        latents = (latents / vae.config.scaling_factor) + getattr(vae.config, "shift_factor", 0.0)
+        image = vae.decode(latents.to(vae.dtype), return_dict=False)[0]
+        return self.image_processor.postprocess(image, output_type=output_type)
+
+    @torch.no_grad()
+    def preview_latents(self, latents: torch.Tensor, height: int, width: int):
+        # packed latents -> low resolution RGB previews (1/8 of the image size) without the VAE
+        latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
+        factors = torch.tensor(FLUX_LATENT_RGB_FACTORS, device=latents.device, dtype=torch.float32)
+        bias = torch.tensor(FLUX_LATENT_RGB_BIAS, device=latents.device, dtype=torch.float32)
+        rgb = torch.einsum("bchw,cr->bhwr", latents.to(torch.float32), factors) + bias
+        rgb = ((rgb.clamp(-1, 1) + 1) / 2).cpu().numpy()
+        return self.image_processor.numpy_to_pil(rgb)
+
     @torch.no_grad()
     def __call__(
         self,
@@ -81,13 +177,19 @@ class SapFlux(FluxPipeline):
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 512,
+        prompt_embeds_by_text: Optional[Dict[str, Dict[str, torch.Tensor]]] = None,
+        decoder: str = "vae",
     ):
         
         height = height or self.default_sample_size * self.vae_scale_factor
         width = width or self.default_sample_size * self.vae_scale_factor
+        # a single SAP dict is shared by the whole batch, a list gives every sample its own schedule
+        if isinstance(sap_prompts, dict):
+            sap_prompts = [sap_prompts] * batch_size
+        batch_size = len(sap_prompts)
         # 1. Check inputs, and apply SAP mapping
         self.check_inputs(
-            sap_prompts['prompts_list'][0], # verify there is at least a single prompt
+            sap_prompts[0]['prompts_list'][0], # verify there is at least a single prompt
             prompt_2,
             height,
             width,
@@ -120,27 +222,44 @@ class SapFlux(FluxPipeline):
         do_true_cfg = true_cfg_scale > 1 and has_neg_prompt
 
 
-        # maps from the input dict to the 1) prompts list 2) step->prompt_index dict and generate prompr embeds
-        prompts_list, SAP_mapping = map_SAP_dict(sap_prompts, num_inference_steps)
-        prompt_embeds_dicts = []
-        for i in range(len(prompts_list)):
-            d = dict()
-            (
-                d["prompt_embeds"],
-                d["pooled_prompt_embeds"],
-                d["text_ids"],
-            ) = self.encode_prompt(
-                prompt=prompts_list[i],
-                prompt_2=prompt_2,
-                prompt_embeds=prompt_embeds,
-                pooled_prompt_embeds=pooled_prompt_embeds,
-                device=device,
-                num_images_per_prompt=num_images_per_prompt,
-                max_sequence_length=max_sequence_length,
-                lora_scale=lora_scale,
-            )
-            prompt_embeds_dicts.append(d)
-        prompt_embeds = prompt_embeds_dicts[0]["prompt_embeds"]
+        # maps from each input dict to the 1) prompts list 2) step->prompt_index dict and generate prompt embeds.
+        # every distinct prompt is encoded once, even if several samples share it.
+        # prompt_embeds_by_text may hold embeddings computed beforehand (encode_sap_prompts)
+        sap_schedules = [map_SAP_dict(d, num_inference_steps) for d in sap_prompts]
+        prompt_embeds_by_text = self.encode_sap_prompts(
+            sap_prompts,
+            max_sequence_length=max_sequence_length,
+            prompt_2=prompt_2,
+            prompt_embeds=prompt_embeds,
+            pooled_prompt_embeds=pooled_prompt_embeds,
+            lora_scale=lora_scale,
+            prompt_embeds_by_text=prompt_embeds_by_text,
+        )
+
+        # per step, the prompt that each sample of the batch is conditioned on
+        step_prompts = [
+            tuple(prompts_list[SAP_mapping[f"step{i}"]] for prompts_list, SAP_mapping in sap_schedules)
+            for i in range(num_inference_steps)
+        ]
+        batched_prompt_embeds = {}
+
+        def get_step_prompt_embeds(key):
+            # samples are stacked in the same order as prepare_latents lays out the batch:
+            # all images of the first sample, then all images of the second
+            if key not in batched_prompt_embeds:
+                dicts = [prompt_embeds_by_text[text] for text in key]
+                batched_prompt_embeds[key] = {
+                    "prompt_embeds": torch.cat(
+                        [d["prompt_embeds"] for d in dicts], dim=0
+                    ).repeat_interleave(num_images_per_prompt, dim=0),
+                    "pooled_prompt_embeds": torch.cat(
+                        [d["pooled_prompt_embeds"] for d in dicts], dim=0
+                    ).repeat_interleave(num_images_per_prompt, dim=0),
+                    "text_ids": dicts[0]["text_ids"],
+                }
+            return batched_prompt_embeds[key]
+
+        prompt_embeds = get_step_prompt_embeds(step_prompts[0])["prompt_embeds"]
 
         if do_true_cfg:
             (
@@ -153,7 +272,7 @@ class SapFlux(FluxPipeline):
                 prompt_embeds=negative_prompt_embeds,
                 pooled_prompt_embeds=negative_pooled_prompt_embeds,
                 device=device,
-                num_images_per_prompt=num_images_per_prompt,
+                num_images_per_prompt=batch_size * num_images_per_prompt,
                 max_sequence_length=max_sequence_length,
                 lora_scale=lora_scale,
             )
@@ -243,7 +362,7 @@ class SapFlux(FluxPipeline):
                 timestep = t.expand(latents.shape[0]).to(latents.dtype)
 
                 # use corresponding proxy prompt embeds
-                prompt_dict = prompt_embeds_dicts[SAP_mapping[f'step{i}']]
+                prompt_dict = get_step_prompt_embeds(step_prompts[i])
                 pooled_prompt_embeds = prompt_dict["pooled_prompt_embeds"]
                 prompt_embeds = prompt_dict["prompt_embeds"]
                 text_ids = prompt_dict["text_ids"]
@@ -306,10 +425,7 @@ class SapFlux(FluxPipeline):
         if output_type == "latent":
             image = latents
         else:
-            latents = self._unpack_latents(latents, height, width, self.vae_scale_factor)
-            latents = (latents / self.vae.config.scaling_factor) + self.vae.config.shift_factor
-            image = self.vae.decode(latents, return_dict=False)[0]
-            image = self.image_processor.postprocess(image, output_type=output_type)
+            image = self.decode_latents(latents, height, width, output_type=output_type, decoder=decoder)
 
         # Offload all models
         self.maybe_free_model_hooks()
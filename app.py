@@ -1,11 +1,18 @@
 from __future__ import annotations
 
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import CancelledError, Future, TimeoutError as FutureTimeoutError
+
 import gradio as gr
 import spaces
 from PIL import Image
 import torch
 from run_SAP_flux import parse_input_arguments, LLM_SAP, generate_models_params, load_model
-from llm_interface.llm_SAP import load_Zephyr_pipeline
+from llm_interface.model_registry import get_registry
+from generation_cache import GenerationCache, make_cache_key, model_fingerprint
+from request_batcher import RequestBatcher
 import re
 
 gr.HTML("""
@@ -57,21 +64,95 @@ For best results, we recommend using **SAP with GPT-4o**, which delivers the bes
 
 device = 'cuda' if torch.cuda.is_available() else 'cpu'
 model_cache = {}
-llm_cache = {}
+# Кэш результатов генерации: повтор (промт, декомпозиция, seed) не запускает FLUX
+generation_cache = GenerationCache(max_size_gb=5.0)
+# Микро-батчинг: одновременные запросы идут в один вызов SapFlux
+BATCH_MAX_SIZE = 4
+BATCH_MAX_WAIT = 0.25  # секунд ожидания попутчиков для первого запроса
+# Превью по ходу дифузии (линейная проекция латентов в RGB, без VAE)
+PREVIEW_EVERY = 5  # шагов
+# События отмены текущих запросов по сессиям Gradio
+active_requests = {}
+
+class LRUCache:
+    """Ограниченный потокобезопасный LRU кэш в памяти"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._items:
+                return None
+            self._items.move_to_end(key)
+            return self._items[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+class SharedRequest:
+    """Одна генерация на все одинаковые одновременные запросы (промт, seed, модель)"""
+
+    def __init__(self):
+        self.future = Future()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, cancel_event):
+        previews = queue.Queue()
+        with self._lock:
+            self._listeners.append((previews, cancel_event))
+        return previews
+
+    def publish(self, step, preview):
+        with self._lock:
+            listeners = list(self._listeners)
+        for previews, cancel_event in listeners:
+            if not cancel_event.is_set():
+                previews.put((step, preview))
+
+    def is_set(self):
+        # the shared request counts as cancelled only when every caller has left
+        with self._lock:
+            return all(cancel_event.is_set() for _, cancel_event in self._listeners)
+
+# Повторы популярных запросов (примеры, повторные клики) отдаются из памяти
+decomposition_cache = LRUCache(max_size=256)  # (промт, LLM) -> SAP декомпозиция
+result_cache = LRUCache(max_size=64)          # (промт, seed, модель) -> изображение
+inflight = {}                                 # (промт, seed, модель) -> SharedRequest
+inflight_lock = threading.Lock()
 
 def toggle_api_visibility(choice):
     return gr.update(visible=(choice == "SAP with GPT-4o"))
 
-@spaces.GPU
 def main_pipeline(
     prompt: str,
     seed: int,
     model_choice: str,
-    api_key: str):
-    
-    res_image = run_demo(prompt, seed, model_choice, api_key)
+    api_key: str,
+    request: gr.Request = None):
 
-    return res_image
+    session = request.session_hash if request is not None else None
+    cancel_event = threading.Event()
+    active_requests[session] = cancel_event
+    try:
+        yield from run_demo(prompt, seed, model_choice, api_key, cancel_event=cancel_event)
+    finally:
+        if active_requests.get(session) is cancel_event:
+            del active_requests[session]
+
+def cancel_generation(request: gr.Request = None):
+    session = request.session_hash if request is not None else None
+    cancel_event = active_requests.get(session)
+    if cancel_event is not None:
+        cancel_event.set()
+    return gr.update(value="⛔ Cancelled")
 
 # Function to load pregenerated SAP-GPT image
 def load_static_result(path):
@@ -110,49 +191,227 @@ def handle_example_compare(index):
 def slugify(text):
     return re.sub(r'[^a-zA-Z0-9]+', '_', text.lower()).strip('_')
 
-@torch.inference_mode()
-def run_demo(prompt, seed, model_choice=None, api_key="API_KEY"):
-    # Align CLI args
-    args = parse_input_arguments()
-    args.prompt = prompt
-    args.seeds_list = [seed]
+@spaces.GPU
+def decompose_with_zephyr(prompt):
+    # Zephyr загружается один раз в общий реестр моделей процесса
+    return LLM_SAP(prompt, llm='Zephyr')[0]
+
+@spaces.GPU
+def generate_batch_gpu(sap_prompts, seeds, height, width, num_inference_steps, guidance_scale):
+    """
+    Один вызов SapFlux на GPU. Аргументы - только данные (декомпозиции, seeds,
+    размеры), поэтому функция может выполняться в процессе ZeroGPU. Генератор
+    отдает ("step", шаг, превью или None) после каждого шага и в конце
+    ("images", изображения); закрытие генератора прерывает дифузию.
+    """
+    if "SAPFlux" not in model_cache:
+        model_cache["SAPFlux"] = load_model()
+    model = model_cache["SAPFlux"]
+    get_registry().make_room()
+    print(f"Batch of {len(sap_prompts)} request(s)")
+
+    events = queue.Queue()
+    stop = threading.Event()
+
+    def on_step_end(pipe, step, timestep, callback_kwargs):
+        if stop.is_set():
+            pipe._interrupt = True
+            return {}
+        previews = None
+        if (step + 1) % PREVIEW_EVERY == 0 and step + 1 < num_inference_steps:
+            previews = pipe.preview_latents(callback_kwargs["latents"], height, width)
+        events.put(("step", step, previews))
+        return {}
+
+    def run():
+        try:
+            with torch.inference_mode():
+                output = model(
+                    sap_prompts=sap_prompts,
+                    generator=[torch.Generator().manual_seed(seed) for seed in seeds],
+                    num_images_per_prompt=1,
+                    height=height,
+                    width=width,
+                    num_inference_steps=num_inference_steps,
+                    guidance_scale=guidance_scale,
+                    callback_on_step_end=on_step_end
+                )
+            events.put(("images", output.images))
+        except Exception as e:
+            events.put(("error", e))
 
+    threading.Thread(target=run, daemon=True).start()
+    try:
+        while True:
+            event = events.get()
+            if event[0] == "error":
+                raise event[1]
+            yield event
+            if event[0] == "images":
+                return
+    finally:
+        stop.set()
+
+def generate_batch(requests):
+    """
+    Батч запросов (поток RequestBatcher в главном процессе): превью и отмена
+    обрабатываются здесь, на GPU уходят только декомпозиции и seeds.
+    Если все запросы батча отменены, возвращаются None.
+    """
+    first = requests[0]
+    events = generate_batch_gpu(
+        [r["sap_prompts"] for r in requests],
+        [r["seed"] for r in requests],
+        first["height"],
+        first["width"],
+        first["num_inference_steps"],
+        first["guidance_scale"]
+    )
+    try:
+        for event in events:
+            if event[0] == "images":
+                return event[1]
+            _, step, previews = event
+            for r, preview in zip(requests, previews or []):
+                if not r["cancel_event"].is_set():
+                    r["on_preview"](step, preview)
+            # abandoned requests stop consuming compute once the whole batch is cancelled
+            if all(r["cancel_event"].is_set() for r in requests):
+                break
+    finally:
+        events.close()
+    return [None] * len(requests)
+
+request_batcher = RequestBatcher(
+    generate_batch,
+    max_batch_size=BATCH_MAX_SIZE,
+    max_wait=BATCH_MAX_WAIT,
+    batch_key=lambda r: (r["height"], r["width"], r["num_inference_steps"], r["guidance_scale"])
+)
+
+def decompose(prompt, model_choice, api_key):
     # ------------------------------
     # FLUX MODE: No LLM, just base model
     # ------------------------------
     if model_choice == 'FLUX':
-        SAP_prompts = {"prompts_list": [prompt], "switch_prompts_steps": []}    
+        return {"prompts_list": [prompt], "switch_prompts_steps": []}
     # ------------------------------
     # SAP MODE: LLM + Prompt Decomposition
     # ------------------------------
-    else:
-        # Decide on which LLM to use
-        llm_type = 'Zephyr' if "SAP with zephyr-7b-beta" in model_choice else 'GPT'
-
-        # Load or cache LLM (optional but smart if it's large)
+    llm_type = 'Zephyr' if "SAP with zephyr-7b-beta" in model_choice else 'GPT'
+    SAP_prompts = decomposition_cache.get((prompt, llm_type))
+    if SAP_prompts is None:
         if llm_type == 'Zephyr':
-            if llm_type not in llm_cache:
-                llm_cache[llm_type] = load_Zephyr_pipeline()
-            llm_model = llm_cache[llm_type]
+            SAP_prompts = decompose_with_zephyr(prompt)
         else:
-            llm_model = None
-
-        # Prompt decomposition
-        SAP_prompts = LLM_SAP(prompt, llm=llm_type, key=api_key, llm_model=llm_model)[0]
+            SAP_prompts = LLM_SAP(prompt, llm='GPT', key=api_key)[0]
+        # a fallback decomposition (LLM failed) is not remembered: the next request asks the LLM again
+        if not is_degraded(SAP_prompts):
+            decomposition_cache.put((prompt, llm_type), SAP_prompts)
+    return SAP_prompts
 
-    # Load SAPFlux
-    if "SAPFlux" not in model_cache:
-        model_cache["SAPFlux"] = load_model()
-    model = model_cache["SAPFlux"]
+def is_degraded(SAP_prompts):
+    return SAP_prompts is None or SAP_prompts.get("source") == "fallback"
 
-    # Generate model params with decomposed prompts
-    params = generate_models_params(args, SAP_prompts)
+def produce_image(shared, key, prompt, seed, model_choice, api_key):
+    """Decomposition and generation for all callers awaiting the same shared request"""
+    try:
+        # Align CLI args
+        args = parse_input_arguments()
+        args.prompt = prompt
+        args.seeds_list = [seed]
+
+        SAP_prompts = decompose(prompt, model_choice, api_key)
+
+        # Generate model params with decomposed prompts
+        params = generate_models_params(args, SAP_prompts)
+
+        # Cached result for the same model weights, decomposition, seed and params
+        cache_params = {"height": params["height"], "width": params["width"],
+                        "num_inference_steps": params["num_inference_steps"],
+                        "guidance_scale": params["guidance_scale"], "generator_device": "cpu"}
+        cache_key = make_cache_key(model_fingerprint("black-forest-labs/FLUX.1-dev", torch.bfloat16), SAP_prompts, seed, cache_params)
+        image = generation_cache.get(cache_key)
+
+        # ------------------------------
+        # Run the model (batched with concurrent requests)
+        # ------------------------------
+        if image is None:
+            future = request_batcher.submit({
+                "sap_prompts": SAP_prompts,
+                "seed": seed,
+                "height": params["height"],
+                "width": params["width"],
+                "num_inference_steps": params["num_inference_steps"],
+                "guidance_scale": params["guidance_scale"],
+                "on_preview": shared.publish,
+                "cancel_event": shared
+            })
+            while True:
+                try:
+                    image = future.result(timeout=0.5)
+                    break
+                except FutureTimeoutError:
+                    # nobody waits anymore: drop the request before its batch starts
+                    if shared.is_set():
+                        future.cancel()
+            # a cancelled batch returns no image: nothing to cache
+            if shared.is_set() or image is None:
+                raise CancelledError()
+            if not is_degraded(SAP_prompts):
+                generation_cache.put(cache_key, image, metadata={"sap_prompts": SAP_prompts, "seed": seed, "params": cache_params})
+
+        # images from a fallback decomposition are served once, never from the caches
+        if not is_degraded(SAP_prompts):
+            result_cache.put(key, image)
+        shared.future.set_result(image)
+    except Exception as e:
+        shared.future.set_exception(e)
+    finally:
+        with inflight_lock:
+            if inflight.get(key) is shared:
+                del inflight[key]
+
+def run_demo(prompt, seed, model_choice=None, api_key="API_KEY", cancel_event=None):
+    """Генератор: превью каждые PREVIEW_EVERY шагов, затем итоговое изображение"""
+    cancel_event = cancel_event or threading.Event()
+    key = (prompt.strip(), int(seed), model_choice)
+
+    image = result_cache.get(key)
+    if image is not None:
+        yield image, "✅ Done (cached)"
+        return
+
+    # identical concurrent requests await the same generation
+    with inflight_lock:
+        shared = inflight.get(key)
+        leader = shared is None
+        if leader:
+            shared = inflight[key] = SharedRequest()
+        previews = shared.subscribe(cancel_event)
+    if leader:
+        threading.Thread(
+            target=produce_image, args=(shared, key, key[0], key[1], model_choice, api_key), daemon=True
+        ).start()
+    else:
+        yield gr.update(), "⏳ Joined an identical request in progress"
 
-    # ------------------------------
-    # Run the model
-    # ------------------------------
-    image = model(**params).images[0]
-    return image
+    try:
+        while not shared.future.done():
+            if cancel_event.is_set():
+                return
+            try:
+                step, preview = previews.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            yield preview, f"⏳ Step {step + 1}"
+        image = shared.future.result()
+    finally:
+        # the handler was closed (cancel button or client gone): leave the shared request
+        if not shared.future.done():
+            cancel_event.set()
+
+    yield image, "✅ Done"
 
 def warmup_models():
     print("Background warmup started...")
@@ -170,7 +429,9 @@ def warmup_models():
                 num_inference_steps=3,
                 guidance_scale=3.5,
                 generator=[torch.Generator().manual_seed(42)],
-                num_images_per_prompt=1
+                num_images_per_prompt=1,
+                # the warmup image is discarded: decode it with the tiny autoencoder
+                decoder="tiny"
             )
             print("SAPFlux warmup complete.")
         except Exception as e:
@@ -220,6 +481,7 @@ with gr.Blocks(css='app/style.css') as demo:
      
             # run_button = gr.Button('Generate')
             run_button = gr.Button('Generate', interactive=False)
+            cancel_button = gr.Button('Cancel')
             status_text = gr.Markdown("🚀 Loading models... Please wait.")
         with gr.Column(scale=1, elem_id="result-column"):
             # result = gr.Gallery(label='Result')
@@ -309,9 +571,12 @@ with gr.Blocks(css='app/style.css') as demo:
         api_key
     ]
     outputs = [
-        result
+        result,
+        status_text
     ]
-    run_button.click(fn=main_pipeline, inputs=inputs, outputs=outputs)
+    # Several handlers run at once so that the batcher can group their requests
+    run_event = run_button.click(fn=main_pipeline, inputs=inputs, outputs=outputs, concurrency_limit=BATCH_MAX_SIZE * 2)
+    cancel_button.click(fn=cancel_generation, inputs=[], outputs=[status_text], cancels=[run_event])
     
     demo.load(fn=warmup_models, inputs=[], outputs=[run_button, warmup_done, status_text])
 
@@ -1,15 +1,23 @@
 import base64
-import requests
+import asyncio
+import sys
+from pathlib import Path
+
+# Корень репозитория в пути для общего клиента OpenAI
+parent_dir = Path(__file__).parent.parent
+if str(parent_dir) not in sys.path:
+    sys.path.insert(0, str(parent_dir))
+
+from llm_interface.openai_client import AsyncOpenAIClient, get_client
+
+EVAL_MODEL = "gpt-4o-2024-05-13"
 
 def encode_image(image_path):
   with open(image_path, "rb") as image_file:
     return base64.b64encode(image_file.read()).decode('utf-8')
 
 
-def evaluate_image_with_gpt(image_path, prompt, key):
-    url = "https://api.openai.com/v1/chat/completions"
-    api_key = key
-
+def build_eval_messages(image_path, prompt):
     # GPT PROMPT
 
     eval_prompt = f"""You are an assistant evaluating an image on two **independent** aspects: \
@@ -69,9 +77,7 @@ Respond using this format:
     # Getting the base64 string
     base64_image = encode_image(image_path)
 
-    payload = {
-      "model": "gpt-4o-2024-05-13",
-      "messages": [
+    return [
         {
           "role": "user",
           "content": [
@@ -87,20 +93,10 @@ Respond using this format:
             }
           ]
         }
-      ],
-      "max_tokens": 4096
-    }
+    ]
 
-    headers = {
-      "Content-Type": "application/json",
-      "Authorization": f"Bearer {api_key}"
-    }
 
-    print('waiting for GPT-4 response')
-    response = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload)
-    output=response.json()
-    
-    text=output['choices'][0]['message']['content']
+def parse_eval_response(text):
     print(text)
     
     alignment_score = int(text.split("### ALIGNMENT SCORE:")[1].split("\n")[0].strip())
@@ -112,4 +108,38 @@ Respond using this format:
                     'alignment explanation': alignment_explanation,
                     'quality score': quality_score,
                     'quality explanation': quality_explanation}
-    return output_dict
\ No newline at end of file
+    return output_dict
+
+
+def evaluate_image_with_gpt(image_path, prompt, key, base_url=None):
+    """Оценка изображения через общий клиент (keep-alive соединения между вызовами)"""
+    print('waiting for GPT-4 response')
+    text = get_client(base_url).chat_completion(
+        build_eval_messages(image_path, prompt), EVAL_MODEL, key=key, max_tokens=4096
+    )
+    return parse_eval_response(text)
+
+
+async def evaluate_image_with_gpt_async(image_path, prompt, key, client):
+    """Асинхронная оценка одного изображения (client - AsyncOpenAIClient)"""
+    messages = await asyncio.to_thread(build_eval_messages, image_path, prompt)
+    text = await client.chat_completion(messages, EVAL_MODEL, key=key, max_tokens=4096)
+    return parse_eval_response(text)
+
+
+async def evaluate_images_async(items, key, max_concurrency=8, base_url=None):
+    """
+    Оценка многих изображений одновременно (не больше max_concurrency запросов).
+
+    items: список пар (image_path, prompt); результаты - в том же порядке,
+    ошибка отдельного изображения возвращается как исключение в его позиции
+    """
+    semaphore = asyncio.Semaphore(max_concurrency)
+    async with AsyncOpenAIClient(base_url, pool_size=max_concurrency) as client:
+        async def evaluate(image_path, prompt):
+            async with semaphore:
+                return await evaluate_image_with_gpt_async(image_path, prompt, key, client)
+
+        results = await asyncio.gather(*(evaluate(path, prompt) for path, prompt in items), return_exceptions=True)
+        print(f"📊 {client.base_url}: {client.metrics.format()}")
+    return results
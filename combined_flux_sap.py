@@ -8,20 +8,44 @@ Combined FLUX + SAP Image Generation Pipeline
 import os
 import sys
 import torch
+import asyncio
 import argparse
 from pathlib import Path
-from typing import List, Dict, Optional
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from datetime import datetime
 
 # Импорты из проекта
 from SAP_pipeline_flux import SapFlux
-from llm_interface.llm_SAP import LLM_SAP
-from diffusers import FluxPipeline
+from llm_interface.llm_SAP import LLM_SAP, LLM_SAP_stream
+from llm_interface.model_registry import get_registry
+from image_writer import ImageWriter, add_image_writer_arguments
+from run_manifest import RunManifest, params_hash, unit_key
+from sharding import (
+    add_sharding_arguments, estimate_generation_cost, make_unit, resolve_shard, select_shard,
+    shard_dir_name, sharded_run_dir
+)
+from worker_pool import WorkerPool, add_worker_pool_arguments
+from generation_cache import (
+    GenerationCache, LatentCapture, add_generation_cache_arguments, make_cache_key, model_fingerprint
+)
 
 # ==================== КОНФИГУРАЦИЯ ====================
 BASE_FOLDER = os.getcwd()
 API_KEY = os.getenv("OPENAI_API_KEY", "YOUR_API_KEY")
 RESULTS_DIR = os.path.join(BASE_FOLDER, "results_combined")
+# Тип весов FLUX (входит в отпечаток модели для кэша генерации)
+FLUX_DTYPE = torch.bfloat16
+
+# Элемент потока генерации: (промт, seed, изображение, метаданные)
+GenerationItem = Tuple[str, int, Any, Dict]
+
+# (режим, промт, seeds) -> seeds, которые еще нужно сгенерировать
+PendingSeedsFn = Callable[[str, str, List[int]], List[int]]
+
+# Сэмпл батча SapFlux: (SAP расписание, seeds)
+Sample = Tuple[Dict, List[int]]
 
 # ==================== УТИЛИТЫ ====================
 def create_timestamp_dir(base_dir: str, prefix: str = "batch") -> str:
@@ -45,20 +69,71 @@ def read_prompts_from_file(filepath: str) -> List[str]:
     print(f"✅ Загружено {len(prompts)} промтов из {filepath}")
     return prompts
 
-def save_results(images, output_dir: str, prompt_name: str, image_type: str, seeds: List[int] = None):
-    """Сохраняет сгенерированные изображения"""
+def save_image(image, output_dir: str, prompt_name: str, image_type: str, seed: Optional[int] = None,
+               index: int = 0, writer: Optional[ImageWriter] = None,
+               on_saved: Optional[Callable[[str], None]] = None) -> str:
+    """
+    Сохраняет одно сгенерированное изображение.
+
+    С writer кодирование и запись выполняются в фоне, а функция сразу
+    возвращает итоговый путь файла. on_saved(путь) вызывается, когда файл
+    действительно записан.
+    """
     prompt_dir = os.path.join(output_dir, prompt_name.replace(" ", "_")[:50])
     Path(prompt_dir).mkdir(parents=True, exist_ok=True)
     
-    for i, image in enumerate(images):
-        if seeds and i < len(seeds):
-            filename = f"{image_type}_seed_{seeds[i]}.png"
-        else:
-            filename = f"{image_type}_{i:03d}.png"
-        
-        filepath = os.path.join(prompt_dir, filename)
+    if seed is not None:
+        filename = f"{image_type}_seed_{seed}.png"
+    else:
+        filename = f"{image_type}_{index:03d}.png"
+    
+    filepath = os.path.join(prompt_dir, filename)
+    if writer is not None:
+        filepath = writer.output_path(filepath)
+        writer.submit(image, filepath, on_written=on_saved)
+        print(f"  💾 В очереди на запись: {filepath}")
+    else:
         image.save(filepath)
         print(f"  💾 Сохранено: {filepath}")
+        if on_saved is not None:
+            on_saved(filepath)
+    return filepath
+
+def save_results(images, output_dir: str, prompt_name: str, image_type: str, seeds: List[int] = None,
+                 writer: Optional[ImageWriter] = None):
+    """Сохраняет сгенерированные изображения"""
+    for i, image in enumerate(images):
+        seed = seeds[i] if seeds and i < len(seeds) else None
+        save_image(image, output_dir, prompt_name, image_type, seed, index=i, writer=writer)
+
+def save_stream(results: Iterator[GenerationItem], output_dirs: Dict[str, str],
+                writer: Optional[ImageWriter] = None, manifest: Optional[RunManifest] = None,
+                phashes: Optional[Dict[str, str]] = None) -> Dict[str, Dict]:
+    """
+    Сохраняет изображения по мере их генерации.
+
+    Args:
+        results: поток (промт, seed, изображение, метаданные) от генератора
+        output_dirs: директория для каждого режима ("direct", "sap")
+        writer: фоновый пул записи (None - синхронное сохранение)
+        manifest: журнал запуска; единица отмечается выполненной только
+                  после того, как файл записан на диск
+        phashes: хэш параметров для каждого режима (для ключей журнала)
+
+    Returns:
+        SAP метаданные по промтам (для metadata.txt)
+    """
+    sap_metadata = {}
+    for prompt, seed, image, metadata in results:
+        mode = metadata["mode"]
+        on_saved = None
+        if manifest is not None:
+            on_saved = (lambda path, m=mode, p=prompt, sd=seed:
+                        manifest.mark_done(m, p, sd, phashes[m], path))
+        save_image(image, output_dirs[mode], prompt, mode, seed, writer=writer, on_saved=on_saved)
+        if mode == "sap":
+            sap_metadata[prompt] = {k: v for k, v in metadata.items() if k != "mode"}
+    return sap_metadata
 
 def save_metadata(output_dir: str, metadata: Dict, filename: str = "metadata.txt"):
     """Сохраняет метаданные генерации"""
@@ -67,26 +142,224 @@ def save_metadata(output_dir: str, metadata: Dict, filename: str = "metadata.txt
         for key, value in metadata.items():
             f.write(f"{key}: {value}\n")
 
+# ==================== ЗАГРУЗКА ОБЩЕЙ МОДЕЛИ ====================
+def flux_model_repo(flux_version: str = "1-dev") -> str:
+    """Репозиторий весов FLUX для версии"""
+    return f"black-forest-labs/FLUX.{flux_version}"
+
+def load_sap_flux(device: str = "cuda", flux_version: str = "1-dev") -> SapFlux:
+    """
+    Загружает FLUX один раз в виде SapFlux.
+
+    Direct режим не требует отдельного FluxPipeline: одностадийное SAP
+    расписание (см. direct_sap_schedule) дает ту же генерацию, поэтому оба
+    генератора могут работать на одном наборе компонентов.
+    """
+    model_repo = flux_model_repo(flux_version)
+    print(f"📥 Загрузка модели {model_repo} (общая для Direct и SAP)...")
+    pipeline = SapFlux.from_pretrained(
+        model_repo,
+        torch_dtype=FLUX_DTYPE
+    )
+    pipeline.enable_model_cpu_offload()
+    pipeline = pipeline.to(device)
+    print("✅ Модель загружена!")
+    return pipeline
+
+def direct_sap_schedule(prompt: str) -> Dict:
+    """Одностадийное SAP расписание, эквивалентное прямой генерации FLUX"""
+    return {"prompts_list": [prompt], "switch_prompts_steps": []}
+
+def make_generators(seeds: List[int], device: str) -> List[torch.Generator]:
+    """Создает по генератору на каждый seed"""
+    generators = []
+    for seed in seeds:
+        gen = torch.Generator(device=device)
+        gen.manual_seed(seed)
+        generators.append(gen)
+    return generators
+
+def generation_params(height: int, width: int, num_inference_steps: int, guidance_scale: float,
+                      device: str) -> Dict:
+    """Параметры генерации, входящие в ключ кэша"""
+    return {
+        "height": height,
+        "width": width,
+        "num_inference_steps": num_inference_steps,
+        "guidance_scale": guidance_scale,
+        # Шум зависит от типа устройства генератора torch (cuda:0 и cuda дают один шум)
+        "generator_device": device.split(":")[0]
+    }
+
+def split_cached(
+    samples: List[Sample],
+    params: Dict,
+    cache: Optional[GenerationCache] = None,
+    fingerprint: str = ""
+) -> Tuple[List[Tuple[int, int, Any]], List[Tuple[int, Dict, List[int]]]]:
+    """
+    Разделяет сэмплы на найденные в кэше и недостающие.
+
+    Returns:
+        (попадания [(индекс сэмпла, seed, изображение)],
+         промахи [(индекс сэмпла, расписание, недостающие seeds)])
+    """
+    hits, misses = [], []
+    for sample_index, (schedule, sample_seeds) in enumerate(samples):
+        missing = []
+        for seed in sample_seeds:
+            image = cache.get(make_cache_key(fingerprint, schedule, seed, params)) if cache else None
+            if image is None:
+                missing.append(seed)
+            else:
+                hits.append((sample_index, seed, image))
+        if missing:
+            misses.append((sample_index, schedule, missing))
+    if hits:
+        print(f"🗃️  Из кэша: {len(hits)} изображений")
+    return hits, misses
+
+def group_misses(misses: List[Tuple[int, Dict, List[int]]]) -> List[List[Tuple[int, Dict, List[int]]]]:
+    """
+    Группирует промахи по набору недостающих seeds.
+
+    Каждая группа - один вызов SapFlux: у всех сэмплов группы одинаковые
+    seeds, поэтому дифузия идет только для запрошенных пар (сэмпл, seed).
+    """
+    groups: Dict[Tuple[int, ...], List[Tuple[int, Dict, List[int]]]] = {}
+    for miss in misses:
+        groups.setdefault(tuple(miss[2]), []).append(miss)
+    return list(groups.values())
+
+def batch_generators(group: List[Tuple[int, Dict, List[int]]], device: str) -> List[torch.Generator]:
+    """Отдельные генераторы на каждый сэмпл группы: одинаковые seeds дают одинаковый шум"""
+    generators = []
+    for _, _, group_seeds in group:
+        generators.extend(make_generators(group_seeds, device))
+    return generators
+
+def collect_batch(
+    group: List[Tuple[int, Dict, List[int]]],
+    images: List[Any],
+    params: Dict,
+    cache: Optional[GenerationCache] = None,
+    fingerprint: str = "",
+    latents: Optional[torch.Tensor] = None
+) -> List[Tuple[int, int, Any]]:
+    """
+    Раскладывает изображения группы по сэмплам и сохраняет их в кэш.
+
+    Раскладка батча: сначала все seeds первого сэмпла, затем все seeds
+    второго.
+    """
+    results = []
+    row = 0
+    for sample_index, schedule, group_seeds in group:
+        for seed in group_seeds:
+            image = images[row]
+            if cache is not None:
+                cache.put(
+                    make_cache_key(fingerprint, schedule, seed, params),
+                    image,
+                    latents=latents[row] if latents is not None else None,
+                    metadata={"model": fingerprint, "sap_prompts": schedule, "seed": seed, "params": params}
+                )
+            results.append((sample_index, seed, image))
+            row += 1
+    return results
+
+def generate_samples(
+    pipeline: Optional[SapFlux],
+    samples: List[Sample],
+    height: int,
+    width: int,
+    num_inference_steps: int,
+    guidance_scale: float,
+    device: str,
+    cache: Optional[GenerationCache] = None,
+    fingerprint: str = "",
+    load_pipeline: Optional[Callable[[], SapFlux]] = None
+) -> Iterator[Tuple[int, int, Any]]:
+    """
+    Генерирует несколько сэмплов (расписание, seeds) батчами SapFlux.
+
+    Результаты, найденные в кэше, отдаются сразу и не попадают в батч:
+    дифузия запускается только для промахов. Сэмплы с одинаковыми
+    недостающими seeds идут одним вызовом SapFlux (см. group_misses).
+
+    Yields:
+        (индекс сэмпла, seed, изображение)
+    """
+    params = generation_params(height, width, num_inference_steps, guidance_scale, device)
+    hits, misses = split_cached(samples, params, cache, fingerprint)
+    yield from hits
+    if not misses:
+        return
+    if pipeline is None:
+        pipeline = load_pipeline()
+    
+    for group in group_misses(misses):
+        capture = LatentCapture(num_inference_steps) if cache is not None and cache.store_latents else None
+        output = pipeline(
+            height=height,
+            width=width,
+            num_inference_steps=num_inference_steps,
+            guidance_scale=guidance_scale,
+            generator=batch_generators(group, device),
+            num_images_per_prompt=len(group[0][2]),
+            sap_prompts=[schedule for _, schedule, _ in group],
+            callback_on_step_end=capture
+        )
+        
+        yield from collect_batch(
+            group, output.images, params, cache, fingerprint,
+            latents=capture.latents if capture is not None else None
+        )
+
+def select_pending_work(
+    prompts: List[str],
+    seeds: List[int],
+    mode: str,
+    pending_seeds: Optional[PendingSeedsFn] = None
+) -> List[Tuple[int, str, List[int]]]:
+    """Список (индекс, промт, seeds) только для еще не сгенерированных изображений"""
+    work = []
+    for i, prompt in enumerate(prompts):
+        prompt_seeds = pending_seeds(mode, prompt, seeds) if pending_seeds else list(seeds)
+        if prompt_seeds:
+            work.append((i, prompt, prompt_seeds))
+    
+    skipped = len(prompts) - len(work)
+    if skipped:
+        print(f"⏭️  [{mode}] Пропускаю {skipped} полностью сгенерированных промтов")
+    return work
+
 # ==================== ГЕНЕРАЦИЯ С ПОМОЩЬЮ FLUX (DIRECT) ====================
 class DirectFluxGenerator:
     """Генератор изображений с прямым использованием Flux без SAP"""
     
-    def __init__(self, device: str = "cuda"):
-        """Инициализация генератора"""
+    def __init__(self, device: str = "cuda", pipeline: Optional[SapFlux] = None,
+                 flux_version: str = "1-dev", cache: Optional[GenerationCache] = None):
+        """
+        Инициализация генератора
+
+        Args:
+            device: устройство для генерации
+            pipeline: уже загруженный SapFlux (общий с SAPFluxGenerator)
+            flux_version: версия FLUX, если модель нужно загрузить
+            cache: кэш результатов генерации (None - без кэша)
+        """
         print("\n🔧 Инициализация Direct FLUX Generator...")
         self.device = device
-        self.pipeline = None
+        self.flux_version = flux_version
+        self.pipeline = pipeline
+        self.cache = cache
+        self.fingerprint = model_fingerprint(flux_model_repo(flux_version), FLUX_DTYPE) if cache is not None else ""
     
-    def load_model(self):
+    def load_model(self) -> SapFlux:
         """Загружает модель Flux"""
-        print("📥 Загрузка модели black-forest-labs/FLUX.1-dev...")
-        self.pipeline = FluxPipeline.from_pretrained(
-            "black-forest-labs/FLUX.1-dev",
-            torch_dtype=torch.bfloat16
-        )
-        self.pipeline.enable_model_cpu_offload()
-        self.pipeline = self.pipeline.to(self.device)
-        print("✅ Модель загружена!")
+        self.pipeline = load_sap_flux(self.device, self.flux_version)
+        return self.pipeline
     
     def generate(
         self,
@@ -96,70 +369,170 @@ class DirectFluxGenerator:
         num_inference_steps: int = 50,
         guidance_scale: float = 3.5,
         seeds: List[int] = None,
-        num_images_per_prompt: int = 1
-    ) -> Dict[str, List]:
-        """Генерирует изображения для каждого промта"""
-        if self.pipeline is None:
-            self.load_model()
-        
+        num_images_per_prompt: int = 1,
+        pending_seeds: Optional[PendingSeedsFn] = None
+    ) -> Iterator[GenerationItem]:
+        """
+        Генерирует изображения для каждого промта.
+
+        Изображения отдаются по мере готовности каждого батча, поэтому
+        вызывающий код может сохранять их сразу, не накапливая в памяти.
+        pending_seeds позволяет пропустить уже сгенерированные seeds,
+        результаты из кэша отдаются без запуска модели.
+        """
         if seeds is None:
             seeds = list(range(num_images_per_prompt))
         
-        results = {}
+        work = select_pending_work(prompts, seeds, "direct", pending_seeds)
         
-        for prompt in prompts:
+        for _, prompt, prompt_seeds in work:
             print(f"\n🎨 Генерация для: '{prompt}'")
             
-            # Создание генераторов
-            generators = []
-            for seed in seeds:
-                gen = torch.Generator(device=self.device)
-                gen.manual_seed(seed)
-                generators.append(gen)
-            
             try:
-                # Генерация
-                output = self.pipeline(
-                    prompt=prompt,
-                    height=height,
-                    width=width,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    generator=generators[0] if len(generators) == 1 else generators,
-                    num_images_per_prompt=len(generators)
-                )
-                
-                images = output.images
-                results[prompt] = images
-                print(f"✅ Сгенерировано {len(images)} изображений")
+                # Генерация (модель загружается при первом промахе кэша)
+                for _, seed, image in generate_samples(
+                    self.pipeline,
+                    [(direct_sap_schedule(prompt), prompt_seeds)],
+                    height, width, num_inference_steps, guidance_scale, self.device,
+                    cache=self.cache, fingerprint=self.fingerprint, load_pipeline=self.load_model
+                ):
+                    yield prompt, seed, image, {"mode": "direct"}
+                print(f"✅ Сгенерировано {len(prompt_seeds)} изображений")
                 
             except Exception as e:
                 print(f"❌ Ошибка при генерации: {e}")
-                results[prompt] = []
-        
-        return results
+                continue
 
 # ==================== ГЕНЕРАЦИЯ С ПОМОЩЬЮ SAP ====================
+def load_pregenerated_sap(json_file: str, prompts: List[str]) -> Optional[List[Optional[Dict]]]:
+    """Загружает предгенерированные SAP декомпозиции (None для ненайденных промтов)"""
+    print(f"\n📂 Загружаю предгенерированные SAP промты из: {json_file}")
+    try:
+        from sap_prompts_loader import SAPPromptsLoader
+        loader = SAPPromptsLoader(json_file)
+        sap_decompositions = loader.get_sap_decompositions_batch(prompts)
+    except ImportError:
+        print(f"❌ Не удалось импортировать SAPPromptsLoader")
+        return None
+    except Exception as e:
+        print(f"❌ Ошибка при загрузке предгенерированных промтов: {e}")
+        return None
+    
+    # Проверяем, что все промты найдены
+    found_count = sum(1 for x in sap_decompositions if x is not None)
+    if found_count == len(prompts):
+        print(f"✅ Все {len(prompts)} SAP декомпозиций успешно загружены!")
+    elif found_count > 0:
+        print(f"⚠️  Найдено только {found_count}/{len(prompts)} SAP декомпозиций")
+        print(f"    Остальные будут сгенерированы на лету...")
+    else:
+        return None
+    
+    for sap_prompt_data in sap_decompositions:
+        if sap_prompt_data is not None:
+            sap_prompt_data.setdefault("source", "pregenerated")
+    return sap_decompositions
+
+def build_sap_metadata(sap_prompt_data: Dict) -> Dict:
+    """Краткие метаданные SAP декомпозиции для metadata.txt"""
+    metadata = {
+        "explanation": sap_prompt_data.get("explanation", "N/A"),
+        "prompts_count": len(sap_prompt_data.get("prompts_list", [])),
+        "switch_steps": sap_prompt_data.get("switch_prompts_steps", [])
+    }
+    if "source" in sap_prompt_data:
+        metadata["source"] = sap_prompt_data["source"]
+    return metadata
+
 class SAPFluxGenerator:
     """Генератор изображений с использованием SAP (prompt decomposition через LLM)"""
     
-    def __init__(self, llm: str = "GPT", device: str = "cuda"):
-        """Инициализация генератора"""
+    def __init__(self, llm: str = "GPT", device: str = "cuda", pipeline: Optional[SapFlux] = None,
+                 flux_version: str = "1-dev", cache: Optional[GenerationCache] = None, llm_model: Any = None,
+                 skip_fallback: bool = False):
+        """
+        Инициализация генератора
+
+        Args:
+            llm: LLM для декомпозиции (GPT или Zephyr)
+            device: устройство для генерации
+            pipeline: уже загруженный SapFlux (общий с DirectFluxGenerator)
+            flux_version: версия FLUX, если модель нужно загрузить
+            cache: кэш результатов генерации (None - без кэша)
+            llm_model: уже загруженный пайплайн Zephyr (иначе - общий из реестра моделей процесса)
+            skip_fallback: не генерировать промты, оставшиеся с резервной декомпозицией после повторов LLM
+        """
         print("\n🔧 Инициализация SAP FLUX Generator...")
         self.device = device
         self.llm = llm
-        self.pipeline = None
+        self.llm_model = llm_model
+        self.skip_fallback = skip_fallback
+        self.flux_version = flux_version
+        self.pipeline = pipeline
+        self.cache = cache
+        self.fingerprint = model_fingerprint(flux_model_repo(flux_version), FLUX_DTYPE) if cache is not None else ""
     
-    def load_model(self):
+    def load_model(self) -> SapFlux:
         """Загружает модель SapFlux"""
-        print("📥 Загрузка модели black-forest-labs/FLUX.1-dev (SAP версия)...")
-        self.pipeline = SapFlux.from_pretrained(
-            "black-forest-labs/FLUX.1-dev",
-            torch_dtype=torch.bfloat16
-        )
-        self.pipeline.enable_model_cpu_offload()
-        self.pipeline = self.pipeline.to(self.device)
-        print("✅ Модель загружена!")
+        self.pipeline = load_sap_flux(self.device, self.flux_version)
+        return self.pipeline
+    
+    def usable(self, sap_prompt_data: Optional[Dict]) -> Optional[Dict]:
+        """Декомпозиция для генерации (None - промт пропускается)"""
+        if self.skip_fallback and sap_prompt_data is not None and sap_prompt_data.get("source") == "fallback":
+            return None
+        return sap_prompt_data
+    
+    def decompose_stream(
+        self,
+        prompts: List[str],
+        sap_prompts_list: Optional[List[Optional[Dict]]] = None
+    ) -> Iterator[Tuple[int, Optional[Dict]]]:
+        """
+        SAP декомпозиции по мере готовности: (индекс промта, декомпозиция).
+
+        Уже известные декомпозиции (например, предгенерированные) отдаются
+        сразу, LLM вызывается только для недостающих; ответ GPT разбирается
+        потоково, так что генерация первого промта начинается до конца ответа.
+        """
+        if sap_prompts_list is None:
+            sap_prompts_list = [None] * len(prompts)
+        
+        missing = [i for i, x in enumerate(sap_prompts_list) if x is None]
+        for i, result in enumerate(sap_prompts_list):
+            if result is not None:
+                yield i, self.usable(result)
+        if not missing:
+            return
+        
+        print(f"\n🧠 Запуск LLM для декомпозиции {len(missing)} промтов (LLM: {self.llm})...")
+        received = 0
+        for j, result in LLM_SAP_stream([prompts[i] for i in missing], llm=self.llm, key=API_KEY,
+                                        llm_model=self.llm_model):
+            if received == 0:
+                # FLUX нужна память устройства: LLM из реестра выгружаются, если ее не хватает
+                get_registry().make_room()
+            received += 1
+            yield missing[j], self.usable(result)
+        
+        if received != len(missing):
+            print(f"⚠️  Ожидалось {len(missing)} результатов, получено {received}")
+    
+    def decompose(
+        self,
+        prompts: List[str],
+        sap_prompts_list: Optional[List[Optional[Dict]]] = None
+    ) -> List[Optional[Dict]]:
+        """Возвращает SAP декомпозиции для всех промтов (в порядке промтов)"""
+        decompositions = [None] * len(prompts)
+        for i, result in self.decompose_stream(prompts, sap_prompts_list):
+            decompositions[i] = result
+        
+        # Подсчет успешных декомпозиций
+        successful_decompositions = sum(1 for x in decompositions if x is not None)
+        print(f"✅ Успешно декомпозировано промтов: {successful_decompositions}/{len(prompts)}")
+        
+        return decompositions
     
     def generate(
         self,
@@ -169,78 +542,470 @@ class SAPFluxGenerator:
         num_inference_steps: int = 50,
         guidance_scale: float = 3.5,
         seeds: List[int] = None,
-        num_images_per_prompt: int = 1
-    ) -> Dict[str, List]:
-        """Генерирует изображения с декомпозицией через LLM"""
-        if self.pipeline is None:
-            self.load_model()
-        
+        num_images_per_prompt: int = 1,
+        sap_prompts_list: Optional[List[Optional[Dict]]] = None,
+        pending_seeds: Optional[PendingSeedsFn] = None
+    ) -> Iterator[GenerationItem]:
+        """
+        Генерирует изображения с декомпозицией через LLM (потоково, по батчам).
+
+        Промты, для которых все seeds уже сгенерированы (pending_seeds),
+        не отправляются ни в LLM, ни в модель.
+        """
         if seeds is None:
             seeds = list(range(num_images_per_prompt))
         
-        results = {}
-        sap_metadata = {}
-        
-        print(f"\n🧠 Запуск LLM для декомпозиции {len(prompts)} промтов (LLM: {self.llm})...")
-        
-        # Получение декомпозиции всех промтов от LLM
-        sap_prompts_list = LLM_SAP(prompts, llm=self.llm, key=API_KEY)
+        work = select_pending_work(prompts, seeds, "sap", pending_seeds)
+        if not work:
+            return
         
-        if len(sap_prompts_list) != len(prompts):
-            print(f"⚠️  Ожидалось {len(prompts)} результатов, получено {len(sap_prompts_list)}")
+        known = [sap_prompts_list[i] for i, _, _ in work] if sap_prompts_list else None
+        decompositions = self.decompose_stream([prompt for _, prompt, _ in work], known)
         
-        # Подсчет успешных декомпозиций
-        successful_decompositions = sum(1 for x in sap_prompts_list if x is not None)
-        print(f"✅ Успешно декомпозировано промтов: {successful_decompositions}/{len(prompts)}")
-        
-        # Генерация для каждого оригинального промта
-        for i, original_prompt in enumerate(prompts):
+        # Генерация для каждого промта, как только готова его декомпозиция
+        for position, sap_prompt_data in decompositions:
+            i, original_prompt, prompt_seeds = work[position]
             print(f"\n🎨 Генерация SAP для: '{original_prompt}'")
             
             # Проверка корректности SAP результата
-            if i >= len(sap_prompts_list) or sap_prompts_list[i] is None:
+            if sap_prompt_data is None:
                 print(f"⚠️  Не удалось получить SAP декомпозицию для промта {i+1}")
                 print(f"    💡 Совет: убедитесь, что LLM ответил в правильном формате")
                 print(f"    💡 Совет: попробуйте использовать GPT вместо Zephyr")
                 continue
             
-            sap_prompt_data = sap_prompts_list[i]
+            metadata = {"mode": "sap", **build_sap_metadata(sap_prompt_data)}
             
-            # Сохранение метаданных
-            sap_metadata[original_prompt] = {
-                "explanation": sap_prompt_data.get("explanation", "N/A"),
-                "prompts_count": len(sap_prompt_data.get("prompts_list", [])),
-                "switch_steps": sap_prompt_data.get("switch_prompts_steps", [])
-            }
+            try:
+                # Генерация с SAP (модель загружается при первом промахе кэша)
+                for _, seed, image in generate_samples(
+                    self.pipeline,
+                    [(sap_prompt_data, prompt_seeds)],
+                    height, width, num_inference_steps, guidance_scale, self.device,
+                    cache=self.cache, fingerprint=self.fingerprint, load_pipeline=self.load_model
+                ):
+                    yield original_prompt, seed, image, metadata
+                print(f"✅ Сгенерировано {len(prompt_seeds)} изображений (с SAP декомпозицией)")
+                
+            except Exception as e:
+                print(f"❌ Ошибка при SAP генерации: {e}")
+                continue
+    
+    def generate_with_direct(
+        self,
+        prompts: List[str],
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 3.5,
+        seeds: List[int] = None,
+        num_images_per_prompt: int = 1,
+        sap_prompts_list: Optional[List[Optional[Dict]]] = None,
+        pending_seeds: Optional[PendingSeedsFn] = None
+    ) -> Iterator[GenerationItem]:
+        """
+        Генерирует Direct и SAP изображения одного промта в одном батче SapFlux.
+
+        Direct сэмпл - это одностадийное расписание исходного промта, SAP
+        сэмпл - LLM декомпозиция. Латенты обоих сэмплов создаются из одних
+        и тех же seeds, поэтому результат совпадает с раздельными запусками,
+        но модель проходит по шагам дифузии один раз.
+        """
+        if seeds is None:
+            seeds = list(range(num_images_per_prompt))
+        
+        direct_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "direct", pending_seeds)}
+        sap_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "sap", pending_seeds)}
+        if not direct_work and not sap_work:
+            return
+        
+        # LLM вызывается только для промтов, у которых остались SAP seeds
+        sap_indices = sorted(sap_work)
+        known = [sap_prompts_list[i] for i in sap_indices] if sap_prompts_list else None
+        decompositions = dict(zip(sap_indices, self.decompose([prompts[i] for i in sap_indices], known))) if sap_indices else {}
+        
+        for i, original_prompt in enumerate(prompts):
+            if i not in direct_work and i not in sap_work:
+                continue
+            print(f"\n🎨 Генерация Direct + SAP для: '{original_prompt}'")
             
-            # Создание генераторов
-            generators = []
-            for seed in seeds:
-                gen = torch.Generator(device=self.device)
-                gen.manual_seed(seed)
-                generators.append(gen)
+            # (расписание, метаданные, seeds для сохранения) для каждого сэмпла батча
+            samples = []
+            if i in direct_work:
+                samples.append((direct_sap_schedule(original_prompt), {"mode": "direct"}, direct_work[i]))
+            if i in sap_work:
+                sap_prompt_data = decompositions.get(i)
+                if sap_prompt_data is None:
+                    print(f"⚠️  Не удалось получить SAP декомпозицию для промта {i+1}")
+                else:
+                    samples.append((sap_prompt_data, {"mode": "sap", **build_sap_metadata(sap_prompt_data)}, sap_work[i]))
+            if not samples:
+                continue
             
             try:
-                # Генерация с SAP
-                output = self.pipeline(
-                    height=height,
-                    width=width,
-                    num_inference_steps=num_inference_steps,
-                    guidance_scale=guidance_scale,
-                    generator=generators,
-                    num_images_per_prompt=len(generators),
-                    sap_prompts=sap_prompt_data
-                )
-                
-                images = output.images
-                results[original_prompt] = images
-                print(f"✅ Сгенерировано {len(images)} изображений (с SAP декомпозицией)")
+                # Кэшированные сэмплы отдаются сразу, остальные - одним батчем SapFlux
+                for sample_index, seed, image in generate_samples(
+                    self.pipeline,
+                    [(schedule, sample_seeds) for schedule, _, sample_seeds in samples],
+                    height, width, num_inference_steps, guidance_scale, self.device,
+                    cache=self.cache, fingerprint=self.fingerprint, load_pipeline=self.load_model
+                ):
+                    yield original_prompt, seed, image, samples[sample_index][1]
+                print(f"✅ Сгенерировано {sum(len(s) for _, _, s in samples)} изображений (Direct + SAP в одном батче)")
                 
             except Exception as e:
-                print(f"❌ Ошибка при SAP генерации: {e}")
-                results[original_prompt] = []
+                print(f"❌ Ошибка при совместной генерации: {e}")
+                continue
+
+# ==================== ПУЛ ВОРКЕРОВ НА НЕСКОЛЬКИХ УСТРОЙСТВАХ ====================
+def pool_dtype(device: str) -> torch.dtype:
+    """Тип весов реплики пула: float32 на CPU, bf16 на GPU"""
+    return torch.float32 if device == "cpu" else FLUX_DTYPE
+
+def load_pool_pipeline(device: str, flux_version: str = "1-dev", model_repo: Optional[str] = None) -> SapFlux:
+    """
+    Реплика SapFlux для воркера пула.
+
+    Каждый воркер владеет своим устройством целиком, поэтому cpu offload не
+    используется. model_repo позволяет подставить маленькую модель для
+    проверки пула на CPU.
+    """
+    pipeline = SapFlux.from_pretrained(
+        model_repo or flux_model_repo(flux_version),
+        torch_dtype=pool_dtype(device)
+    )
+    return pipeline.to(device)
+
+def pool_batch_key(task: Dict) -> Tuple:
+    """Задачи с одинаковыми параметрами генерации можно объединять в батч"""
+    return (task["height"], task["width"], task["num_inference_steps"], task["guidance_scale"])
+
+def run_pool_batch(pipeline: SapFlux, tasks: List[Dict], device: str) -> List[Any]:
+    """Батч задач воркера: один вызов SapFlux со своим расписанием и seed у каждого сэмпла"""
+    first = tasks[0]
+    output = pipeline(
+        height=first["height"],
+        width=first["width"],
+        num_inference_steps=first["num_inference_steps"],
+        guidance_scale=first["guidance_scale"],
+        generator=make_generators([task["seed"] for task in tasks], device),
+        num_images_per_prompt=1,
+        sap_prompts=[task["sap_prompts"] for task in tasks]
+    )
+    return output.images
+
+def generate_pooled(
+    pool: WorkerPool,
+    sap_generator: "SAPFluxGenerator",
+    prompts: List[str],
+    modes: List[str],
+    height: int = 1024,
+    width: int = 1024,
+    num_inference_steps: int = 50,
+    guidance_scale: float = 3.5,
+    seeds: List[int] = None,
+    num_images_per_prompt: int = 1,
+    sap_prompts_list: Optional[List[Optional[Dict]]] = None,
+    pending_seeds: Optional[PendingSeedsFn] = None
+) -> Iterator[GenerationItem]:
+    """
+    Генерирует Direct и/или SAP изображения на пуле воркеров.
+
+    Каждая пара (сэмпл, seed) - отдельная задача общей очереди, воркеры
+    собирают их в батчи сами; результаты отдаются в порядке промтов.
+    Кэш проверяется и пополняется в основном процессе.
+    """
+    if seeds is None:
+        seeds = list(range(num_images_per_prompt))
+    params = generation_params(height, width, num_inference_steps, guidance_scale, pool.devices[0])
+    cache = sap_generator.cache
+    fingerprint = sap_generator.fingerprint
+    if cache is not None and len({pool_dtype(device) for device in pool.devices}) > 1:
+        # Реплики разного типа дают разные изображения для одного ключа
+        print("⚠️  Пул смешивает CPU и GPU воркеры: кэш генерации не используется")
+        cache = None
+    
+    direct_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "direct", pending_seeds)} \
+        if "direct" in modes else {}
+    sap_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "sap", pending_seeds)} \
+        if "sap" in modes else {}
+    sap_indices = sorted(sap_work)
+    known = [sap_prompts_list[i] for i in sap_indices] if sap_prompts_list else None
+    decompositions = dict(zip(sap_indices, sap_generator.decompose([prompts[i] for i in sap_indices], known))) \
+        if sap_indices else {}
+    
+    tasks = []
+    for i, prompt in enumerate(prompts):
+        samples = []
+        if i in direct_work:
+            samples.append((direct_sap_schedule(prompt), {"mode": "direct"}, direct_work[i]))
+        if i in sap_work:
+            if decompositions.get(i) is None:
+                print(f"⚠️  Не удалось получить SAP декомпозицию для промта {i+1}")
+            else:
+                samples.append((decompositions[i], {"mode": "sap", **build_sap_metadata(decompositions[i])},
+                                sap_work[i]))
+        for schedule, metadata, sample_seeds in samples:
+            hits, misses = split_cached([(schedule, sample_seeds)], params, cache, fingerprint)
+            for _, seed, image in hits:
+                yield prompt, seed, image, metadata
+            for seed in (misses[0][2] if misses else []):
+                tasks.append({"prompt": prompt, "metadata": metadata, "sap_prompts": schedule, "seed": seed,
+                              "height": height, "width": width, "num_inference_steps": num_inference_steps,
+                              "guidance_scale": guidance_scale})
+    
+    if not tasks:
+        return
+    print(f"\n🧵 Задач для пула: {len(tasks)} на {len(pool.devices)} воркерах")
+    for task, image in pool.map(tasks):
+        if image is None:
+            continue
+        if cache is not None:
+            cache.put(make_cache_key(fingerprint, task["sap_prompts"], task["seed"], params), image,
+                      metadata={"model": fingerprint, "sap_prompts": task["sap_prompts"],
+                                "seed": task["seed"], "params": params})
+        yield task["prompt"], task["seed"], image, task["metadata"]
+
+# ==================== АСИНХРОННЫЙ КОНВЕЙЕР ПО СТАДИЯМ ====================
+class StagedSAPPipeline:
+    """
+    Конвейер декомпозиция → кодирование текста → дифузия → декодирование → запись.
+
+    Стадии связаны ограниченными очередями asyncio.Queue: если следующая
+    стадия не успевает, предыдущая ждет (backpressure), и в памяти находится
+    не больше queue_size промтов на стадию. Декомпозиция через LLM идет
+    параллельно (до llm_concurrency запросов), поэтому первые изображения
+    появляются, пока остальные промты еще декомпозируются. Стадии на GPU
+    выполняются в одном потоке: одна модель с cpu offload не должна
+    использоваться из нескольких потоков одновременно.
+    """
+    
+    def __init__(
+        self,
+        generator: SAPFluxGenerator,
+        output_dirs: Dict[str, str],
+        writer: Optional[ImageWriter] = None,
+        manifest: Optional[RunManifest] = None,
+        phashes: Optional[Dict[str, str]] = None,
+        llm_concurrency: int = 4,
+        queue_size: int = 2
+    ):
+        """
+        Args:
+            generator: SAP генератор (модель, LLM, кэш)
+            output_dirs: директория для каждого режима ("direct", "sap")
+            writer: фоновый пул записи (None - синхронное сохранение)
+            manifest: журнал запуска
+            phashes: хэш параметров для каждого режима (для ключей журнала)
+            llm_concurrency: одновременных запросов к LLM (Zephyr - всегда 1)
+            queue_size: размер очереди между стадиями
+        """
+        self.generator = generator
+        self.output_dirs = output_dirs
+        self.writer = writer
+        self.manifest = manifest
+        self.phashes = phashes
+        self.llm_concurrency = 1 if generator.llm == "Zephyr" else max(1, llm_concurrency)
+        self.queue_size = queue_size
+        self.sap_metadata: Dict[str, Dict] = {}
+    
+    async def _stage(self, name: str, inbox: "asyncio.Queue", handler, workers: int = 1):
+        """Обрабатывает элементы очереди до сигнала завершения (None)"""
+        async def worker():
+            while True:
+                item = await inbox.get()
+                if item is None:
+                    # Сигнал завершения получают все обработчики стадии
+                    await inbox.put(None)
+                    return
+                try:
+                    await handler(item)
+                except Exception as e:
+                    print(f"❌ [{name}] Ошибка для '{item['prompt']}': {e}")
         
-        return results, sap_metadata
+        await asyncio.gather(*(worker() for _ in range(workers)))
+    
+    def _decompose(self, prompt: str) -> Optional[Dict]:
+        """Декомпозиция одного промта (выполняется в пуле потоков)"""
+        results = LLM_SAP([prompt], llm=self.generator.llm, key=API_KEY, llm_model=self.generator.llm_model)
+        return self.generator.usable(results[0]) if results else None
+    
+    def _encode(self, item: Dict):
+        """Кэш и кодирование текста (поток GPU)"""
+        samples = [(schedule, seeds) for schedule, _, seeds in item["samples"]]
+        hits, misses = split_cached(samples, item["params"], self.generator.cache, self.generator.fingerprint)
+        item["hits"], item["misses"] = hits, misses
+        if not misses:
+            return
+        pipeline = self.generator.pipeline or self.generator.load_model()
+        item["groups"] = group_misses(misses)
+        item["prompt_embeds_by_text"] = pipeline.encode_sap_prompts([schedule for _, schedule, _ in misses])
+    
+    def _denoise(self, item: Dict):
+        """Дифузия до латентов (поток GPU), по вызову SapFlux на группу seeds"""
+        params = item["params"]
+        cache = self.generator.cache
+        prompt_embeds_by_text = item.pop("prompt_embeds_by_text")
+        item["group_latents"] = []
+        for group in item["groups"]:
+            capture = LatentCapture(params["num_inference_steps"]) if cache is not None and cache.store_latents else None
+            latents = self.generator.pipeline(
+                height=params["height"],
+                width=params["width"],
+                num_inference_steps=params["num_inference_steps"],
+                guidance_scale=params["guidance_scale"],
+                generator=batch_generators(group, self.generator.device),
+                num_images_per_prompt=len(group[0][2]),
+                sap_prompts=[schedule for _, schedule, _ in group],
+                prompt_embeds_by_text=prompt_embeds_by_text,
+                output_type="latent",
+                callback_on_step_end=capture
+            ).images
+            item["group_latents"].append((latents, capture.latents if capture is not None else None))
+    
+    def _decode(self, item: Dict) -> List[Tuple[int, int, Any]]:
+        """Декодирование VAE и сохранение в кэш (поток GPU)"""
+        params = item["params"]
+        results = []
+        for group, (latents, final_latents) in zip(item["groups"], item.pop("group_latents")):
+            images = self.generator.pipeline.decode_latents(latents, params["height"], params["width"])
+            results.extend(collect_batch(
+                group, images, params, self.generator.cache, self.generator.fingerprint, latents=final_latents
+            ))
+        return results
+    
+    def _save(self, item: Dict, results: List[Tuple[int, int, Any]]):
+        """Передает изображения в пул записи (может ждать свободного места в очереди записи)"""
+        prompt = item["prompt"]
+        for sample_index, seed, image in results:
+            _, metadata, _ = item["samples"][sample_index]
+            mode = metadata["mode"]
+            on_saved = None
+            if self.manifest is not None:
+                on_saved = (lambda path, m=mode, sd=seed:
+                            self.manifest.mark_done(m, prompt, sd, self.phashes[m], path))
+            save_image(image, self.output_dirs[mode], prompt, mode, seed, writer=self.writer, on_saved=on_saved)
+            if mode == "sap":
+                self.sap_metadata[prompt] = {k: v for k, v in metadata.items() if k != "mode"}
+    
+    async def _run(self, work: List[Dict]):
+        loop = asyncio.get_running_loop()
+        llm_executor = ThreadPoolExecutor(max_workers=self.llm_concurrency, thread_name_prefix="sap-llm")
+        gpu_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sap-gpu")
+        io_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sap-save")
+        
+        decompose_q = asyncio.Queue(maxsize=self.queue_size)
+        encode_q = asyncio.Queue(maxsize=self.queue_size)
+        denoise_q = asyncio.Queue(maxsize=self.queue_size)
+        decode_q = asyncio.Queue(maxsize=self.queue_size)
+        save_q = asyncio.Queue(maxsize=self.queue_size)
+        
+        async def decompose(item):
+            if item["sap_seeds"]:
+                sap_prompt_data = item["known"]
+                if sap_prompt_data is None:
+                    sap_prompt_data = await loop.run_in_executor(llm_executor, self._decompose, item["prompt"])
+                if sap_prompt_data is None:
+                    print(f"⚠️  Не удалось получить SAP декомпозицию для: '{item['prompt']}'")
+                else:
+                    item["samples"].append((sap_prompt_data, {"mode": "sap", **build_sap_metadata(sap_prompt_data)},
+                                            item["sap_seeds"]))
+            if item["samples"]:
+                await encode_q.put(item)
+        
+        async def encode(item):
+            await loop.run_in_executor(gpu_executor, self._encode, item)
+            if item["hits"]:
+                await save_q.put({"prompt": item["prompt"], "item": item, "results": item["hits"]})
+            if item["misses"]:
+                await denoise_q.put(item)
+        
+        async def denoise(item):
+            print(f"\n🎨 Дифузия для: '{item['prompt']}'")
+            await loop.run_in_executor(gpu_executor, self._denoise, item)
+            await decode_q.put(item)
+        
+        async def decode(item):
+            results = await loop.run_in_executor(gpu_executor, self._decode, item)
+            print(f"✅ Сгенерировано {len(results)} изображений для: '{item['prompt']}'")
+            await save_q.put({"prompt": item["prompt"], "item": item, "results": results})
+        
+        async def save(entry):
+            await loop.run_in_executor(io_executor, self._save, entry["item"], entry["results"])
+        
+        async def produce():
+            for item in work:
+                await decompose_q.put(item)
+            await decompose_q.put(None)
+        
+        async def chain(stage, next_q):
+            # Следующая стадия завершается только после текущей
+            await stage
+            if next_q is not None:
+                await next_q.put(None)
+        
+        save_stage = asyncio.ensure_future(self._stage("save", save_q, save))
+        try:
+            await asyncio.gather(
+                produce(),
+                chain(self._stage("decompose", decompose_q, decompose, self.llm_concurrency), encode_q),
+                chain(self._stage("encode", encode_q, encode), denoise_q),
+                chain(self._stage("denoise", denoise_q, denoise), decode_q),
+                chain(self._stage("decode", decode_q, decode), save_q)
+            )
+            await save_stage
+        finally:
+            for executor in (llm_executor, gpu_executor, io_executor):
+                executor.shutdown(wait=True)
+    
+    def run(
+        self,
+        prompts: List[str],
+        modes: List[str],
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 3.5,
+        seeds: List[int] = None,
+        num_images_per_prompt: int = 1,
+        sap_prompts_list: Optional[List[Optional[Dict]]] = None,
+        pending_seeds: Optional[PendingSeedsFn] = None
+    ) -> Dict[str, Dict]:
+        """
+        Запускает конвейер для всех промтов.
+
+        В режиме both Direct и SAP сэмплы промта идут одним батчем SapFlux
+        (как generate_with_direct).
+
+        Returns:
+            SAP метаданные по промтам (для metadata.txt)
+        """
+        if seeds is None:
+            seeds = list(range(num_images_per_prompt))
+        params = generation_params(height, width, num_inference_steps, guidance_scale, self.generator.device)
+        
+        direct_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "direct", pending_seeds)} \
+            if "direct" in modes else {}
+        sap_work = {i: s for i, _, s in select_pending_work(prompts, seeds, "sap", pending_seeds)} \
+            if "sap" in modes else {}
+        
+        work = []
+        for i, prompt in enumerate(prompts):
+            if i not in direct_work and i not in sap_work:
+                continue
+            samples = []
+            if i in direct_work:
+                samples.append((direct_sap_schedule(prompt), {"mode": "direct"}, direct_work[i]))
+            work.append({
+                "prompt": prompt,
+                "params": params,
+                "samples": samples,
+                "sap_seeds": sap_work.get(i, []),
+                "known": sap_prompts_list[i] if sap_prompts_list else None
+            })
+        if work:
+            asyncio.run(self._run(work))
+        return self.sap_metadata
 
 # ==================== ГЛАВНОЕ ПРИЛОЖЕНИЕ ====================
 def parse_arguments():
@@ -264,6 +1029,14 @@ def parse_arguments():
         help='Директория для сохранения результатов'
     )
     
+    parser.add_argument(
+        '--run-dir',
+        type=str,
+        default=None,
+        help='Постоянная директория запуска: уже сгенерированные изображения '
+             '(по manifest.jsonl) пропускаются, догенерируется только недостающее'
+    )
+    
     # Параметры генерации
     parser.add_argument(
         '--height',
@@ -332,12 +1105,57 @@ def parse_arguments():
         default=None,
         help='Использовать предгенерированные SAP промты из JSON файла (например: SAP_prompts.json)'
     )
-        parser.add_argument(
-            '--flux-version',
-            type=str,
-            default='1-dev',
-            help='Версия FLUX: 1-dev или 2-dev (по умолчанию 1-dev)'
-        )
+    parser.add_argument(
+        '--no-co-batch',
+        action='store_true',
+        help='В режиме both запускать Direct и SAP последовательно, а не в одном батче'
+    )
+    
+    parser.add_argument(
+        '--staged',
+        action='store_true',
+        help='Асинхронный конвейер по стадиям: LLM декомпозиция идет параллельно с генерацией'
+    )
+    
+    parser.add_argument(
+        '--llm-concurrency',
+        type=int,
+        default=4,
+        help='Одновременных запросов к LLM в режиме --staged (для Zephyr всегда 1)'
+    )
+    
+    parser.add_argument(
+        '--stage-queue-size',
+        type=int,
+        default=2,
+        help='Размер очереди между стадиями в режиме --staged'
+    )
+    
+    parser.add_argument(
+        '--flux-version',
+        type=str,
+        default='1-dev',
+        help='Версия FLUX: 1-dev или 2-dev (по умолчанию 1-dev)'
+    )
+    
+    parser.add_argument(
+        '--skip-fallback',
+        action='store_true',
+        help='Не генерировать SAP изображения для промтов, оставшихся с резервной декомпозицией '
+             '(повторы LLM задает SAP_REPAIR_ATTEMPTS)'
+    )
+    
+    add_image_writer_arguments(parser)
+    add_generation_cache_arguments(parser)
+    add_sharding_arguments(parser)
+    add_worker_pool_arguments(parser)
+    parser.add_argument(
+        '--model-repo',
+        type=str,
+        default=None,
+        help='Модель для пула воркеров вместо black-forest-labs/FLUX.<версия> '
+             '(например, маленькая модель для проверки на CPU)'
+    )
     
     return parser.parse_args()
 
@@ -356,47 +1174,281 @@ def main():
         print(f"❌ Ошибка: {e}")
         sys.exit(1)
     
+    # Шард задачи массива (--num-shards/--shard-index или SLURM array)
+    try:
+        num_shards, shard_index = resolve_shard(args.num_shards, args.shard_index)
+    except ValueError as e:
+        print(f"❌ Ошибка: {e}")
+        sys.exit(1)
+    
     # Создание директории для результатов
-    batch_dir = create_timestamp_dir(args.output_dir)
+    if num_shards > 1:
+        # У каждого шарда своя поддиректория общей директории запуска
+        sharded_dir = sharded_run_dir(args.output_dir, args.run_dir)
+        batch_dir = os.path.join(sharded_dir, shard_dir_name(shard_index, num_shards))
+        Path(batch_dir).mkdir(parents=True, exist_ok=True)
+    elif args.run_dir:
+        batch_dir = args.run_dir
+        Path(batch_dir).mkdir(parents=True, exist_ok=True)
+    else:
+        batch_dir = create_timestamp_dir(args.output_dir)
     print(f"📁 Результаты будут сохранены в: {batch_dir}")
     
-    # ===== РЕЖИМ DIRECT =====
-    if args.mode in ['direct', 'both']:
+    # Журнал единиц работы (режим, промт, seed, хэш параметров)
+    manifest = RunManifest(batch_dir)
+    base_params = {
+        "flux_version": args.flux_version,
+        "height": args.height,
+        "width": args.width,
+        "num_inference_steps": args.num_inference_steps,
+        "guidance_scale": args.guidance_scale,
+        "image_format": args.image_format
+    }
+    phashes = {
+        "direct": params_hash({"mode": "direct", **base_params}),
+        "sap": params_hash({"mode": "sap", "llm": args.llm,
+                            "pregenerated_sap": args.use_pregenerated_sap, **base_params})
+    }
+    modes = ["direct", "sap"] if args.mode == "both" else [args.mode]
+    
+    # Единицы работы: все seeds и режимы промта остаются в одном шарде, чтобы
+    # не повторять LLM декомпозицию и сохранить совместный батч
+    units = [
+        make_unit(mode, prompt, seed, phashes[mode],
+                  cost=estimate_generation_cost(args.height, args.width, args.num_inference_steps, mode),
+                  group=prompt)
+        for prompt in prompts for mode in modes for seed in args.seeds
+    ]
+    if num_shards > 1:
+        units = select_shard(units, num_shards, shard_index, batch_dir)
+    owned_keys = {unit["key"] for unit in units}
+    for unit in units:
+        manifest.mark_pending(unit["mode"], unit["prompt"], unit["seed"], unit["params_hash"])
+    
+    def pending_seeds(mode, prompt, seeds):
+        seeds = [seed for seed in seeds if unit_key(mode, prompt, seed, phashes[mode]) in owned_keys]
+        return manifest.pending_seeds(mode, prompt, seeds, phashes[mode])
+    
+    total_units = len(units)
+    remaining_units = sum(len(pending_seeds(mode, prompt, args.seeds)) for mode in modes for prompt in prompts)
+    if args.run_dir or num_shards > 1:
+        print(f"📒 Журнал запуска: выполнено {total_units - remaining_units}/{total_units}, "
+              f"осталось {remaining_units}")
+    
+    direct_dir = os.path.join(batch_dir, "direct_flux")
+    sap_dir = os.path.join(batch_dir, "sap_flux")
+    direct_metadata = {
+        "mode": "direct_flux",
+        "num_prompts": len(prompts),
+        "image_size": f"{args.height}x{args.width}",
+        "num_inference_steps": args.num_inference_steps,
+        "guidance_scale": args.guidance_scale,
+        "seeds": args.seeds
+    }
+    
+    def sap_run_metadata(sap_metadata):
+        return {
+            "mode": "sap_flux",
+            "llm": args.llm,
+            "num_prompts": len(prompts),
+            "image_size": f"{args.height}x{args.width}",
+            "num_inference_steps": args.num_inference_steps,
+            "guidance_scale": args.guidance_scale,
+            "seeds": args.seeds,
+            "used_pregenerated_sap": args.use_pregenerated_sap is not None,
+            "sap_details": str(sap_metadata)
+        }
+    
+    generation_kwargs = dict(
+        height=args.height,
+        width=args.width,
+        num_inference_steps=args.num_inference_steps,
+        guidance_scale=args.guidance_scale,
+        seeds=args.seeds,
+        num_images_per_prompt=len(args.seeds),
+        pending_seeds=pending_seeds
+    )
+    
+    # Фоновая запись изображений: кодирование не останавливает дифузию
+    writer = ImageWriter.from_args(args)
+    
+    # Кэш результатов: совпадающие (модель, декомпозиция, seed, параметры)
+    # берутся с диска без дифузии
+    cache = GenerationCache.from_args(args)
+    
+    # Одна загрузка FLUX на оба режима при последовательном запуске: генераторы
+    # разделяют компоненты. В остальных случаях генератор загружает модель
+    # сам при первом промахе кэша, поэтому повторный запуск ее не загружает
+    shared_pipeline = None
+    if args.mode == 'both' and args.no_co_batch and not (args.staged or args.devices or args.cpu_workers) \
+            and remaining_units > 0:
+        shared_pipeline = load_sap_flux(args.device, args.flux_version)
+    
+    # Проверяем, нужно ли использовать предгенерированные SAP промты
+    pregenerated_sap = None
+    if args.mode in ['sap', 'both'] and args.use_pregenerated_sap:
+        pregenerated_sap = load_pregenerated_sap(args.use_pregenerated_sap, prompts)
+    
+    # ===== КОНВЕЙЕР ПО СТАДИЯМ =====
+    if args.staged:
         print("\n" + "=" * 60)
-        print("ЭТАП 1: Direct FLUX Generation (без SAP)")
+        print("Конвейер: декомпозиция → кодирование → дифузия → декодирование → запись")
+        print("=" * 60)
+        
+        output_dirs = {"direct": direct_dir, "sap": sap_dir}
+        for mode in modes:
+            Path(output_dirs[mode]).mkdir(parents=True, exist_ok=True)
+        
+        try:
+            staged = StagedSAPPipeline(
+                SAPFluxGenerator(
+                    llm=args.llm,
+                    device=args.device,
+                    pipeline=shared_pipeline,
+                    flux_version=args.flux_version,
+                    cache=cache,
+                    skip_fallback=args.skip_fallback
+                ),
+                output_dirs,
+                writer=writer,
+                manifest=manifest,
+                phashes=phashes,
+                llm_concurrency=args.llm_concurrency,
+                queue_size=args.stage_queue_size
+            )
+            if "direct" in modes:
+                save_results_metadata(direct_dir, direct_metadata)
+            sap_metadata = staged.run(prompts=prompts, modes=modes, sap_prompts_list=pregenerated_sap,
+                                      **generation_kwargs)
+            if "sap" in modes:
+                save_results_metadata(sap_dir, sap_run_metadata(sap_metadata))
+            print("✅ Генерация в конвейере завершена!")
+            
+        except Exception as e:
+            print(f"❌ Ошибка в конвейере генерации: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    # ===== ПУЛ ВОРКЕРОВ: реплика модели на каждом устройстве =====
+    elif args.devices or args.cpu_workers:
+        print("\n" + "=" * 60)
+        print("Генерация на пуле воркеров")
+        print("=" * 60)
+        
+        output_dirs = {"direct": direct_dir, "sap": sap_dir}
+        for mode in modes:
+            Path(output_dirs[mode]).mkdir(parents=True, exist_ok=True)
+        
+        try:
+            sap_generator = SAPFluxGenerator(
+                llm=args.llm,
+                device=args.device,
+                flux_version=args.flux_version,
+                cache=cache,
+                skip_fallback=args.skip_fallback
+            )
+            if "direct" in modes:
+                save_results_metadata(direct_dir, direct_metadata)
+            if remaining_units > 0:
+                pool = WorkerPool(
+                    partial(load_pool_pipeline, flux_version=args.flux_version, model_repo=args.model_repo),
+                    run_pool_batch,
+                    devices=args.devices,
+                    max_batch_size=args.pool_batch_size,
+                    batch_key=pool_batch_key,
+                    cpu_workers=args.cpu_workers
+                )
+                if cache is not None:
+                    sap_generator.fingerprint = model_fingerprint(
+                        args.model_repo or flux_model_repo(args.flux_version), pool_dtype(pool.devices[0])
+                    )
+                with pool:
+                    sap_metadata = save_stream(
+                        generate_pooled(pool, sap_generator, prompts, modes,
+                                        sap_prompts_list=pregenerated_sap, **generation_kwargs),
+                        output_dirs,
+                        writer=writer,
+                        manifest=manifest,
+                        phashes=phashes
+                    )
+            else:
+                sap_metadata = {}
+            if "sap" in modes:
+                save_results_metadata(sap_dir, sap_run_metadata(sap_metadata))
+            print("✅ Генерация на пуле воркеров завершена!")
+            
+        except Exception as e:
+            print(f"❌ Ошибка при генерации на пуле воркеров: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    # ===== РЕЖИМ BOTH: Direct и SAP в одном батче =====
+    elif args.mode == 'both' and not args.no_co_batch:
+        print("\n" + "=" * 60)
+        print("Direct FLUX + SAP Generation (в одном батче)")
         print("=" * 60)
         
-        direct_dir = os.path.join(batch_dir, "direct_flux")
         Path(direct_dir).mkdir(parents=True, exist_ok=True)
+        Path(sap_dir).mkdir(parents=True, exist_ok=True)
         
         try:
-            direct_generator = DirectFluxGenerator(device=args.device)
-            direct_results = direct_generator.generate(
-                prompts=prompts,
-                height=args.height,
-                width=args.width,
-                num_inference_steps=args.num_inference_steps,
-                guidance_scale=args.guidance_scale,
-                seeds=args.seeds,
-                num_images_per_prompt=len(args.seeds)
+            sap_generator = SAPFluxGenerator(
+                llm=args.llm,
+                device=args.device,
+                pipeline=shared_pipeline,
+                flux_version=args.flux_version,
+                cache=cache,
+                skip_fallback=args.skip_fallback
+            )
+            save_results_metadata(direct_dir, direct_metadata)
+            
+            # Генерация и сохранение результатов по мере готовности батчей
+            sap_metadata = save_stream(
+                sap_generator.generate_with_direct(
+                    prompts=prompts,
+                    sap_prompts_list=pregenerated_sap,
+                    **generation_kwargs
+                ),
+                {"direct": direct_dir, "sap": sap_dir},
+                writer=writer,
+                manifest=manifest,
+                phashes=phashes
             )
             
-            # Сохранение результатов
-            print("\n💾 Сохранение результатов Direct FLUX...")
-            for prompt, images in direct_results.items():
-                if images:
-                    save_results(images, direct_dir, prompt, "direct", args.seeds)
+            save_results_metadata(sap_dir, sap_run_metadata(sap_metadata))
+            print("✅ Direct + SAP FLUX генерация завершена!")
             
+        except Exception as e:
+            print(f"❌ Ошибка при совместной генерации: {e}")
+            import traceback
+            traceback.print_exc()
+    
+    # ===== РЕЖИМ DIRECT =====
+    elif args.mode in ['direct', 'both']:
+        print("\n" + "=" * 60)
+        print("ЭТАП 1: Direct FLUX Generation (без SAP)")
+        print("=" * 60)
+        
+        Path(direct_dir).mkdir(parents=True, exist_ok=True)
+        
+        try:
+            direct_generator = DirectFluxGenerator(
+                device=args.device,
+                pipeline=shared_pipeline,
+                flux_version=args.flux_version,
+                cache=cache
+            )
             # Сохранение метаданных
-            metadata = {
-                "mode": "direct_flux",
-                "num_prompts": len(prompts),
-                "image_size": f"{args.height}x{args.width}",
-                "num_inference_steps": args.num_inference_steps,
-                "guidance_scale": args.guidance_scale,
-                "seeds": args.seeds
-            }
-            save_results_metadata(direct_dir, metadata)
+            save_results_metadata(direct_dir, direct_metadata)
+            
+            # Генерация и сохранение результатов по мере готовности батчей
+            save_stream(
+                direct_generator.generate(prompts=prompts, **generation_kwargs),
+                {"direct": direct_dir},
+                writer=writer,
+                manifest=manifest,
+                phashes=phashes
+            )
             print("✅ Direct FLUX генерация завершена!")
             
         except Exception as e:
@@ -405,118 +1457,38 @@ def main():
             traceback.print_exc()
     
     # ===== РЕЖИМ SAP =====
-    if args.mode in ['sap', 'both']:
+    if not (args.staged or args.devices or args.cpu_workers) and \
+            (args.mode == 'sap' or (args.mode == 'both' and args.no_co_batch)):
         print("\n" + "=" * 60)
         print("ЭТАП 2: SAP Generation (с LLM декомпозицией)")
         print("=" * 60)
         
-        sap_dir = os.path.join(batch_dir, "sap_flux")
         Path(sap_dir).mkdir(parents=True, exist_ok=True)
         
         try:
-            sap_generator = SAPFluxGenerator(llm=args.llm, device=args.device)
-            
-            # Проверяем, нужно ли использовать предгенерированные SAP промты
-            sap_prompts_to_use = None
-            if args.use_pregenerated_sap:
-                print(f"\n📂 Загружаю предгенерированные SAP промты из: {args.use_pregenerated_sap}")
-                try:
-                    from sap_prompts_loader import SAPPromptsLoader
-                    loader = SAPPromptsLoader(args.use_pregenerated_sap)
-                    sap_decompositions = loader.get_sap_decompositions_batch(prompts)
-                    
-                    # Проверяем, что все промты найдены
-                    found_count = sum(1 for x in sap_decompositions if x is not None)
-                    if found_count == len(prompts):
-                        sap_prompts_to_use = sap_decompositions
-                        print(f"✅ Все {len(prompts)} SAP декомпозиций успешно загружены!")
-                    else:
-                        print(f"⚠️  Найдено только {found_count}/{len(prompts)} SAP декомпозиций")
-                        print(f"    Остальные будут сгенерированы на лету...")
-                        sap_prompts_to_use = sap_decompositions
-                except ImportError:
-                    print(f"❌ Не удалось импортировать SAPPromptsLoader")
-                except Exception as e:
-                    print(f"❌ Ошибка при загрузке предгенерированных промтов: {e}")
-            
-            # Если SAP промты загружены, используем их напрямую
-            if sap_prompts_to_use:
-                sap_results = {}
-                sap_metadata = {}
-                
-                for i, (original_prompt, sap_prompt_data) in enumerate(zip(prompts, sap_prompts_to_use)):
-                    print(f"\n🎨 Генерация SAP для: '{original_prompt}'")
-                    
-                    # Если SAP данные не загружены, пропускаем
-                    if sap_prompt_data is None:
-                        print(f"⚠️  SAP декомпозиция не найдена для промта {i+1}, пропускаю...")
-                        continue
-                    
-                    # Сохранение метаданных
-                    sap_metadata[original_prompt] = {
-                        "explanation": sap_prompt_data.get("explanation", "Loaded from pregenerated"),
-                        "prompts_count": len(sap_prompt_data.get("prompts_list", [])),
-                        "switch_steps": sap_prompt_data.get("switch_prompts_steps", []),
-                        "source": "pregenerated"
-                    }
-                    
-                    # Создание генераторов
-                    generators = []
-                    for seed in args.seeds:
-                        gen = torch.Generator(device=args.device)
-                        gen.manual_seed(seed)
-                        generators.append(gen)
-                    
-                    try:
-                        # Генерация с SAP
-                        output = sap_generator.pipeline(
-                            height=args.height,
-                            width=args.width,
-                            num_inference_steps=args.num_inference_steps,
-                            guidance_scale=args.guidance_scale,
-                            generator=generators,
-                            num_images_per_prompt=len(generators),
-                            sap_prompts=sap_prompt_data
-                        )
-                        
-                        images = output.images
-                        sap_results[original_prompt] = images
-                        print(f"✅ Сгенерировано {len(images)} изображений (с предгенерированной SAP декомпозицией)")
-                        
-                    except Exception as e:
-                        print(f"❌ Ошибка при SAP генерации: {e}")
-                        sap_results[original_prompt] = []
-            else:
-                # Стандартная генерация SAP (с вызовом LLM)
-                sap_results, sap_metadata = sap_generator.generate(
+            sap_generator = SAPFluxGenerator(
+                llm=args.llm,
+                device=args.device,
+                pipeline=shared_pipeline,
+                flux_version=args.flux_version,
+                cache=cache,
+                skip_fallback=args.skip_fallback
+            )
+            # Генерация и сохранение результатов по мере готовности батчей
+            sap_metadata = save_stream(
+                sap_generator.generate(
                     prompts=prompts,
-                    height=args.height,
-                    width=args.width,
-                    num_inference_steps=args.num_inference_steps,
-                    guidance_scale=args.guidance_scale,
-                    seeds=args.seeds,
-                    num_images_per_prompt=len(args.seeds)
-                )
-            
-            # Сохранение результатов
-            print("\n💾 Сохранение результатов SAP FLUX...")
-            for prompt, images in sap_results.items():
-                if images:
-                    save_results(images, sap_dir, prompt, "sap", args.seeds)
+                    sap_prompts_list=pregenerated_sap,
+                    **generation_kwargs
+                ),
+                {"sap": sap_dir},
+                writer=writer,
+                manifest=manifest,
+                phashes=phashes
+            )
             
             # Сохранение метаданных SAP
-            metadata = {
-                "mode": "sap_flux",
-                "llm": args.llm,
-                "num_prompts": len(prompts),
-                "image_size": f"{args.height}x{args.width}",
-                "num_inference_steps": args.num_inference_steps,
-                "guidance_scale": args.guidance_scale,
-                "seeds": args.seeds,
-                "used_pregenerated_sap": args.use_pregenerated_sap is not None,
-                "sap_details": str(sap_metadata)
-            }
-            save_results_metadata(sap_dir, metadata)
+            save_results_metadata(sap_dir, sap_run_metadata(sap_metadata))
             print("✅ SAP FLUX генерация завершена!")
             
         except Exception as e:
@@ -524,6 +1496,21 @@ def main():
             import traceback
             traceback.print_exc()
     
+    # Дожидаемся записи всех изображений
+    writer.close()
+    if cache is not None:
+        cache.print_stats()
+    remaining_units = sum(len(pending_seeds(mode, prompt, args.seeds)) for mode in modes for prompt in prompts)
+    manifest.close()
+    print(f"📒 Журнал запуска: выполнено {total_units - remaining_units}/{total_units}")
+    if remaining_units:
+        if num_shards > 1:
+            print(f"⚠️  Не сгенерировано {remaining_units} изображений, перезапустите задачу шарда {shard_index}")
+        else:
+            print(f"⚠️  Не сгенерировано {remaining_units} изображений, повторите запуск с --run-dir {batch_dir}")
+    if num_shards > 1:
+        print(f"🧩 После завершения всех шардов: python sharding.py {sharded_dir}")
+    
     # Завершение
     print("\n" + "=" * 60)
     print("🎉 Генерация завершена!")
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Continuous batching
+Планировщик непрерывного батчинга вокруг цикла дифузии SapFlux: новые
+запросы добавляются в работающий батч латентов на границе шага, а
+завершенные сэмплы сразу декодируются и покидают батч (как continuous
+batching в LLM serving). У каждого сэмпла свой номер шага, timestep и
+стадия SAP расписания.
+
+Бенчмарк (пропускная способность и p95 задержки при синтетическом потоке
+запросов, пакетная обработка запросов против непрерывной):
+    python continuous_batching.py --num-requests 32 --arrival-rate 0.2
+"""
+
+import json
+import time
+import random
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import CancelledError, Future, wait
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+from diffusers.pipelines.flux.pipeline_flux import calculate_shift, retrieve_timesteps
+
+from SAP_pipeline_flux import SapFlux, map_SAP_dict
+
+
+class BatchRequest:
+    """Сэмпл в непрерывном батче: собственные шаг, timestep и стадия SAP"""
+
+    def __init__(self, sap_prompts: Dict, seed: int, num_inference_steps: int):
+        self.sap_prompts = sap_prompts
+        self.seed = int(seed)
+        self.prompts_list, self.sap_mapping = map_SAP_dict(sap_prompts, num_inference_steps)
+        self.step = 0
+        self.latents: Optional[torch.Tensor] = None
+        self.cancelled = False
+        self.future: Future = Future()
+        self.submitted_at = time.perf_counter()
+        self.admitted_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def stage(self) -> int:
+        """Текущая стадия SAP расписания"""
+        return self.sap_mapping[f"step{self.step}"]
+
+    @property
+    def prompt(self) -> str:
+        """Промт, на котором обусловлен текущий шаг"""
+        return self.prompts_list[self.stage]
+
+    @property
+    def latency(self) -> Optional[float]:
+        return self.finished_at - self.submitted_at if self.finished_at is not None else None
+
+
+class ContinuousBatchScheduler:
+    """
+    Итерационный планировщик: один вызов трансформера - один шаг для всех
+    активных сэмплов, каждый на своем timestep.
+
+    Шаг Flow Matching Euler выполняется здесь же по сигмам каждого сэмпла
+    (общий scheduler пайплайна хранит один step_index на весь батч).
+    Все сэмплы планировщика имеют одинаковые размер, число шагов и
+    guidance: для других параметров нужен отдельный планировщик (общий
+    step_lock сериализует их шаги на одном устройстве).
+    """
+
+    def __init__(
+        self,
+        pipeline: SapFlux,
+        height: int = 1024,
+        width: int = 1024,
+        num_inference_steps: int = 50,
+        guidance_scale: float = 3.5,
+        max_batch_size: int = 4,
+        device: str = "cuda",
+        continuous: bool = True,
+        max_sequence_length: int = 512,
+        step_lock: Optional[threading.Lock] = None
+    ):
+        """
+        Args:
+            pipeline: загруженный SapFlux
+            height, width: размер изображений
+            num_inference_steps: количество шагов дифузии
+            guidance_scale: guidance FLUX
+            max_batch_size: максимум сэмплов в одном вызове трансформера
+            device: устройство генераторов шума (как в generate_samples)
+            continuous: добавлять запросы на каждом шаге (False - только когда
+                        батч пуст, т.е. пакетная обработка запросов)
+            max_sequence_length: длина T5 последовательности
+            step_lock: общий замок шагов нескольких планировщиков
+        """
+        self.pipeline = pipeline
+        self.height = height
+        self.width = width
+        self.num_inference_steps = num_inference_steps
+        self.guidance_scale = guidance_scale
+        self.max_batch_size = max_batch_size
+        self.generator_device = device.split(":")[0]
+        self.continuous = continuous
+        self.max_sequence_length = max_sequence_length
+        self.step_lock = step_lock or threading.Lock()
+
+        self.device = pipeline._execution_device
+        self.num_channels_latents = pipeline.transformer.config.in_channels // 4
+        self.timesteps, self.sigmas = self._prepare_schedule()
+
+        self._pending: deque = deque()
+        self._active: List[BatchRequest] = []
+        self._embeds: Dict[str, Dict[str, torch.Tensor]] = {}
+        self._latent_image_ids: Optional[torch.Tensor] = None
+        self._cond = threading.Condition()
+        self._closed = False
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"steps": 0, "samples": 0, "batch_rows": 0}
+
+    def _prepare_schedule(self) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Timesteps и сигмы (с конечной нулевой) - как в SapFlux.__call__"""
+        n = self.num_inference_steps
+        latent_h = 2 * (self.height // (self.pipeline.vae_scale_factor * 2))
+        latent_w = 2 * (self.width // (self.pipeline.vae_scale_factor * 2))
+        image_seq_len = (latent_h // 2) * (latent_w // 2)
+        config = self.pipeline.scheduler.config
+        mu = calculate_shift(
+            image_seq_len,
+            config.get("base_image_seq_len", 256),
+            config.get("max_image_seq_len", 4096),
+            config.get("base_shift", 0.5),
+            config.get("max_shift", 1.15),
+        )
+        timesteps, _ = retrieve_timesteps(
+            self.pipeline.scheduler, n, self.device, sigmas=np.linspace(1.0, 1 / n, n), mu=mu
+        )
+        sigmas = self.pipeline.scheduler.sigmas.to(self.device, dtype=torch.float32)
+        return timesteps.clone(), sigmas.clone()
+
+    # ---------- очередь ----------
+    def submit(self, sap_prompts: Dict, seed: int) -> BatchRequest:
+        """Ставит сэмпл в очередь; результат - request.future (PIL изображение)"""
+        request = BatchRequest(sap_prompts, seed, self.num_inference_steps)
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Планировщик остановлен")
+            self._pending.append(request)
+            self._cond.notify()
+        return request
+
+    def cancel(self, request: BatchRequest):
+        """Снимает сэмпл: из очереди - сразу, из батча - на ближайшей границе шага"""
+        request.cancelled = True
+        request.future.cancel()
+
+    def _admit(self):
+        """Добавляет ожидающие сэмплы в батч на границе шага"""
+        if not self.continuous and self._active:
+            return
+        admitted = []
+        with self._cond:
+            while self._pending and len(self._active) + len(admitted) < self.max_batch_size:
+                request = self._pending.popleft()
+                if request.cancelled or not request.future.set_running_or_notify_cancel():
+                    continue
+                admitted.append(request)
+        if not admitted:
+            return
+
+        self._embeds = self.pipeline.encode_sap_prompts(
+            [r.sap_prompts for r in admitted],
+            max_sequence_length=self.max_sequence_length,
+            prompt_embeds_by_text=self._embeds,
+        )
+        dtype = next(iter(self._embeds.values()))["prompt_embeds"].dtype
+        for request in admitted:
+            generator = torch.Generator(device=self.generator_device).manual_seed(request.seed)
+            request.latents, self._latent_image_ids = self.pipeline.prepare_latents(
+                1, self.num_channels_latents, self.height, self.width, dtype, self.device, generator
+            )
+            request.admitted_at = time.perf_counter()
+        self._active.extend(admitted)
+
+    def _step(self):
+        """Один вызов трансформера для всех активных сэмплов"""
+        active = self._active
+        latents = torch.cat([r.latents for r in active], dim=0)
+        steps = torch.tensor([r.step for r in active], device=self.device)
+        timestep = self.timesteps[steps].to(latents.dtype)
+
+        embeds = [self._embeds[r.prompt] for r in active]
+        prompt_embeds = torch.cat([e["prompt_embeds"] for e in embeds], dim=0)
+        pooled_prompt_embeds = torch.cat([e["pooled_prompt_embeds"] for e in embeds], dim=0)
+        guidance = None
+        if self.pipeline.transformer.config.guidance_embeds:
+            guidance = torch.full([len(active)], self.guidance_scale, device=self.device, dtype=torch.float32)
+
+        noise_pred = self.pipeline.transformer(
+            hidden_states=latents,
+            timestep=timestep / 1000,
+            guidance=guidance,
+            pooled_projections=pooled_prompt_embeds,
+            encoder_hidden_states=prompt_embeds,
+            txt_ids=embeds[0]["text_ids"],
+            img_ids=self._latent_image_ids,
+            joint_attention_kwargs={},
+            return_dict=False,
+        )[0]
+
+        # Euler шаг Flow Matching с сигмами каждого сэмпла
+        dt = (self.sigmas[steps + 1] - self.sigmas[steps]).view(-1, 1, 1)
+        latents = (latents.to(torch.float32) + dt * noise_pred.to(torch.float32)).to(latents.dtype)
+        for row, request in enumerate(active):
+            request.latents = latents[row:row + 1]
+            request.step += 1
+
+        self.stats["steps"] += 1
+        self.stats["batch_rows"] += len(active)
+
+    def _retire(self):
+        """Декодирует завершенные сэмплы и убирает снятые из батча"""
+        for request in self._active:
+            if request.cancelled and not request.future.done():
+                request.future.set_exception(CancelledError())
+        finished = [r for r in self._active if r.step >= self.num_inference_steps and not r.cancelled]
+        self._active = [r for r in self._active if r.step < self.num_inference_steps and not r.cancelled]
+        if finished:
+            images = self.pipeline.decode_latents(
+                torch.cat([r.latents for r in finished], dim=0), self.height, self.width
+            )
+            now = time.perf_counter()
+            for request, image in zip(finished, images):
+                request.latents = None
+                request.finished_at = now
+                request.future.set_result(image)
+            self.stats["samples"] += len(finished)
+
+        # Эмбеддинги нужны только промтам активных и ожидающих сэмплов
+        with self._cond:
+            needed = {p for r in list(self._active) + list(self._pending) for p in r.prompts_list}
+        self._embeds = {text: e for text, e in self._embeds.items() if text in needed}
+
+    def run_once(self) -> bool:
+        """Граница шага: прием новых сэмплов, шаг, выпуск готовых"""
+        with self.step_lock:
+            self._admit()
+            if not self._active:
+                return False
+            with torch.no_grad():
+                self._step()
+                self._retire()
+        return True
+
+    # ---------- фоновый цикл ----------
+    def _loop(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._active and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending and not self._active:
+                    return
+            try:
+                self.run_once()
+            except Exception as e:
+                for request in self._active:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                self._active = []
+
+    def start(self) -> "ContinuousBatchScheduler":
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="continuous-batching", daemon=True)
+            self._thread.start()
+        return self
+
+    def close(self):
+        """Дожидается уже поставленных сэмплов и останавливает цикл"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+    def generate(self, samples: List[Tuple[Dict, int]]) -> List[Any]:
+        """Генерирует сэмплы (расписание, seed) и возвращает изображения по порядку"""
+        requests = [self.submit(sap_prompts, seed) for sap_prompts, seed in samples]
+        return [r.future.result() for r in requests]
+
+
+# ==================== БЕНЧМАРК ====================
+def poisson_arrivals(num_requests: int, arrival_rate: float, seed: int = 0) -> List[float]:
+    """Моменты поступления запросов (пуассоновский поток, запросов в секунду)"""
+    rng = random.Random(seed)
+    t, arrivals = 0.0, []
+    for _ in range(num_requests):
+        arrivals.append(t)
+        t += rng.expovariate(arrival_rate)
+    return arrivals
+
+
+def percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def run_workload(scheduler: ContinuousBatchScheduler, samples: List[Tuple[Dict, int]],
+                 arrivals: List[float]) -> Dict:
+    """Подает сэмплы по расписанию поступления и измеряет задержки"""
+    requests = []
+    with scheduler:
+        start = time.perf_counter()
+        for (sap_prompts, seed), arrival in zip(samples, arrivals):
+            delay = start + arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            requests.append(scheduler.submit(sap_prompts, seed))
+        wait([r.future for r in requests])
+        stopped = time.perf_counter()
+    # Метрики - по завершенным сэмплам; отмененные и упавшие считаются отдельно
+    completed = [r for r in requests if r.finished_at is not None]
+    cancelled = [r for r in requests if r.cancelled or r.future.cancelled()]
+    failed = [r for r in requests if r.finished_at is None and r not in cancelled]
+    if failed or cancelled:
+        print(f"⚠️  Не завершено запросов: ошибок {len(failed)}, отменено {len(cancelled)}")
+    end = max((r.finished_at for r in completed), default=stopped)
+    latencies = [r.latency for r in completed]
+    queue_waits = [r.admitted_at - r.submitted_at for r in completed]
+    return {
+        "mode": "continuous" if scheduler.continuous else "request-level",
+        "num_requests": len(requests),
+        "completed": len(completed),
+        "failed": len(failed),
+        "cancelled": len(cancelled),
+        "wall_time_s": round(end - start, 3),
+        "throughput_img_per_s": round(len(completed) / (end - start), 4) if end > start else 0.0,
+        "latency_p50_s": round(percentile(latencies, 50), 3),
+        "latency_p95_s": round(percentile(latencies, 95), 3),
+        "queue_wait_p95_s": round(percentile(queue_waits, 95), 3),
+        "mean_batch_size": round(scheduler.stats["batch_rows"] / max(scheduler.stats["steps"], 1), 2),
+        "transformer_calls": scheduler.stats["steps"]
+    }
+
+
+def benchmark(pipeline: SapFlux, samples: List[Tuple[Dict, int]], arrival_rate: float,
+              max_batch_size: int = 4, **scheduler_kwargs) -> List[Dict]:
+    """Сравнивает пакетную обработку запросов и непрерывный батчинг на одном потоке"""
+    arrivals = poisson_arrivals(len(samples), arrival_rate)
+    reports = []
+    for continuous in (False, True):
+        scheduler = ContinuousBatchScheduler(
+            pipeline, max_batch_size=max_batch_size, continuous=continuous, **scheduler_kwargs
+        )
+        reports.append(run_workload(scheduler, samples, arrivals))
+    return reports
+
+
+def main():
+    from combined_flux_sap import direct_sap_schedule, load_pregenerated_sap, load_sap_flux, read_prompts_from_file
+
+    parser = argparse.ArgumentParser(description="Бенчмарк непрерывного батчинга SapFlux")
+    parser.add_argument('--prompts-file', type=str, default='prompts.txt', help='Файл с промтами')
+    parser.add_argument('--sap-json', type=str, default=None,
+                        help='Предгенерированные SAP декомпозиции (иначе - одностадийные расписания)')
+    parser.add_argument('--num-requests', type=int, default=32, help='Количество запросов')
+    parser.add_argument('--arrival-rate', type=float, default=0.2, help='Запросов в секунду')
+    parser.add_argument('--max-batch-size', type=int, default=4, help='Максимальный размер батча')
+    parser.add_argument('--height', type=int, default=1024, help='Высота изображения')
+    parser.add_argument('--width', type=int, default=1024, help='Ширина изображения')
+    parser.add_argument('--num-inference-steps', type=int, default=50, help='Количество шагов дифузии')
+    parser.add_argument('--device', type=str, choices=['cuda', 'cpu'], default='cuda', help='Устройство')
+    parser.add_argument('--flux-version', type=str, default='1-dev', help='Версия FLUX')
+    parser.add_argument('--output', type=str, default=None, help='Сохранить отчет в JSON')
+    args = parser.parse_args()
+
+    prompts = read_prompts_from_file(args.prompts_file)
+    decompositions = load_pregenerated_sap(args.sap_json, prompts) if args.sap_json else None
+    schedules = [d or direct_sap_schedule(p) for p, d in zip(prompts, decompositions or [None] * len(prompts))]
+    samples = [(schedules[i % len(schedules)], 1000 + i) for i in range(args.num_requests)]
+
+    pipeline = load_sap_flux(args.device, args.flux_version)
+    reports = benchmark(
+        pipeline, samples, args.arrival_rate, max_batch_size=args.max_batch_size,
+        height=args.height, width=args.width, num_inference_steps=args.num_inference_steps, device=args.device
+    )
+
+    print("\n📊 Непрерывный батчинг")
+    print(f"  {'Режим':<15}{'img/s':>10}{'p50, с':>10}{'p95, с':>10}{'батч':>8}")
+    for r in reports:
+        print(f"  {r['mode']:<15}{r['throughput_img_per_s']:>10}{r['latency_p50_s']:>10}"
+              f"{r['latency_p95_s']:>10}{r['mean_batch_size']:>8}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+        print(f"📄 Отчет: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Latent decoder benchmark
+Сравнение полного FLUX VAE и крошечного автоэнкодера TAEF1 (decoder="tiny"):
+задержка декодирования и качество (PSNR/MAE относительно полного VAE) на
+одних и тех же латентах
+
+    python decoder_benchmark.py --num-prompts 4 --output-dir results_decoders
+"""
+
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+import torch
+from PIL import Image
+
+from combined_flux_sap import direct_sap_schedule, load_sap_flux, read_prompts_from_file
+from SAP_pipeline_flux import LATENT_DECODERS, SapFlux
+
+
+def generate_latents(pipeline: SapFlux, prompts: List[str], seed: int, height: int, width: int,
+                     num_inference_steps: int) -> torch.Tensor:
+    """Упакованные латенты для промтов (одна дифузия на все декодеры)"""
+    output = pipeline(
+        sap_prompts=[direct_sap_schedule(p) for p in prompts],
+        generator=[torch.Generator().manual_seed(seed) for _ in prompts],
+        height=height,
+        width=width,
+        num_inference_steps=num_inference_steps,
+        output_type="latent"
+    )
+    return output.images
+
+
+def timed_decode(pipeline: SapFlux, latents: torch.Tensor, height: int, width: int, decoder: str,
+                 repeats: int) -> Dict:
+    """Декодирует латенты и возвращает изображения и задержку на изображение"""
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+    # Прогрев: загрузка весов и выбор ядер не входят в замер
+    pipeline.decode_latents(latents[:1], height, width, decoder=decoder)
+    sync()
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        images = pipeline.decode_latents(latents, height, width, decoder=decoder)
+        sync()
+        timings.append((time.perf_counter() - start) / len(latents))
+    peak_mb = torch.cuda.max_memory_allocated() / 2 ** 20 if torch.cuda.is_available() else None
+    return {"images": images, "ms_per_image": 1000 * float(np.median(timings)), "peak_mb": peak_mb}
+
+
+def image_quality(reference: Image.Image, image: Image.Image) -> Dict[str, float]:
+    """PSNR и средняя абсолютная ошибка относительно эталона (0-255)"""
+    a = np.asarray(reference.convert("RGB"), dtype=np.float64)
+    b = np.asarray(image.convert("RGB").resize(reference.size), dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    psnr = float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+    return {"psnr_db": psnr, "mae": float(np.mean(np.abs(a - b)))}
+
+
+def benchmark_decoders(pipeline: SapFlux, prompts: List[str], seed: int = 30498, height: int = 1024,
+                       width: int = 1024, num_inference_steps: int = 28, repeats: int = 3,
+                       output_dir: str = None) -> Dict:
+    """Сравнивает декодеры на общих латентах"""
+    latents = generate_latents(pipeline, prompts, seed, height, width, num_inference_steps)
+
+    results = {}
+    for decoder in LATENT_DECODERS:
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        results[decoder] = timed_decode(pipeline, latents, height, width, decoder, repeats)
+
+    reference = results["vae"]["images"]
+    report = {"num_images": len(prompts), "height": height, "width": width, "decoders": {}}
+    for decoder, result in results.items():
+        quality = [image_quality(ref, img) for ref, img in zip(reference, result["images"])]
+        report["decoders"][decoder] = {
+            "ms_per_image": round(result["ms_per_image"], 2),
+            "speedup": round(results["vae"]["ms_per_image"] / result["ms_per_image"], 2),
+            "peak_mb": round(result["peak_mb"], 1) if result["peak_mb"] is not None else None,
+            "psnr_db": round(float(np.mean([q["psnr_db"] for q in quality])), 2) if decoder != "vae" else None,
+            "mae": round(float(np.mean([q["mae"] for q in quality])), 2)
+        }
+
+    if output_dir:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        for i, prompt in enumerate(prompts):
+            row = [results[d]["images"][i] for d in LATENT_DECODERS]
+            canvas = Image.new("RGB", (width * len(row), height))
+            for j, image in enumerate(row):
+                canvas.paste(image.resize((width, height)), (j * width, 0))
+            canvas.save(os.path.join(output_dir, f"{i:02d}_{'_vs_'.join(LATENT_DECODERS)}.png"))
+        with open(os.path.join(output_dir, "decoder_report.json"), "w", encoding="utf-8") as f:
+            json.dump({**report, "prompts": prompts}, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение полного VAE и TAEF1 при декодировании латентов FLUX")
+    parser.add_argument('--prompts-file', type=str, default='prompts.txt', help='Файл с промтами')
+    parser.add_argument('--num-prompts', type=int, default=4, help='Сколько промтов взять из файла')
+    parser.add_argument('--seed', type=int, default=30498, help='Seed')
+    parser.add_argument('--height', type=int, default=1024, help='Высота изображения')
+    parser.add_argument('--width', type=int, default=1024, help='Ширина изображения')
+    parser.add_argument('--num-inference-steps', type=int, default=28, help='Количество шагов дифузии')
+    parser.add_argument('--repeats', type=int, default=3, help='Повторов замера декодирования')
+    parser.add_argument('--device', type=str, choices=['cuda', 'cpu'], default='cuda', help='Устройство')
+    parser.add_argument('--flux-version', type=str, default='1-dev', help='Версия FLUX')
+    parser.add_argument('--output-dir', type=str, default='results_decoders',
+                        help='Директория для пар изображений и отчета')
+    args = parser.parse_args()
+
+    prompts = read_prompts_from_file(args.prompts_file)[:args.num_prompts]
+    pipeline = load_sap_flux(args.device, args.flux_version)
+    report = benchmark_decoders(
+        pipeline, prompts, seed=args.seed, height=args.height, width=args.width,
+        num_inference_steps=args.num_inference_steps, repeats=args.repeats, output_dir=args.output_dir
+    )
+
+    print(f"\n📊 Декодирование {report['num_images']} латентов {report['width']}x{report['height']}")
+    print(f"  {'Декодер':<10}{'мс/изобр.':>12}{'ускорение':>12}{'PSNR, дБ':>10}{'MAE':>8}{'пик, МБ':>10}")
+    for decoder, r in report["decoders"].items():
+        psnr = r["psnr_db"] if r["psnr_db"] is not None else "—"
+        peak = r["peak_mb"] if r["peak_mb"] is not None else "—"
+        print(f"  {decoder:<10}{r['ms_per_image']:>12}{r['speedup']:>12}{psnr:>10}{r['mae']:>8}{peak:>10}")
+    print(f"📁 Пары изображений и отчет: {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,14 +5,26 @@
 """
 
 import os
+import sys
 import json
 import torch
 import argparse
 from pathlib import Path
-from typing import List, Dict, Tuple
+from typing import Callable, List, Dict, Optional, Set, Tuple
 from PIL import Image
 from diffusers import FluxPipeline
 
+# Общие модули проекта лежат в корне репозитория
+parent_dir = Path(__file__).parent.parent
+if str(parent_dir) not in sys.path:
+    sys.path.insert(0, str(parent_dir))
+
+from image_writer import ImageWriter, add_image_writer_arguments
+from run_manifest import RunManifest, params_hash
+from sharding import (
+    add_sharding_arguments, estimate_generation_cost, make_unit, resolve_shard, select_shard, shard_dir_name
+)
+
 class FluxImageGenerator:
     """Генератор изображений на основе FLUX модели"""
     
@@ -95,7 +107,9 @@ class FluxImageGenerator:
         
         return result.images
     
-    def save_images(self, images: List[Image.Image], output_dir: str, prefix: str = ""):
+    def save_images(self, images: List[Image.Image], output_dir: str, prefix: str = "",
+                    writer: Optional[ImageWriter] = None, indices: Optional[List[int]] = None,
+                    on_saved: Optional[Callable[[int, str], None]] = None):
         """
         Сохранение изображений в директорию
         
@@ -103,16 +117,29 @@ class FluxImageGenerator:
             images: Список изображений для сохранения
             output_dir: Директория для сохранения
             prefix: Префикс для имен файлов
+            writer: Фоновый пул записи (None - синхронное сохранение в PNG)
+            indices: Номера изображений в именах файлов (по умолчанию 0, 1, ...)
+            on_saved: Вызывается с (номер, путь) после записи файла
         """
         Path(output_dir).mkdir(parents=True, exist_ok=True)
+        if indices is None:
+            indices = list(range(len(images)))
         
         saved_paths = []
-        for i, image in enumerate(images):
+        for i, image in zip(indices, images):
             filename = f"{prefix}_{i:04d}.png" if prefix else f"image_{i:04d}.png"
             filepath = os.path.join(output_dir, filename)
-            image.save(filepath)
+            callback = (lambda path, index=i: on_saved(index, path)) if on_saved is not None else None
+            if writer is not None:
+                filepath = writer.output_path(filepath)
+                writer.submit(image, filepath, on_written=callback)
+                print(f"   💾 В очереди на запись: {os.path.basename(filepath)}")
+            else:
+                image.save(filepath)
+                print(f"   ✅ Сохранено: {filename}")
+                if callback is not None:
+                    callback(filepath)
             saved_paths.append(filepath)
-            print(f"   ✅ Сохранено: {filename}")
         
         return saved_paths
 
@@ -133,13 +160,69 @@ def load_prompts_from_file(filepath: str) -> Dict[str, Dict]:
         return json.load(f)
 
 
+def build_prompt_plan(
+    prompts_data: Dict[str, Dict],
+    num_without_hints: int = 2,
+    num_with_hints: int = 5,
+    seed_base: int = 42
+) -> Dict[str, Dict[str, List[Tuple[int, str, int]]]]:
+    """
+    План генерации: для каждого промпта и варианта (without_hints/with_hints)
+    список (номер изображения, промпт, seed)
+    """
+    plan = {}
+    for prompt_name, prompt_info in prompts_data.items():
+        base_prompt = prompt_info.get("text", "")
+        hints = prompt_info.get("hints", [])
+        if not base_prompt:
+            continue
+        
+        seeds_without = list(range(seed_base, seed_base + num_without_hints))
+        seeds_with = list(range(seed_base + num_without_hints, seed_base + num_without_hints + num_with_hints))
+        
+        # Создание расширенных промптов с подсказками
+        extended_prompts = []
+        for i in range(num_with_hints):
+            hint_idx = i % len(hints) if hints else 0
+            hint = hints[hint_idx] if hints else ""
+            extended_prompt = f"{base_prompt}. {hint}" if hint else base_prompt
+            extended_prompts.append(extended_prompt)
+        
+        plan[prompt_name] = {
+            "without_hints": [(i, base_prompt, seed) for i, seed in enumerate(seeds_without)],
+            "with_hints": [(i, extended_prompts[i], seed) for i, seed in enumerate(seeds_with)]
+        }
+    return plan
+
+
+def plan_units(plan: Dict[str, Dict[str, List[Tuple[int, str, int]]]], phash: str,
+               cost: float = 1.0) -> List[Dict]:
+    """
+    Единицы работы плана: вариант промпта генерируется одним батчем в одном шарде.
+
+    Ключ единицы строится по тексту промпта (с подсказкой для with_hints), а
+    не по имени: после правки текста или подсказок в JSON изображение
+    генерируется заново.
+    """
+    return [
+        make_unit(variant, prompt, seed, phash, cost=cost, group=f"{prompt_name}|{variant}")
+        for prompt_name, variants in plan.items()
+        for variant, items in variants.items()
+        for _, prompt, seed in items
+    ]
+
+
 def process_prompts(
     generator: FluxImageGenerator,
     prompts_data: Dict[str, Dict],
     output_base_dir: str,
     num_without_hints: int = 2,
     num_with_hints: int = 5,
-    seed_base: int = 42
+    seed_base: int = 42,
+    writer: Optional[ImageWriter] = None,
+    manifest: Optional[RunManifest] = None,
+    phash: str = "",
+    owned_keys: Optional[Set[str]] = None
 ) -> None:
     """
     Обрабатывает все промпты: генерирует изображения с и без подсказок
@@ -151,65 +234,75 @@ def process_prompts(
         num_without_hints: Количество изображений БЕЗ подсказок
         num_with_hints: Количество изображений С подсказками
         seed_base: Базовое значение для seed'ов
+        writer: Фоновый пул записи изображений
+        manifest: Журнал запуска: готовые изображения пропускаются
+        phash: Хэш параметров генерации (для ключей журнала)
+        owned_keys: Ключи единиц работы текущего шарда (None - все)
     """
+    plan = build_prompt_plan(prompts_data, num_without_hints, num_with_hints, seed_base)
+    titles = {
+        "without_hints": ("🖼️", "БЕЗ подсказок", "img"),
+        "with_hints": ("💡", "С подсказками", "img_hint")
+    }
     
     for prompt_name, prompt_info in prompts_data.items():
+        if prompt_name not in plan:
+            print(f"⚠️  Пропуск {prompt_name}: нет основного промпта")
+            continue
+        
+        # Изображения этого шарда, которые еще не сгенерированы
+        todo = {}
+        for variant, items in plan[prompt_name].items():
+            selected = []
+            for index, prompt, seed in items:
+                unit = make_unit(variant, prompt, seed, phash)
+                if owned_keys is not None and unit["key"] not in owned_keys:
+                    continue
+                if manifest is not None and manifest.is_done(unit["key"]):
+                    continue
+                selected.append((index, prompt, seed))
+            todo[variant] = selected
+        if not any(todo.values()):
+            continue
+        
         print(f"\n{'='*60}")
         print(f"📋 Обработка: {prompt_name}")
         print(f"{'='*60}")
         
-        base_prompt = prompt_info.get("text", "")
-        hints = prompt_info.get("hints", [])
-        
-        if not base_prompt:
-            print(f"⚠️  Пропуск: нет основного промпта")
-            continue
-        
         # Создание директории для этого промпта
         prompt_dir = os.path.join(output_base_dir, prompt_name)
         
-        # 1. Генерация без подсказок
-        print(f"\n🖼️  Генерация {num_without_hints} изображений БЕЗ подсказок...")
-        without_hints_dir = os.path.join(prompt_dir, "without_hints")
-        
-        seeds_without = list(range(seed_base, seed_base + num_without_hints))
-        images_without = generator.generate_images(
-            prompts=[base_prompt] * num_without_hints,
-            num_images_per_prompt=1,
-            seeds=seeds_without
-        )
-        generator.save_images(images_without, without_hints_dir, prefix="img")
-        
-        # 2. Генерация с подсказками
-        print(f"\n💡 Генерация {num_with_hints} изображений С подсказками...")
-        with_hints_dir = os.path.join(prompt_dir, "with_hints")
-        
-        # Создание расширенных промптов с подсказками
-        extended_prompts = []
-        for i in range(num_with_hints):
-            hint_idx = i % len(hints) if hints else 0
-            hint = hints[hint_idx] if hints else ""
-            extended_prompt = f"{base_prompt}. {hint}" if hint else base_prompt
-            extended_prompts.append(extended_prompt)
-        
-        seeds_with = list(range(seed_base + num_without_hints, seed_base + num_without_hints + num_with_hints))
-        images_with = generator.generate_images(
-            prompts=extended_prompts,
-            num_images_per_prompt=1,
-            seeds=seeds_with
-        )
-        generator.save_images(images_with, with_hints_dir, prefix="img_hint")
+        for variant, selected in todo.items():
+            if not selected:
+                continue
+            icon, title, prefix = titles[variant]
+            print(f"\n{icon}  Генерация {len(selected)} изображений {title}...")
+            
+            on_saved = None
+            if manifest is not None:
+                units_by_index = {index: (prompt, seed) for index, prompt, seed in selected}
+                on_saved = (lambda index, path, v=variant, by_index=units_by_index:
+                            manifest.mark_done(v, *by_index[index], phash, path))
+            images = generator.generate_images(
+                prompts=[prompt for _, prompt, _ in selected],
+                num_images_per_prompt=1,
+                seeds=[seed for _, _, seed in selected]
+            )
+            generator.save_images(
+                images, os.path.join(prompt_dir, variant), prefix=prefix, writer=writer,
+                indices=[index for index, _, _ in selected], on_saved=on_saved
+            )
         
         print(f"\n✅ {prompt_name} завершено!")
         
         # Сохранение метаданных
         metadata = {
-            "prompt": base_prompt,
-            "hints": hints,
+            "prompt": prompt_info.get("text", ""),
+            "hints": prompt_info.get("hints", []),
             "images_without_hints": num_without_hints,
             "images_with_hints": num_with_hints,
-            "seeds_without_hints": seeds_without,
-            "seeds_with_hints": seeds_with
+            "seeds_without_hints": [seed for _, _, seed in plan[prompt_name]["without_hints"]],
+            "seeds_with_hints": [seed for _, _, seed in plan[prompt_name]["with_hints"]]
         }
         
         metadata_path = os.path.join(prompt_dir, "metadata.json")
@@ -268,29 +361,64 @@ def main():
         default=42,
         help="Базовое значение для seed'ов"
     )
+    add_image_writer_arguments(parser)
+    add_sharding_arguments(parser)
     
     args = parser.parse_args()
     
-    # Инициализация генератора
-    generator = FluxImageGenerator(args.model_path)
-    
     # Загрузка промптов
     print(f"\n📂 Загрузка промптов из {args.prompts_file}...")
     prompts_data = load_prompts_from_file(args.prompts_file)
     print(f"✅ Загружено {len(prompts_data)} промптов")
     
-    # Обработка всех промптов
-    process_prompts(
-        generator=generator,
-        prompts_data=prompts_data,
-        output_base_dir=args.output_dir,
-        num_without_hints=args.num_without_hints,
-        num_with_hints=args.num_with_hints,
-        seed_base=args.seed_base
-    )
+    # Шард задачи массива (--num-shards/--shard-index или SLURM array):
+    # результаты шарда пишутся в свою поддиректорию output_dir
+    num_shards, shard_index = resolve_shard(args.num_shards, args.shard_index)
+    output_dir = args.output_dir
+    if num_shards > 1:
+        output_dir = os.path.join(args.output_dir, shard_dir_name(shard_index, num_shards))
+    
+    manifest = RunManifest(output_dir)
+    phash = params_hash({
+        "model_path": os.path.abspath(args.model_path),
+        "height": args.height,
+        "width": args.width,
+        "image_format": args.image_format
+    })
+    plan = build_prompt_plan(prompts_data, args.num_without_hints, args.num_with_hints, args.seed_base)
+    units = plan_units(plan, phash, cost=estimate_generation_cost(args.height, args.width, 50))
+    if num_shards > 1:
+        units = select_shard(units, num_shards, shard_index, output_dir)
+    owned_keys = {unit["key"] for unit in units}
+    pending = [unit for unit in units if not manifest.is_done(unit["key"])]
+    for unit in pending:
+        manifest.mark_pending(unit["mode"], unit["prompt"], unit["seed"], phash)
+    print(f"📒 Изображений: {len(units)}, осталось сгенерировать: {len(pending)}")
+    
+    if pending:
+        # Инициализация генератора
+        generator = FluxImageGenerator(args.model_path)
+        
+        # Обработка всех промптов (кодирование изображений идет в фоне)
+        with ImageWriter.from_args(args) as writer:
+            process_prompts(
+                generator=generator,
+                prompts_data=prompts_data,
+                output_base_dir=output_dir,
+                num_without_hints=args.num_without_hints,
+                num_with_hints=args.num_with_hints,
+                seed_base=args.seed_base,
+                writer=writer,
+                manifest=manifest,
+                phash=phash,
+                owned_keys=owned_keys
+            )
+    manifest.close()
     
     print(f"\n{'='*60}")
-    print("🎉 Все готово! Результаты сохранены в:", args.output_dir)
+    print("🎉 Все готово! Результаты сохранены в:", output_dir)
+    if num_shards > 1:
+        print(f"🧩 После завершения всех шардов: python sharding.py {args.output_dir}")
     print(f"{'='*60}")
 
 
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+"""
+Content-addressed generation cache
+Кэш результатов генерации по хэшу (отпечаток весов модели, SAP декомпозиция,
+seed, параметры генерации): повторные прогоны одного и того же Direct FLUX
+бейзлайна берутся с диска без запуска дифузии
+"""
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from image_writer import ImageWriter
+
+# Кэш скриптов включается флагом --cache или переменной SAP_GENERATION_CACHE
+CACHE_DIR_ENV = os.getenv("SAP_GENERATION_CACHE")
+DEFAULT_CACHE_DIR = CACHE_DIR_ENV or os.path.join(os.path.expanduser("~"), ".cache", "sap_generation")
+DEFAULT_CACHE_MAX_GB = 2.0
+WEIGHT_EXTENSIONS = (".safetensors", ".bin", ".pt", ".pth", ".gguf")
+
+_fingerprints: Dict[str, str] = {}
+
+
+def model_fingerprint(model_id_or_path: str, dtype="bfloat16") -> str:
+    """
+    Отпечаток весов модели, вычисляемый без загрузки модели.
+
+    dtype - тип, в котором пайплайн реально работает (строка или torch.dtype):
+    результаты float32 реплик на CPU не смешиваются с результатами bf16 на GPU.
+
+    Для локальной директории учитываются имена, размеры и время изменения
+    файлов весов; для репозитория Hugging Face - хэш коммита локального
+    снапшота (если huggingface_hub доступен), иначе только имя репозитория.
+    """
+    dtype = str(dtype).replace("torch.", "")
+    cache_key = f"{model_id_or_path}|{dtype}"
+    if cache_key in _fingerprints:
+        return _fingerprints[cache_key]
+
+    parts = [str(model_id_or_path), dtype]
+    if os.path.isdir(model_id_or_path):
+        for root, _, files in sorted(os.walk(model_id_or_path)):
+            for filename in sorted(files):
+                if filename.endswith(WEIGHT_EXTENSIONS):
+                    path = os.path.join(root, filename)
+                    stat = os.stat(path)
+                    parts.append(f"{os.path.relpath(path, model_id_or_path)}:{stat.st_size}:{stat.st_mtime_ns}")
+    else:
+        try:
+            from huggingface_hub import snapshot_download
+            snapshot_dir = snapshot_download(model_id_or_path, local_files_only=True)
+            # Имя директории снапшота - хэш коммита
+            parts.append(os.path.basename(os.path.normpath(snapshot_dir)))
+        except Exception:
+            pass
+
+    fingerprint = hashlib.sha256("|".join(parts).encode("utf-8")).hexdigest()[:16]
+    _fingerprints[cache_key] = fingerprint
+    return fingerprint
+
+
+def make_cache_key(fingerprint: str, sap_prompts: Dict, seed: int, params: Dict) -> str:
+    """
+    Ключ результата генерации.
+
+    Из декомпозиции берутся только поля, влияющие на изображение
+    (prompts_list и switch_prompts_steps), поэтому Direct FLUX совпадает с
+    одностадийной SAP декомпозицией исходного промта.
+    """
+    payload = json.dumps({
+        "model": fingerprint,
+        "prompts_list": list(sap_prompts["prompts_list"]),
+        "switch_prompts_steps": list(sap_prompts["switch_prompts_steps"]),
+        "seed": int(seed),
+        "params": params
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LatentCapture:
+    """callback_on_step_end, запоминающий латенты после последнего шага"""
+
+    def __init__(self, num_inference_steps: int):
+        self.num_inference_steps = num_inference_steps
+        self.latents = None
+
+    def __call__(self, pipeline, step, timestep, callback_kwargs):
+        if step == self.num_inference_steps - 1:
+            self.latents = callback_kwargs["latents"].detach().to("cpu")
+        return {}
+
+
+class GenerationCache:
+    """Кэш изображений (и опционально латентов) с вытеснением по размеру"""
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_size_gb: float = DEFAULT_CACHE_MAX_GB,
+                 store_latents: bool = False, write_workers: int = 2):
+        """
+        Args:
+            cache_dir: директория кэша
+            max_size_gb: максимальный размер кэша; при превышении удаляются
+                         давно не использованные записи
+            store_latents: сохранять также финальные латенты (.pt)
+            write_workers: потоков фонового кодирования PNG
+        """
+        self.cache_dir = str(cache_dir)
+        self.objects_dir = os.path.join(self.cache_dir, "objects")
+        Path(self.objects_dir).mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = int(max_size_gb * 1024 ** 3)
+        self.store_latents = store_latents
+        # PNG кодируется в фоне: put не останавливает поток генерации
+        self.writer = ImageWriter(image_format="png", png_compress_level=1, max_workers=write_workers,
+                                  max_pending=32)
+
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.total_size = sum(entry.stat().st_size for entry in self._scan())
+
+    @classmethod
+    def from_args(cls, args) -> Optional["GenerationCache"]:
+        """
+        Создает кэш из аргументов add_generation_cache_arguments.
+
+        Кэш выключен, если не задан --cache или SAP_GENERATION_CACHE
+        (и всегда при --no-cache): он пишет на диск дополнительные PNG.
+        """
+        if args.no_cache or not (args.cache or CACHE_DIR_ENV):
+            return None
+        print(f"🗃️  Кэш генерации: {args.cache_dir} (до {args.cache_max_gb:g} GB)")
+        return cls(args.cache_dir, args.cache_max_gb, args.cache_latents)
+
+    def _scan(self) -> List[os.DirEntry]:
+        entries = []
+        for shard in os.scandir(self.objects_dir):
+            if shard.is_dir():
+                entries.extend(e for e in os.scandir(shard.path) if e.is_file() and not e.name.endswith(".tmp"))
+        return entries
+
+    def _path(self, key: str, extension: str) -> str:
+        return os.path.join(self.objects_dir, key[:2], key + extension)
+
+    def get(self, key: str):
+        """Возвращает изображение из кэша или None"""
+        path = self._path(key, ".png")
+        try:
+            from PIL import Image
+            with Image.open(path) as image:
+                image.load()
+                result = image.copy()
+            # Время использования для вытеснения давно не использованных записей
+            os.utime(path)
+        except (FileNotFoundError, OSError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def get_latents(self, key: str):
+        """Возвращает сохраненные латенты (torch.Tensor) или None"""
+        path = self._path(key, ".pt")
+        if not os.path.exists(path):
+            return None
+        import torch
+        return torch.load(path, map_location="cpu")
+
+    def _write(self, path: str, write_fn):
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        write_fn(tmp_path)
+        os.replace(tmp_path, path)
+        return os.path.getsize(path)
+
+    def put(self, key: str, image, latents=None, metadata: Optional[Dict] = None):
+        """Сохраняет результат генерации в кэш (изображение записывается в фоне)"""
+        added = 0
+        if metadata is not None:
+            added += self._write(
+                self._path(key, ".json"),
+                lambda p: Path(p).write_text(json.dumps(metadata, ensure_ascii=False, default=str), encoding="utf-8")
+            )
+        if latents is not None and self.store_latents:
+            import torch
+            added += self._write(self._path(key, ".pt"), lambda p: torch.save(latents.clone(), p))
+
+        path = self._path(key, ".png")
+        Path(os.path.dirname(path)).mkdir(parents=True, exist_ok=True)
+        self.writer.submit(image, path, on_written=self._stored)
+        self._account(added)
+
+    def _stored(self, path: str):
+        """Учет записанного изображения (поток записи)"""
+        with self._lock:
+            self.stores += 1
+        self._account(os.path.getsize(path))
+
+    def _account(self, added: int):
+        with self._lock:
+            self.total_size += added
+            need_eviction = self.total_size > self.max_size_bytes
+        if need_eviction:
+            self.evict()
+
+    def flush(self):
+        """Ждет завершения фоновой записи изображений"""
+        self.writer.flush()
+
+    def close(self):
+        """Дожидается записи и останавливает пул"""
+        self.flush()
+        self.writer.executor.shutdown(wait=True)
+
+    def evict(self):
+        """Удаляет давно не использованные записи, пока кэш не уложится в лимит"""
+        with self._lock:
+            # Группируем файлы записи (.png/.json/.pt) по ключу
+            groups: Dict[str, List[os.DirEntry]] = {}
+            for entry in self._scan():
+                groups.setdefault(entry.name.split(".")[0], []).append(entry)
+            total = sum(e.stat().st_size for entries in groups.values() for e in entries)
+            # Порядок вытеснения - по времени последнего использования изображения
+            order = sorted(groups.items(), key=lambda kv: max(e.stat().st_mtime for e in kv[1]))
+            target = int(self.max_size_bytes * 0.9)
+            for _, entries in order:
+                if total <= target:
+                    break
+                for entry in entries:
+                    try:
+                        size = entry.stat().st_size
+                        os.remove(entry.path)
+                        total -= size
+                    except FileNotFoundError:
+                        pass
+                self.evictions += 1
+            self.total_size = total
+
+    def stats(self) -> Dict:
+        """Статистика попаданий"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": f"{(self.hits / lookups * 100):.1f}%" if lookups else "0%",
+                "stores": self.stores,
+                "evictions": self.evictions,
+                "size_gb": round(self.total_size / 1024 ** 3, 3)
+            }
+
+    def print_stats(self):
+        self.flush()
+        stats = self.stats()
+        print(f"🗃️  Кэш генерации: попаданий {stats['hits']}, промахов {stats['misses']} "
+              f"({stats['hit_rate']}), сохранено {stats['stores']}, вытеснено {stats['evictions']}, "
+              f"размер {stats['size_gb']} GB")
+
+
+def add_generation_cache_arguments(parser):
+    """Добавляет в argparse параметры кэша генерации"""
+    group = parser.add_argument_group("Кэш генерации")
+    group.add_argument(
+        '--cache',
+        action='store_true',
+        help='Использовать кэш результатов генерации (включен также, если задана SAP_GENERATION_CACHE)'
+    )
+    group.add_argument(
+        '--cache-dir',
+        type=str,
+        default=DEFAULT_CACHE_DIR,
+        help='Директория кэша результатов генерации (или переменная SAP_GENERATION_CACHE)'
+    )
+    group.add_argument(
+        '--cache-max-gb',
+        type=float,
+        default=DEFAULT_CACHE_MAX_GB,
+        help='Максимальный размер кэша в GB'
+    )
+    group.add_argument(
+        '--cache-latents',
+        action='store_true',
+        help='Сохранять в кэш также финальные латенты'
+    )
+    group.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Не использовать кэш результатов генерации (даже если задана SAP_GENERATION_CACHE)'
+    )
+    return parser
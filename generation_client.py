@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Generation server client
+Легкий клиент API сервера генерации (generation_server.py) по HTTP или
+Unix-сокету: не импортирует torch и модели
+"""
+
+import os
+import json
+import time
+import socket
+import http.client
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+DEFAULT_SERVER_URL = os.getenv("SAP_SERVER_URL", "http://127.0.0.1:8765")
+FINAL_STATUSES = ("done", "failed", "cancelled")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """HTTP соединение через Unix-сокет"""
+
+    def __init__(self, socket_path: str, timeout: float = 30.0):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class GenerationClient:
+    """Клиент очереди задач сервера генерации"""
+
+    def __init__(self, url: str = DEFAULT_SERVER_URL, socket_path: Optional[str] = None, timeout: float = 30.0):
+        """
+        Args:
+            url: адрес HTTP сервера
+            socket_path: путь к Unix-сокету (имеет приоритет над url)
+            timeout: таймаут одного запроса в секундах
+        """
+        self.url = urlparse(url)
+        self.socket_path = socket_path
+        self.timeout = timeout
+
+    def _connection(self) -> http.client.HTTPConnection:
+        if self.socket_path:
+            return UnixHTTPConnection(self.socket_path, timeout=self.timeout)
+        return http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=self.timeout)
+
+    def _request(self, method: str, path: str, payload: Optional[Dict] = None) -> Dict:
+        connection = self._connection()
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = json.loads(response.read().decode("utf-8") or "{}")
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise RuntimeError(f"Сервер вернул {response.status}: {data.get('error', data)}")
+        return data
+
+    def is_available(self) -> bool:
+        """Сервер запущен и отвечает"""
+        try:
+            self.health()
+            return True
+        except (OSError, RuntimeError, ValueError):
+            return False
+
+    def health(self) -> Dict:
+        return self._request("GET", "/health")
+
+    def submit(self, job: Dict) -> str:
+        """Ставит задачу в очередь, возвращает ее идентификатор"""
+        return self._request("POST", "/jobs", job)["job_id"]
+
+    def status(self, job_id: str) -> Dict:
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def jobs(self) -> List[Dict]:
+        return self._request("GET", "/jobs")["jobs"]
+
+    def result(self, job_id: str) -> Dict:
+        """Итог задачи: статус и пути к изображениям"""
+        return self._request("GET", f"/jobs/{job_id}/result")
+
+    def cancel(self, job_id: str) -> Dict:
+        return self._request("DELETE", f"/jobs/{job_id}")
+
+    def wait(self, job_id: str, poll_interval: float = 2.0, verbose: bool = True) -> Dict:
+        """Ждет завершения задачи, печатая прогресс"""
+        last = None
+        while True:
+            status = self.status(job_id)
+            progress = (status["status"], status["progress"]["saved"], status["progress"]["total"])
+            if verbose and progress != last:
+                print(f"  ⏳ [{job_id}] {progress[0]}: {progress[1]}/{progress[2]} изображений")
+                last = progress
+            if status["status"] in FINAL_STATUSES:
+                return status
+            time.sleep(poll_interval)
@@ -0,0 +1,545 @@
+#!/usr/bin/env python3
+"""
+Persistent generation server
+Долгоживущий сервер генерации: SapFlux (с текстовыми энкодерами) и, по
+желанию, Zephyr загружаются один раз и остаются в памяти, а задачи
+(промты, режим, предустановка, seeds) принимаются через локальный HTTP API
+или Unix-сокет и выполняются из очереди
+
+API:
+    GET    /health                 - состояние сервера и моделей
+    POST   /jobs                   - поставить задачу в очередь
+    GET    /jobs                   - список задач
+    GET    /jobs/<id>              - статус и прогресс задачи
+    GET    /jobs/<id>/result       - пути к готовым изображениям
+    GET    /jobs/<id>/files/<путь> - файл результата
+    DELETE /jobs/<id>              - отменить задачу
+"""
+
+import os
+import json
+import queue
+import argparse
+import threading
+import socketserver
+from pathlib import Path
+from datetime import datetime
+from concurrent.futures import as_completed
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, List, Optional
+from uuid import uuid4
+
+from combined_flux_sap import (
+    FLUX_DTYPE, RESULTS_DIR, DirectFluxGenerator, SAPFluxGenerator, build_sap_metadata, direct_sap_schedule,
+    flux_model_repo, generation_params, load_sap_flux, save_stream, save_results_metadata
+)
+from continuous_batching import ContinuousBatchScheduler
+from image_writer import ImageWriter, add_image_writer_arguments
+from generation_cache import GenerationCache, add_generation_cache_arguments, make_cache_key, model_fingerprint
+from run_manifest import RunManifest, params_hash
+from quick_launch import PRESETS
+from llm_interface.model_registry import get_registry
+
+JOB_DEFAULTS = {
+    "mode": "both",
+    "llm": "GPT",
+    "height": 1024,
+    "width": 1024,
+    "num_inference_steps": 50,
+    "guidance_scale": 3.5,
+    "seeds": [30498]
+}
+
+
+class JobManifest(RunManifest):
+    """Журнал задачи, сообщающий о каждом записанном на диск изображении"""
+
+    def __init__(self, run_dir: str, on_done: Callable[[Dict], None]):
+        super().__init__(run_dir)
+        self.on_done = on_done
+
+    def mark_done(self, mode: str, prompt: str, seed: int, phash: str, output_path: str, **extra):
+        super().mark_done(mode, prompt, seed, phash, output_path, **extra)
+        self.on_done({"mode": mode, "prompt": prompt, "seed": int(seed), "path": str(output_path)})
+
+
+class GenerationService:
+    """Резидентные модели и очередь задач генерации"""
+
+    def __init__(self, device: str = "cuda", flux_version: str = "1-dev", output_dir: str = RESULTS_DIR,
+                 preload_zephyr: bool = False, writer: Optional[ImageWriter] = None,
+                 cache: Optional[GenerationCache] = None, continuous_batching: bool = False,
+                 max_batch_size: int = 4, job_workers: int = 4):
+        """
+        Args:
+            device: устройство генерации
+            flux_version: версия FLUX
+            output_dir: директория результатов задач
+            preload_zephyr: загрузить Zephyr при старте (иначе - при первой задаче с Zephyr)
+            writer: фоновый пул записи изображений
+            cache: кэш результатов генерации
+            continuous_batching: сэмплы всех задач идут в общий непрерывный батч
+                                 (новые задачи не ждут окончания текущего батча)
+            max_batch_size: максимальный размер непрерывного батча
+            job_workers: задач, готовящихся одновременно (только с continuous_batching)
+        """
+        self.device = device
+        self.flux_version = flux_version
+        self.output_dir = output_dir
+        self.writer = writer or ImageWriter()
+        self.cache = cache
+        self.fingerprint = model_fingerprint(flux_model_repo(flux_version), FLUX_DTYPE) if cache is not None else ""
+        self.continuous_batching = continuous_batching
+        self.max_batch_size = max_batch_size
+
+        self.pipeline = load_sap_flux(device, flux_version)
+        self._llm_lock = threading.Lock()
+        if preload_zephyr:
+            self._load_zephyr()
+
+        # Планировщик непрерывного батчинга на каждый набор (размер, шаги, guidance)
+        self.schedulers: Dict[tuple, ContinuousBatchScheduler] = {}
+        self._step_lock = threading.Lock()
+
+        self.jobs: Dict[str, Dict] = {}
+        self.queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = [
+            threading.Thread(target=self._run, name=f"generation-worker-{i}", daemon=True)
+            for i in range(job_workers if continuous_batching else 1)
+        ]
+        for worker in self._workers:
+            worker.start()
+
+    def _load_zephyr(self):
+        # Zephyr живет в общем реестре процесса и выгружается, когда FLUX не хватает памяти
+        with self._llm_lock:
+            get_registry().get("Zephyr")
+
+    def _scheduler(self, params: Dict) -> ContinuousBatchScheduler:
+        key = (params["height"], params["width"], params["num_inference_steps"], params["guidance_scale"])
+        with self._lock:
+            if key not in self.schedulers:
+                self.schedulers[key] = ContinuousBatchScheduler(
+                    self.pipeline,
+                    height=params["height"],
+                    width=params["width"],
+                    num_inference_steps=params["num_inference_steps"],
+                    guidance_scale=params["guidance_scale"],
+                    max_batch_size=self.max_batch_size,
+                    device=self.device,
+                    step_lock=self._step_lock
+                ).start()
+            return self.schedulers[key]
+
+    def health(self) -> Dict:
+        with self._lock:
+            statuses = [job["status"] for job in self.jobs.values()]
+        return {
+            "status": "ok",
+            "flux_version": self.flux_version,
+            "device": self.device,
+            "zephyr_loaded": get_registry().loaded("Zephyr"),
+            "llm_models": get_registry().status()["loaded"],
+            "continuous_batching": self.continuous_batching,
+            "queued": statuses.count("queued"),
+            "running": statuses.count("running"),
+            "cache": self.cache.stats() if self.cache is not None else None
+        }
+
+    def submit(self, request: Dict) -> Dict:
+        """Проверяет запрос и ставит задачу в очередь"""
+        params = dict(JOB_DEFAULTS)
+        preset = request.get("preset")
+        if preset:
+            if preset not in PRESETS:
+                raise ValueError(f"Неизвестная предустановка: {preset}")
+            params.update({k: v for k, v in PRESETS[preset].items() if k != "title"})
+        params.update({k: v for k, v in request.items() if k in JOB_DEFAULTS and v is not None})
+
+        prompts = request.get("prompts") or []
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        prompts = [p.strip() for p in prompts if p and p.strip()]
+        if not prompts:
+            raise ValueError("Нужен хотя бы один промт")
+        if params["mode"] not in ("direct", "sap", "both"):
+            raise ValueError(f"Неизвестный режим: {params['mode']}")
+        if params["llm"] not in ("GPT", "Zephyr"):
+            raise ValueError(f"Неизвестная LLM: {params['llm']}")
+
+        job_id = datetime.now().strftime("%Y%m%d_%H%M%S_") + uuid4().hex[:6]
+        modes = ["direct", "sap"] if params["mode"] == "both" else [params["mode"]]
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "preset": preset,
+            "prompts": prompts,
+            "params": params,
+            "output_dir": os.path.join(self.output_dir, f"job_{job_id}"),
+            "progress": {"generated": 0, "saved": 0, "total": len(prompts) * len(params["seeds"]) * len(modes)},
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "error": None,
+            "images": [],
+            "cancel": False
+        }
+        with self._lock:
+            self.jobs[job_id] = job
+        self.queue.put(job_id)
+        return self.public(job)
+
+    def public(self, job: Dict) -> Dict:
+        """Состояние задачи для API"""
+        with self._lock:
+            state = {k: v for k, v in job.items() if k not in ("cancel", "images")}
+            state["progress"] = dict(job["progress"])
+        state["queue_position"] = list(self.queue.queue).index(job["job_id"]) + 1 \
+            if job["status"] == "queued" and job["job_id"] in self.queue.queue else None
+        return state
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def cancel(self, job_id: str) -> Dict:
+        """Отменяет задачу: из очереди - сразу, выполняющуюся - после текущего батча"""
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        with self._lock:
+            job["cancel"] = True
+            if job["status"] == "queued":
+                job["status"] = "cancelled"
+                job["finished_at"] = datetime.now().isoformat()
+        return self.public(job)
+
+    def result(self, job_id: str) -> Dict:
+        """Пути к сохраненным изображениям задачи"""
+        job = self.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        with self._lock:
+            images = list(job["images"])
+        return {"job_id": job_id, "status": job["status"], "output_dir": job["output_dir"], "images": images}
+
+    def _track(self, job: Dict, results: Iterator) -> Iterator:
+        """Прогресс задачи и отмена между батчами"""
+        for item in results:
+            if job["cancel"]:
+                print(f"⛔ Задача {job['job_id']} отменена")
+                # Закрытие потока снимает недоделанные сэмплы с непрерывного батча
+                results.close()
+                return
+            with self._lock:
+                job["progress"]["generated"] += 1
+            yield item
+
+    def _record_saved(self, job: Dict, image: Dict):
+        with self._lock:
+            job["progress"]["saved"] += 1
+            job["images"].append(image)
+
+    def _generate_continuous(self, job: Dict, modes: List[str], sap_generator: Optional[SAPFluxGenerator]) -> Iterator:
+        """
+        Сэмплы задачи идут в общий непрерывный батч и отдаются по готовности.
+
+        При отмене задачи (закрытии потока) недоделанные сэмплы снимаются
+        с батча на ближайшей границе шага.
+        """
+        params = job["params"]
+        prompts = job["prompts"]
+        samples = []
+        if "direct" in modes:
+            samples.extend((prompt, direct_sap_schedule(prompt), {"mode": "direct"}) for prompt in prompts)
+        if "sap" in modes:
+            with self._llm_lock:
+                decompositions = sap_generator.decompose(prompts)
+            for prompt, sap_prompt_data in zip(prompts, decompositions):
+                if sap_prompt_data is None:
+                    print(f"⚠️  Не удалось получить SAP декомпозицию: '{prompt}'")
+                    continue
+                samples.append((prompt, sap_prompt_data, {"mode": "sap", **build_sap_metadata(sap_prompt_data)}))
+
+        scheduler = self._scheduler(params)
+        cache_params = generation_params(params["height"], params["width"], params["num_inference_steps"],
+                                         params["guidance_scale"], self.device)
+        submitted = {}
+        for prompt, schedule, metadata in samples:
+            for seed in params["seeds"]:
+                key = make_cache_key(self.fingerprint, schedule, seed, cache_params) if self.cache else None
+                image = self.cache.get(key) if self.cache else None
+                if image is not None:
+                    yield prompt, seed, image, metadata
+                    continue
+                request = scheduler.submit(schedule, seed)
+                submitted[request.future] = (request, prompt, seed, schedule, metadata, key)
+
+        try:
+            for future in as_completed(submitted):
+                _, prompt, seed, schedule, metadata, key = submitted[future]
+                image = future.result()
+                if self.cache is not None:
+                    self.cache.put(key, image, metadata={
+                        "model": self.fingerprint, "sap_prompts": schedule, "seed": seed, "params": cache_params
+                    })
+                yield prompt, seed, image, metadata
+        finally:
+            for request, *_ in submitted.values():
+                if not request.future.done():
+                    scheduler.cancel(request)
+
+    def _execute(self, job: Dict):
+        params = job["params"]
+        prompts = job["prompts"]
+        batch_dir = job["output_dir"]
+        modes = ["direct", "sap"] if params["mode"] == "both" else [params["mode"]]
+        dirs = {"direct": os.path.join(batch_dir, "direct_flux"), "sap": os.path.join(batch_dir, "sap_flux")}
+        for mode in modes:
+            Path(dirs[mode]).mkdir(parents=True, exist_ok=True)
+
+        manifest = JobManifest(batch_dir, on_done=lambda image: self._record_saved(job, image))
+        base_params = {k: params[k] for k in ("height", "width", "num_inference_steps", "guidance_scale")}
+        phashes = {
+            "direct": params_hash({"mode": "direct", "flux_version": self.flux_version, **base_params}),
+            "sap": params_hash({"mode": "sap", "llm": params["llm"], "flux_version": self.flux_version, **base_params})
+        }
+
+        generation_kwargs = dict(
+            height=params["height"],
+            width=params["width"],
+            num_inference_steps=params["num_inference_steps"],
+            guidance_scale=params["guidance_scale"],
+            seeds=params["seeds"],
+            num_images_per_prompt=len(params["seeds"])
+        )
+        sap_metadata = {}
+        sap_generator = None
+        try:
+            if "sap" in modes:
+                sap_generator = SAPFluxGenerator(
+                    llm=params["llm"], device=self.device, pipeline=self.pipeline,
+                    flux_version=self.flux_version, cache=self.cache
+                )
+            if self.continuous_batching:
+                results = self._generate_continuous(job, modes, sap_generator)
+            elif "sap" in modes:
+                results = sap_generator.generate_with_direct(prompts=prompts, **generation_kwargs) \
+                    if params["mode"] == "both" else sap_generator.generate(prompts=prompts, **generation_kwargs)
+            else:
+                direct_generator = DirectFluxGenerator(
+                    device=self.device, pipeline=self.pipeline, flux_version=self.flux_version, cache=self.cache
+                )
+                results = direct_generator.generate(prompts=prompts, **generation_kwargs)
+
+            sap_metadata = save_stream(self._track(job, results), dirs, writer=self.writer,
+                                       manifest=manifest, phashes=phashes)
+        finally:
+            self.writer.flush()
+            manifest.close()
+
+        for mode in modes:
+            metadata = {"mode": f"{mode}_flux", "preset": job["preset"], "num_prompts": len(prompts), **params}
+            if mode == "sap":
+                metadata["sap_details"] = str(sap_metadata)
+            save_results_metadata(dirs[mode], metadata)
+
+    def _run(self):
+        """
+        Поток обработки очереди. Без непрерывного батчинга поток один (одна
+        задача за раз - одна модель на устройстве), с ним задачи готовятся
+        параллельно, а шаги дифузии объединяет планировщик.
+        """
+        while True:
+            job_id = self.queue.get()
+            if job_id is None:
+                return
+            job = self.get(job_id)
+            if job is None or job["status"] == "cancelled":
+                continue
+            with self._lock:
+                job["status"] = "running"
+                job["started_at"] = datetime.now().isoformat()
+            print(f"\n▶️  Задача {job_id}: {len(job['prompts'])} промтов, режим {job['params']['mode']}")
+            try:
+                self._execute(job)
+                status = "cancelled" if job["cancel"] else "done"
+            except Exception as e:
+                import traceback
+                traceback.print_exc()
+                job["error"] = str(e)
+                status = "failed"
+            with self._lock:
+                job["status"] = status
+                job["finished_at"] = datetime.now().isoformat()
+            print(f"⏹️  Задача {job_id}: {status} ({job['progress']['saved']}/{job['progress']['total']})")
+
+    def shutdown(self):
+        for _ in self._workers:
+            self.queue.put(None)
+        for worker in self._workers:
+            worker.join(timeout=5)
+        for scheduler in self.schedulers.values():
+            scheduler.close()
+        self.writer.close()
+
+
+class GenerationRequestHandler(BaseHTTPRequestHandler):
+    """Обработчик HTTP API (server.service - GenerationService)"""
+
+    def _send_json(self, status: int, payload: Any):
+        body = json.dumps(payload, ensure_ascii=False, default=str).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _route(self) -> List[str]:
+        return [part for part in self.path.split("?")[0].split("/") if part]
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self._route()
+        try:
+            if parts == ["health"]:
+                self._send_json(200, service.health())
+            elif parts == ["jobs"]:
+                with service._lock:
+                    jobs = list(service.jobs.values())
+                self._send_json(200, {"jobs": [service.public(job) for job in jobs]})
+            elif len(parts) == 2 and parts[0] == "jobs":
+                job = service.get(parts[1])
+                if job is None:
+                    raise KeyError(parts[1])
+                self._send_json(200, service.public(job))
+            elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "result":
+                self._send_json(200, service.result(parts[1]))
+            elif len(parts) >= 4 and parts[0] == "jobs" and parts[2] == "files":
+                self._send_file(service, parts[1], "/".join(parts[3:]))
+            else:
+                self._send_json(404, {"error": "not found"})
+        except KeyError as e:
+            self._send_json(404, {"error": f"Задача не найдена: {e}"})
+
+    def _send_file(self, service: GenerationService, job_id: str, relative: str):
+        job = service.get(job_id)
+        if job is None:
+            raise KeyError(job_id)
+        root = os.path.realpath(job["output_dir"])
+        path = os.path.realpath(os.path.join(root, relative))
+        if not path.startswith(root + os.sep) or not os.path.isfile(path):
+            self._send_json(404, {"error": "file not found"})
+            return
+        with open(path, "rb") as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self):
+        if self._route() != ["jobs"]:
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8") or "{}")
+            self._send_json(202, self.server.service.submit(request))
+        except (ValueError, TypeError) as e:
+            self._send_json(400, {"error": str(e)})
+
+    def do_DELETE(self):
+        parts = self._route()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            self._send_json(200, self.server.service.cancel(parts[1]))
+        except KeyError as e:
+            self._send_json(404, {"error": f"Задача не найдена: {e}"})
+
+    def log_message(self, format, *args):
+        # Опросы статуса не засоряют вывод сервера
+        if self.command != "GET":
+            super().log_message(format, *args)
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP сервер на Unix-сокете"""
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Сервер генерации FLUX + SAP с резидентными моделями")
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Адрес HTTP сервера')
+    parser.add_argument('--port', type=int, default=8765, help='Порт HTTP сервера')
+    parser.add_argument('--socket', type=str, default=None,
+                        help='Слушать Unix-сокет вместо TCP порта')
+    parser.add_argument('--device', type=str, choices=['cuda', 'cpu'], default='cuda',
+                        help='Устройство для генерации')
+    parser.add_argument('--flux-version', type=str, default='1-dev', help='Версия FLUX')
+    parser.add_argument('--output-dir', type=str, default=RESULTS_DIR,
+                        help='Директория результатов задач')
+    parser.add_argument('--preload-zephyr', action='store_true',
+                        help='Загрузить Zephyr при старте сервера')
+    batching = parser.add_argument_group("Непрерывный батчинг")
+    batching.add_argument('--continuous-batching', action='store_true',
+                          help='Добавлять сэмплы новых задач в работающий батч на границе шага')
+    batching.add_argument('--max-batch-size', type=int, default=4,
+                          help='Максимальный размер непрерывного батча')
+    batching.add_argument('--job-workers', type=int, default=4,
+                          help='Задач, готовящихся одновременно (LLM декомпозиция, кэш)')
+    add_image_writer_arguments(parser)
+    add_generation_cache_arguments(parser)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+
+    print("=" * 60)
+    print("🖥️  Сервер генерации FLUX + SAP")
+    print("=" * 60)
+    service = GenerationService(
+        device=args.device,
+        flux_version=args.flux_version,
+        output_dir=args.output_dir,
+        preload_zephyr=args.preload_zephyr,
+        writer=ImageWriter.from_args(args),
+        cache=GenerationCache.from_args(args),
+        continuous_batching=args.continuous_batching,
+        max_batch_size=args.max_batch_size,
+        job_workers=args.job_workers
+    )
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, GenerationRequestHandler)
+        address = f"unix:{args.socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), GenerationRequestHandler)
+        address = f"http://{args.host}:{args.port}"
+    server.service = service
+
+    print(f"✅ Сервер готов: {address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Остановка сервера...")
+    finally:
+        server.server_close()
+        service.shutdown()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
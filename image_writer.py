@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+"""
+Background image writer
+Фоновая запись изображений: кодирование PNG/WebP/JPEG в пуле потоков или
+процессов, чтобы сохранение не останавливало дифузию
+"""
+
+import os
+import threading
+from functools import partial
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+
+# Формат -> (расширение файла, имя формата для PIL)
+IMAGE_FORMATS = {
+    "png": (".png", "PNG"),
+    "webp": (".webp", "WEBP"),
+    "jpeg": (".jpg", "JPEG"),
+}
+
+
+def _encode_and_write(image, path: str, pil_format: str, save_kwargs: Dict) -> str:
+    """
+    Кодирует и записывает одно изображение (выполняется в пуле).
+
+    Запись идет во временный файл с последующим os.replace, поэтому на диске
+    никогда не остается наполовину записанного изображения.
+    """
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        image.save(f, format=pil_format, **save_kwargs)
+    os.replace(tmp_path, path)
+    return path
+
+
+def _fsync_paths(paths: List[str]):
+    """Сбрасывает на диск файлы и их директории одним пакетом"""
+    directories = set()
+    for path in paths:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path) or ".")
+        except OSError as e:
+            print(f"⚠️  fsync не удался для {path}: {e}")
+
+    for directory in directories:
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            # Например, Windows не позволяет открыть директорию
+            continue
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+
+class ImageWriter:
+    """Пул фоновой записи изображений с ограниченной очередью"""
+
+    def __init__(
+        self,
+        image_format: str = "png",
+        png_compress_level: int = 6,
+        jpeg_quality: int = 95,
+        max_workers: int = 4,
+        max_pending: int = 16,
+        use_processes: bool = False,
+        fsync_every: int = 0
+    ):
+        """
+        Инициализация пула записи
+
+        Args:
+            image_format: png, webp (lossless) или jpeg
+            png_compress_level: уровень сжатия PNG (0-9, 0 - быстрее всего)
+            jpeg_quality: качество JPEG (1-100)
+            max_workers: количество потоков/процессов кодирования
+            max_pending: максимум изображений в очереди; submit блокируется,
+                         пока очередь заполнена
+            use_processes: кодировать в пуле процессов вместо потоков
+            fsync_every: сбрасывать файлы на диск пакетами по N штук
+                         (0 - не вызывать fsync)
+        """
+        if image_format not in IMAGE_FORMATS:
+            raise ValueError(f"Неизвестный формат изображений: {image_format}. Доступные: {list(IMAGE_FORMATS)}")
+
+        self.image_format = image_format
+        self.extension, self.pil_format = IMAGE_FORMATS[image_format]
+        if image_format == "png":
+            self.save_kwargs = {"compress_level": png_compress_level}
+        elif image_format == "webp":
+            self.save_kwargs = {"lossless": True, "quality": 80, "method": 4}
+        else:
+            self.save_kwargs = {"quality": jpeg_quality}
+
+        executor_cls = ProcessPoolExecutor if use_processes else ThreadPoolExecutor
+        self.executor = executor_cls(max_workers=max_workers)
+        self.fsync_every = fsync_every
+
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Condition()
+        self._unsynced: List[str] = []
+        self._outstanding = 0
+        self.written = 0
+        self.failed = 0
+
+    @classmethod
+    def from_args(cls, args) -> "ImageWriter":
+        """Создает пул записи из аргументов add_image_writer_arguments"""
+        return cls(
+            image_format=args.image_format,
+            png_compress_level=args.png_compress_level,
+            jpeg_quality=args.jpeg_quality,
+            max_workers=args.writer_workers,
+            use_processes=args.writer_processes,
+            fsync_every=args.fsync_every
+        )
+
+    def output_path(self, path: str) -> str:
+        """Итоговый путь файла с расширением выбранного формата"""
+        return os.path.splitext(str(path))[0] + self.extension
+
+    def submit(self, image, path: str, on_written: Optional[Callable[[str], None]] = None) -> Future:
+        """
+        Ставит изображение в очередь на запись.
+
+        Args:
+            image: PIL изображение
+            path: путь к файлу; расширение заменяется на расширение формата
+            on_written: вызывается с итоговым путем после успешной записи
+                        (до того, как flush/close сочтут запись завершенной)
+
+        Returns:
+            Future, результат которого - итоговый путь файла
+        """
+        path = self.output_path(path)
+        self._slots.acquire()
+        with self._lock:
+            self._outstanding += 1
+        try:
+            future = self.executor.submit(
+                _encode_and_write, image, path, self.pil_format, self.save_kwargs
+            )
+        except BaseException:
+            with self._lock:
+                self._outstanding -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(partial(self._on_done, on_written=on_written))
+        return future
+
+    def _on_done(self, future: Future, on_written: Optional[Callable[[str], None]] = None):
+        """Учет завершенной записи и пакетный fsync"""
+        self._slots.release()
+        to_sync = None
+        with self._lock:
+            if future.exception() is not None:
+                self.failed += 1
+                print(f"  ❌ Ошибка при сохранении изображения: {future.exception()}")
+            else:
+                self.written += 1
+                if self.fsync_every > 0:
+                    self._unsynced.append(future.result())
+                    if len(self._unsynced) >= self.fsync_every:
+                        to_sync, self._unsynced = self._unsynced, []
+        if to_sync:
+            _fsync_paths(to_sync)
+        if on_written is not None and future.exception() is None:
+            try:
+                on_written(future.result())
+            except Exception as e:
+                print(f"  ⚠️  Ошибка в обработчике записи: {e}")
+        with self._lock:
+            self._outstanding -= 1
+            self._lock.notify_all()
+
+    def flush(self):
+        """Ждет завершения всех записей и сбрасывает оставшиеся файлы на диск"""
+        with self._lock:
+            self._lock.wait_for(lambda: self._outstanding == 0)
+            to_sync, self._unsynced = self._unsynced, []
+        if to_sync:
+            _fsync_paths(to_sync)
+
+    def close(self):
+        """Дожидается очереди и останавливает пул"""
+        self.flush()
+        self.executor.shutdown(wait=True)
+        print(f"💾 Записано изображений: {self.written}" + (f", ошибок: {self.failed}" if self.failed else ""))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def add_image_writer_arguments(parser):
+    """Добавляет в argparse параметры фоновой записи изображений"""
+    group = parser.add_argument_group("Сохранение изображений")
+    group.add_argument(
+        '--image-format',
+        type=str,
+        choices=list(IMAGE_FORMATS),
+        default='png',
+        help='Формат файлов: png, webp (lossless) или jpeg'
+    )
+    group.add_argument(
+        '--png-compress-level',
+        type=int,
+        default=6,
+        help='Уровень сжатия PNG (0-9, 0 - самый быстрый)'
+    )
+    group.add_argument(
+        '--jpeg-quality',
+        type=int,
+        default=95,
+        help='Качество JPEG (1-100)'
+    )
+    group.add_argument(
+        '--writer-workers',
+        type=int,
+        default=4,
+        help='Количество потоков (или процессов) кодирования изображений'
+    )
+    group.add_argument(
+        '--writer-processes',
+        action='store_true',
+        help='Кодировать изображения в пуле процессов вместо потоков'
+    )
+    group.add_argument(
+        '--fsync-every',
+        type=int,
+        default=0,
+        help='Сбрасывать файлы на диск (fsync) пакетами по N штук (0 - отключено)'
+    )
+    return parser
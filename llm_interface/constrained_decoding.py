@@ -0,0 +1,229 @@
+"""
+Constrained decoding
+Ограниченное грамматикой декодирование для локальных LLM: модель может
+выбирать только токены, сохраняющие формат ответа
+
+    a. Explanation: <текст>
+    b. Final dictionary:
+    {"prompts_list": ["...", ...], "switch_prompts_steps": [n, ...]}
+
+где prompts_list непустой, а в switch_prompts_steps ровно на одно число
+меньше. Когда словарь закрыт, разрешен только конец последовательности.
+"""
+
+import os
+import weakref
+from typing import Dict, List, Optional, Tuple
+
+ZEPHYR_CONSTRAINED = os.getenv("SAP_ZEPHYR_CONSTRAINED", "1") == "1"
+
+WHITESPACE = " \t\n\r"
+HEADER = "a. Explanation:"
+MARKER = "b. Final dictionary:"
+# Заменитель символов, которые токен кодирует байтами (часть многобайтного UTF-8)
+OTHER_CHAR = "�"
+
+State = Tuple
+
+
+class DecompositionGrammar:
+    """
+    Символьный автомат формата декомпозиции. Состояние - кортеж, feed
+    возвращает новое состояние или None, если текст выходит из формата.
+    """
+
+    def __init__(self, max_explanation_chars: int = 600, max_prompt_chars: int = 200, max_step_digits: int = 3):
+        """
+        Args:
+            max_explanation_chars: после стольких символов объяснения формат требует перейти к словарю
+            max_prompt_chars: максимальная длина одного промта в prompts_list
+            max_step_digits: максимальное число цифр шага в switch_prompts_steps
+        """
+        self.max_explanation_chars = max_explanation_chars
+        self.max_prompt_chars = max_prompt_chars
+        self.max_step_digits = max_step_digits
+
+    def initial(self) -> State:
+        return ("wslit", HEADER, ("expl", 0, ""))
+
+    @staticmethod
+    def is_complete(state: Optional[State]) -> bool:
+        return state is not None and state[0] == "done"
+
+    def feed(self, state: Optional[State], text: str) -> Optional[State]:
+        for char in text:
+            if state is None:
+                return None
+            state = self._step(state, char)
+        return state
+
+    def _dict_states(self) -> State:
+        return ("wslit", "{", ("wslit", '"prompts_list"', ("wslit", ":", ("wslit", "[", ("item", 0)))))
+
+    def _switch_states(self, count: int) -> State:
+        return ("wslit", ",", ("wslit", '"switch_prompts_steps"', ("wslit", ":", ("wslit", "[", ("ints", count - 1, 0)))))
+
+    def _step(self, state: State, char: str) -> Optional[State]:
+        kind = state[0]
+
+        if kind == "wslit":
+            _, literal, then = state
+            if char in WHITESPACE:
+                return state
+            return self._step(("lit", literal, 0, then), char)
+
+        if kind == "lit":
+            _, literal, i, then = state
+            if char != literal[i]:
+                return None
+            return then if i + 1 == len(literal) else ("lit", literal, i + 1, then)
+
+        if kind == "expl":
+            _, length, tail = state
+            if char in "{}#":
+                return None
+            tail = (tail + char)[-len(MARKER):]
+            if tail == MARKER:
+                return self._dict_states()
+            if length + 1 >= self.max_explanation_chars:
+                # Объяснение слишком длинное: дальше только переход к словарю
+                return ("lit", "\n" + MARKER, 0, self._dict_states())
+            return ("expl", length + 1, tail)
+
+        if kind == "item":
+            # Ожидается строка списка (после запятой допускается закрытие списка)
+            _, count = state
+            if char in WHITESPACE:
+                return state
+            if char == '"':
+                return ("str", count, 0)
+            if char == "]" and count > 0:
+                return self._switch_states(count)
+            return None
+
+        if kind == "str":
+            _, count, length = state
+            if char == '"':
+                return ("sep", count + 1) if length > 0 else None
+            if char in "\\\n" or length >= self.max_prompt_chars:
+                return None
+            return ("str", count, length + 1)
+
+        if kind == "sep":
+            _, count = state
+            if char in WHITESPACE:
+                return state
+            if char == ",":
+                return ("item", count)
+            if char == "]":
+                return self._switch_states(count)
+            return None
+
+        if kind == "ints":
+            # Ожидается шаг переключения или закрытие списка, когда шагов достаточно
+            _, need, count = state
+            if char in WHITESPACE:
+                return state
+            if char.isdigit() and char.isascii() and count < need:
+                return ("int", need, count, 1)
+            if char == "]" and count == need:
+                return ("wslit", "}", ("done",))
+            return None
+
+        if kind == "int":
+            _, need, count, digits = state
+            if char.isdigit() and char.isascii():
+                return ("int", need, count, digits + 1) if digits < self.max_step_digits else None
+            return self._step(("int_sep", need, count + 1), char)
+
+        if kind == "int_sep":
+            _, need, count = state
+            if char in WHITESPACE:
+                return state
+            if char == "," and count < need:
+                return ("ints", need, count)
+            if char == "]" and count == need:
+                return ("wslit", "}", ("done",))
+            return None
+
+        return None
+
+
+_token_texts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def token_texts(tokenizer) -> List[str]:
+    """Текст каждого токена словаря (sentencepiece: ▁ - пробел, <0xNN> - байт)"""
+    cached = _token_texts.get(tokenizer)
+    if cached is not None:
+        return cached
+    texts = []
+    for token in tokenizer.convert_ids_to_tokens(list(range(len(tokenizer)))):
+        token = token or ""
+        if token.startswith("<0x") and token.endswith(">") and len(token) == 6:
+            value = int(token[3:5], 16)
+            texts.append(chr(value) if value < 128 else OTHER_CHAR)
+        else:
+            texts.append(token.replace("▁", " "))
+    special = set(tokenizer.all_special_ids)
+    texts = ["" if i in special else text for i, text in enumerate(texts)]
+    _token_texts[tokenizer] = texts
+    return texts
+
+
+def decomposition_logits_processor(tokenizer, batch_size: int, grammar: Optional[DecompositionGrammar] = None,
+                                   top_k: int = 32):
+    """LogitsProcessor generate, оставляющий только токены, допустимые грамматикой"""
+    import torch
+    from transformers import LogitsProcessor
+
+    grammar = grammar or DecompositionGrammar()
+    texts = token_texts(tokenizer)
+    eos_id = tokenizer.eos_token_id
+
+    class GrammarLogitsProcessor(LogitsProcessor):
+        def __init__(self):
+            self.states: List[Optional[State]] = [grammar.initial()] * batch_size
+            self.finished = [False] * batch_size
+            self.prompt_length: Optional[int] = None
+            self.forced: Dict[State, List[int]] = {}
+
+        def _allowed_from_vocab(self, state: State) -> List[int]:
+            """Допустимые токены по всему словарю (когда ни один из top_k не подходит)"""
+            if state not in self.forced:
+                self.forced[state] = [i for i, text in enumerate(texts) if text and grammar.feed(state, text) is not None]
+            return self.forced[state]
+
+        def __call__(self, input_ids, scores):
+            if self.prompt_length is None:
+                self.prompt_length = input_ids.shape[1]
+            elif input_ids.shape[1] > self.prompt_length:
+                for row, token in enumerate(input_ids[:, -1].tolist()):
+                    if self.finished[row]:
+                        continue
+                    if token == eos_id:
+                        self.finished[row] = True
+                    else:
+                        self.states[row] = grammar.feed(self.states[row], texts[token])
+
+            output = torch.full_like(scores, float("-inf"))
+            for row in range(scores.shape[0]):
+                state = self.states[row]
+                if self.finished[row] or state is None:
+                    # Завершенные последовательности (паддинг) не ограничиваются
+                    output[row] = scores[row]
+                    continue
+                if grammar.is_complete(state):
+                    allowed = [eos_id]
+                else:
+                    candidates = torch.topk(scores[row], min(top_k, scores.shape[1])).indices.tolist()
+                    allowed = [t for t in candidates if texts[t] and grammar.feed(state, texts[t]) is not None]
+                    if not allowed:
+                        allowed = self._allowed_from_vocab(state)
+                index = torch.tensor(allowed, device=scores.device)
+                values = scores[row, index]
+                # Если предыдущие фильтры (top_p) отсекли все допустимые токены, выбор идет среди допустимых равновероятно
+                output[row, index] = values if torch.isfinite(values).any() else torch.zeros_like(values)
+            return output
+
+    return GrammarLogitsProcessor()
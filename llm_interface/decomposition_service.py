@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+"""
+Decomposition service
+Локальный демон декомпозиции: держит Zephyr загруженным один раз и
+обслуживает LLM_SAP-совместимые запросы многих процессов по Unix-сокету
+или localhost HTTP. Промты одновременных клиентов собираются в общие
+батчи генерации. LLM_SAP(llm='Zephyr') сам использует демон, если он
+запущен (SAP_DECOMPOSITION_SERVER задает адрес, off - не использовать).
+
+    python llm_interface/decomposition_service.py                 # Unix-сокет по умолчанию
+    python llm_interface/decomposition_service.py --port 8766     # localhost HTTP
+    SAP_DECOMPOSITION_SERVER=http://127.0.0.1:8766 python generate_sap_prompts.py ...
+"""
+
+import os
+import sys
+import json
+import argparse
+import socketserver
+import http.client
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+# Корень репозитория в пути (запуск как скрипт из любой директории)
+parent_dir = Path(__file__).parent.parent
+if str(parent_dir) not in sys.path:
+    sys.path.insert(0, str(parent_dir))
+
+from generation_client import UnixHTTPConnection
+
+DEFAULT_DECOMPOSITION_SOCKET = os.path.join(os.path.expanduser("~"), ".cache", "sap_generation", "decomposition.sock")
+SUPPORTED_LLMS = ("Zephyr",)
+
+
+class DecompositionClient:
+    """Клиент демона декомпозиции (без torch и моделей)"""
+
+    def __init__(self, address: str, timeout: float = 600.0):
+        """
+        Args:
+            address: unix:/путь/к/сокету или http://host:port
+            timeout: таймаут запроса в секундах (генерация может быть долгой)
+        """
+        self.address = address
+        self.timeout = timeout
+        if address.startswith("unix:"):
+            self.socket_path, self.url = address[len("unix:"):], None
+        else:
+            self.socket_path, self.url = None, urlparse(address)
+
+    @classmethod
+    def from_env(cls) -> Optional["DecompositionClient"]:
+        """Клиент по SAP_DECOMPOSITION_SERVER или сокету по умолчанию (None - демон не настроен)"""
+        address = os.getenv("SAP_DECOMPOSITION_SERVER", "")
+        if address.lower() == "off":
+            return None
+        if not address:
+            if not os.path.exists(DEFAULT_DECOMPOSITION_SOCKET):
+                return None
+            address = f"unix:{DEFAULT_DECOMPOSITION_SOCKET}"
+        return cls(address)
+
+    def _request(self, method: str, path: str, payload: Optional[Dict] = None, timeout: Optional[float] = None) -> Dict:
+        timeout = timeout or self.timeout
+        if self.socket_path:
+            connection = UnixHTTPConnection(self.socket_path, timeout=timeout)
+        else:
+            connection = http.client.HTTPConnection(self.url.hostname, self.url.port or 80, timeout=timeout)
+        try:
+            body = json.dumps(payload).encode("utf-8") if payload is not None else None
+            headers = {"Content-Type": "application/json"} if body is not None else {}
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            data = json.loads(response.read().decode("utf-8") or "{}")
+        finally:
+            connection.close()
+        if response.status >= 400:
+            raise RuntimeError(f"Демон декомпозиции вернул {response.status}: {data.get('error', data)}")
+        return data
+
+    def health(self) -> Dict:
+        return self._request("GET", "/health", timeout=2.0)
+
+    def is_available(self, llm: str = "Zephyr") -> bool:
+        """Демон запущен и обслуживает llm"""
+        try:
+            return llm in self.health().get("llms", [])
+        except (OSError, RuntimeError, ValueError):
+            return False
+
+    def decompose(self, prompts: List[str], llm: str = "Zephyr") -> List[Dict]:
+        """Декомпозиции в формате LLM_SAP (в порядке промтов)"""
+        return self._request("POST", "/decompose", {"prompts": list(prompts), "llm": llm})["results"]
+
+
+class DecompositionService:
+    """Резидентный Zephyr и сборщик запросов клиентов в батчи генерации"""
+
+    def __init__(self, max_batch_size: int = 8, max_wait: float = 0.05):
+        """
+        Args:
+            max_batch_size: промтов в одном батче генерации
+            max_wait: сколько секунд первый промт ждет попутчиков от других клиентов
+        """
+        from llm_interface.model_registry import get_registry
+        from request_batcher import RequestBatcher
+
+        self.registry = get_registry()
+        self.registry.get("Zephyr")
+        self.batcher = RequestBatcher(self._run_batch, max_batch_size=max_batch_size, max_wait=max_wait,
+                                      name="decomposition-batcher")
+        self.stats = {"requests": 0, "prompts": 0}
+
+    def _run_batch(self, prompts: List[str]) -> List[Dict]:
+        from llm_interface.llm_SAP import LLM_SAP_batch_Zephyr
+        with self.registry.use("Zephyr") as pipe:
+            return LLM_SAP_batch_Zephyr(prompts, pipe)
+
+    def decompose(self, prompts: List[str]) -> List[Dict]:
+        self.stats["requests"] += 1
+        self.stats["prompts"] += len(prompts)
+        futures = [self.batcher.submit(prompt) for prompt in prompts]
+        return [future.result() for future in futures]
+
+    def health(self) -> Dict:
+        return {
+            "status": "ok",
+            "llms": list(SUPPORTED_LLMS),
+            "models": self.registry.status()["loaded"],
+            "stats": {**self.stats, "batches": self.batcher.stats["batches"]}
+        }
+
+    def close(self):
+        self.batcher.close()
+
+
+class DecompositionRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SAPDecomposition/1.0"
+
+    def _send_json(self, status: int, payload: Dict):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/health":
+            self._send_json(200, self.server.service.health())
+        else:
+            self._send_json(404, {"error": f"Неизвестный путь {self.path}"})
+
+    def do_POST(self):
+        if self.path.rstrip("/") != "/decompose":
+            self._send_json(404, {"error": f"Неизвестный путь {self.path}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_json(400, {"error": "Тело запроса должно быть JSON"})
+            return
+        prompts = request.get("prompts")
+        llm = request.get("llm", "Zephyr")
+        if not isinstance(prompts, list) or not all(isinstance(p, str) for p in prompts):
+            self._send_json(400, {"error": "prompts должен быть списком строк"})
+            return
+        if llm not in SUPPORTED_LLMS:
+            self._send_json(400, {"error": f"Демон обслуживает только {', '.join(SUPPORTED_LLMS)}"})
+            return
+        try:
+            self._send_json(200, {"results": self.server.service.decompose(prompts)})
+        except Exception as e:
+            self._send_json(500, {"error": str(e)})
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """HTTP сервер на Unix-сокете"""
+    daemon_threads = True
+
+    def get_request(self):
+        request, _ = super().get_request()
+        return request, ("unix", 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Демон SAP декомпозиции с резидентным Zephyr")
+    parser.add_argument('--socket', type=str, default=DEFAULT_DECOMPOSITION_SOCKET,
+                        help='Unix-сокет (используется, если не задан --port)')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Адрес HTTP сервера')
+    parser.add_argument('--port', type=int, default=None, help='Слушать localhost HTTP вместо Unix-сокета')
+    parser.add_argument('--max-batch-size', type=int, default=8, help='Промтов в одном батче генерации')
+    parser.add_argument('--max-wait', type=float, default=0.05,
+                        help='Сколько секунд ждать промты других клиентов для общего батча')
+    args = parser.parse_args()
+
+    # Сам демон генерирует локально и не обращается к себе
+    os.environ["SAP_DECOMPOSITION_SERVER"] = "off"
+    service = DecompositionService(max_batch_size=args.max_batch_size, max_wait=args.max_wait)
+
+    if args.port is None:
+        Path(os.path.dirname(args.socket)).mkdir(parents=True, exist_ok=True)
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server = UnixHTTPServer(args.socket, DecompositionRequestHandler)
+        address = f"unix:{args.socket}"
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), DecompositionRequestHandler)
+        address = f"http://{args.host}:{args.port}"
+    server.service = service
+
+    print(f"🧠 Демон декомпозиции слушает {address}")
+    if args.port is not None:
+        print(f"   Клиенты: SAP_DECOMPOSITION_SERVER={address}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n🛑 Остановка демона...")
+    finally:
+        server.server_close()
+        service.close()
+        if args.port is None and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
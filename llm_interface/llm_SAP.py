@@ -1,7 +1,11 @@
-import requests
 import json
 import re
+import os
 import ast
+import math
+import queue
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import sys
 
@@ -10,22 +14,241 @@ parent_dir = Path(__file__).parent.parent
 if str(parent_dir) not in sys.path:
     sys.path.insert(0, str(parent_dir))
 
+from llm_interface.sap_cache import DecompositionCache, decomposition_key, template_hash
+from llm_interface.openai_client import DEFAULT_OPENAI_BASE_URL, OpenAIRequestError, get_client
+from llm_interface.prefix_cache import get_prefix_cache
+from llm_interface.zephyr_batch import decomposition_complete, generate_batched
+from llm_interface.model_registry import get_registry
+from llm_interface.decomposition_service import DecompositionClient
 
-def LLM_SAP(prompts_list, llm='GPT', key='', llm_model=None):
+GPT_MODEL = "gpt-4o"
+ZEPHYR_MODEL_ID = "HuggingFaceH4/zephyr-7b-beta"
+ZEPHYR_GENERATION_KWARGS = {"max_new_tokens": 512, "temperature": 0.5, "do_sample": True, "top_p": 0.95}
+
+TEMPLATE_DIR = 'llm_interface/template'
+LLM_TEMPLATES = {
+    'GPT': [f'{TEMPLATE_DIR}/template_SAP_system.txt', f'{TEMPLATE_DIR}/template_SAP_user.txt'],
+    'Zephyr': [f'{TEMPLATE_DIR}/template_SAP_system_short.txt', f'{TEMPLATE_DIR}/template_SAP_user.txt'],
+}
+
+# Декомпозиция через GPT: промты делятся на чанки по бюджету токенов и
+# отправляются параллельно через общий клиент (base URL, таймауты и повторы -
+# в llm_interface/openai_client.py); настройки можно переопределить переменными окружения
+GPT_MAX_CONCURRENCY = int(os.getenv("SAP_GPT_CONCURRENCY", "4"))
+GPT_CHUNK_TOKEN_BUDGET = int(os.getenv("SAP_GPT_CHUNK_TOKENS", "4000"))
+GPT_MAX_PROMPTS_PER_CHUNK = 20
+# Общий срок чанка в секундах: все повторы (429/5xx) и паузы между ними
+GPT_CHUNK_DEADLINE = float(os.getenv("SAP_GPT_CHUNK_DEADLINE", "600"))
+GPT_OUTPUT_TOKENS_PER_PROMPT = 250  # объяснение + словарь одной декомпозиции
+
+# Сколько раз повторно запрашивать декомпозиции, которые не удалось распарсить
+REPAIR_ATTEMPTS = int(os.getenv("SAP_REPAIR_ATTEMPTS", "2"))
+
+# Ответы нестандартного OpenAI endpoint (mock сервер, прокси) сохраняются в общий кэш только по явному согласию
+CACHE_CUSTOM_ENDPOINT = os.getenv("SAP_DECOMPOSITION_CACHE_CUSTOM_ENDPOINT", "0") == "1"
+
+_default_cache = None
+
+
+def get_decomposition_cache():
+    """Общий кэш декомпозиций процесса (настраивается переменными SAP_DECOMPOSITION_CACHE*)"""
+    global _default_cache
+    if _default_cache is None:
+        try:
+            _default_cache = DecompositionCache.from_env() or False
+        except (OSError, sqlite3.Error) as e:
+            print(f"⚠️  Кэш декомпозиций недоступен ({e}), LLM будет вызываться для всех промтов")
+            _default_cache = False
+    return _default_cache or None
+
+
+def _resolve_cache(cache, llm):
+    """cache=True - общий кэш процесса, кроме GPT через нестандартный endpoint без согласия"""
+    if cache is not True:
+        return cache
+    if llm == 'GPT' and get_client().base_url != DEFAULT_OPENAI_BASE_URL and not CACHE_CUSTOM_ENDPOINT:
+        print(f"🗃️  Кэш декомпозиций не используется для {get_client().base_url} "
+              f"(SAP_DECOMPOSITION_CACHE_CUSTOM_ENDPOINT=1 - использовать)")
+        return None
+    return get_decomposition_cache()
+
+
+def llm_cache_identity(llm):
+    """(бэкенд/модель, хэш шаблонов, параметры сэмплирования) - часть ключа кэша"""
+    if llm == 'Zephyr':
+        return f"Zephyr:{ZEPHYR_MODEL_ID}", template_hash(LLM_TEMPLATES[llm]), dict(ZEPHYR_GENERATION_KWARGS)
+    # Разные endpoint (OpenAI, прокси, mock сервер) не делят записи кэша
+    return f"GPT:{GPT_MODEL}@{get_client().base_url}", template_hash(LLM_TEMPLATES[llm]), {}
+
+
+def LLM_SAP(prompts_list, llm='GPT', key='', llm_model=None, cache=True):
+    """
+    SAP декомпозиции промтов.
+
+    Декомпозиции берутся из постоянного кэша, LLM вызывается только для
+    промахов (повторы в списке отправляются один раз). Резервные
+    декомпозиции (fallback) в кэш не попадают.
+
+    cache: True - общий кэш процесса (ответы GPT через нестандартный endpoint -
+    только при SAP_DECOMPOSITION_CACHE_CUSTOM_ENDPOINT=1), False/None - без
+    кэша, либо DecompositionCache
+    """
+    if isinstance(prompts_list, str):
+        prompts_list = [prompts_list]
+    if llm not in LLM_TEMPLATES:
+        raise ValueError(f"Unsupported llm: {llm} (supported: GPT, Zephyr)")
+    cache = _resolve_cache(cache, llm)
+
+    if not cache:
+        return _run_llm(prompts_list, llm, key, llm_model)
+
+    backend, templates, params = llm_cache_identity(llm)
+    keys = [decomposition_key(p, backend, templates, params) for p in prompts_list]
+    found = cache.get_many(keys)
+
+    # Промахи без повторов, в исходном порядке
+    missing = {}
+    for prompt, k in zip(prompts_list, keys):
+        if k not in found and k not in missing:
+            missing[k] = prompt
+    if found:
+        print(f"🗃️  Декомпозиции из кэша: {len(prompts_list) - sum(k not in found for k in keys)}/{len(prompts_list)}")
+
+    if missing:
+        outputs = _run_llm(list(missing.values()), llm, key, llm_model)
+        entries = []
+        for (k, prompt), result in zip(missing.items(), outputs):
+            found[k] = result
+            if result is not None and result.get("source") != "fallback":
+                entries.append({"key": k, "prompt": prompt, "backend": backend, "template_hash": templates,
+                                "params": params, "value": result})
+        cache.put_many(entries)
+
+    # Только что полученные декомпозиции не помечаются как взятые из кэша
+    return [_copy(found.get(k)) if k in missing else _from_cache(found[k]) for k in keys]
+
+
+def LLM_SAP_stream(prompts_list, llm='GPT', key='', llm_model=None, cache=True):
+    """
+    Потоковый вариант LLM_SAP: пары (индекс промта, декомпозиция) по мере
+    готовности. Попадания в кэш отдаются сразу, ответ GPT разбирается по мере
+    поступления, другие LLM отдают результаты после своего батча.
+    """
     if isinstance(prompts_list, str):
         prompts_list = [prompts_list]
+    if llm not in LLM_TEMPLATES:
+        raise ValueError(f"Unsupported llm: {llm} (supported: GPT, Zephyr)")
+    cache = _resolve_cache(cache, llm)
+
+    backend, templates, params = llm_cache_identity(llm)
+    keys = [decomposition_key(p, backend, templates, params) for p in prompts_list]
+    found = cache.get_many(keys) if cache else {}
+    positions = {}
+    for i, k in enumerate(keys):
+        positions.setdefault(k, []).append(i)
+
+    for k, indices in positions.items():
+        if k in found:
+            for i in indices:
+                yield i, _from_cache(found[k])
+
+    missing = [k for k in positions if k not in found]
+    if not missing:
+        return
+    prompts = [prompts_list[positions[k][0]] for k in missing]
+    if llm == 'GPT':
+        results = _repaired_stream(LLM_SAP_stream_gpt(prompts, key), prompts, llm, key, llm_model)
+    else:
+        results = enumerate(_run_llm(prompts, llm, key, llm_model))
+    for j, result in results:
+        k = missing[j]
+        if cache and result is not None and result.get("source") != "fallback":
+            cache.put_many([{"key": k, "prompt": prompts[j], "backend": backend, "template_hash": templates,
+                             "params": params, "value": result}])
+        for i in positions[k]:
+            yield i, _copy(result)
+
+
+def _copy(result):
+    return dict(result) if result is not None else None
+
+
+def _from_cache(result):
+    return {**result, "source": "cache"}
+
+
+def _run_llm(prompts_list, llm, key, llm_model):
+    return repair_decompositions(prompts_list, _request_llm(prompts_list, llm, key, llm_model), llm, key, llm_model)
+
+
+def _failed(result):
+    return result is None or result.get("source") == "fallback"
+
+
+def repair_decompositions(prompts_list, results, llm, key, llm_model=None, attempts=None):
+    """
+    Повторные запросы к LLM только для промтов с резервной декомпозицией:
+    неудачные промты отправляются отдельным небольшим батчем, не более
+    attempts раз. Каждая декомпозиция получает источник (source): llm - с
+    первого ответа, retry - после повтора (attempts - число запросов),
+    fallback - LLM так и не ответил в нужном формате.
+    """
+    attempts = REPAIR_ATTEMPTS if attempts is None else attempts
+    results = [r if r is None or "source" in r else {**r, "source": "llm"} for r in results]
+    failed = [i for i, r in enumerate(results) if _failed(r)]
+
+    for attempt in range(1, attempts + 1):
+        if not failed:
+            break
+        print(f"🔁 Повторный запрос {len(failed)} неудачных декомпозиций (попытка {attempt}/{attempts})")
+        retried = _request_llm([prompts_list[i] for i in failed], llm, key, llm_model)
+        still_failed = []
+        for i, result in zip(failed, retried):
+            if _failed(result):
+                still_failed.append(i)
+            else:
+                results[i] = {**result, "source": "retry", "attempts": attempt + 1}
+        failed = still_failed
+
+    if failed:
+        print(f"⚠️  Резервная декомпозиция осталась у {len(failed)}/{len(prompts_list)} промтов")
+    return results
+
+
+def _repaired_stream(results, prompts_list, llm, key, llm_model):
+    """Удачные декомпозиции потока отдаются сразу, неудачные - после повторных запросов"""
+    failed = []
+    for i, result in results:
+        if _failed(result):
+            failed.append((i, result))
+        else:
+            yield i, {**result, "source": result.get("source", "llm")}
+    if failed:
+        repaired = repair_decompositions([prompts_list[i] for i, _ in failed], [r for _, r in failed],
+                                         llm, key, llm_model)
+        yield from zip([i for i, _ in failed], repaired)
+
+
+def _request_llm(prompts_list, llm, key, llm_model):
     if llm == 'Zephyr':
-        result = LLM_SAP_batch_Zephyr(prompts_list, llm_model)
-    elif llm == 'GPT':
-        result = LLM_SAP_batch_gpt(prompts_list, key)
-    return result
+        # Запущенный демон декомпозиции избавляет процесс от загрузки своей копии модели
+        if llm_model is None:
+            client = DecompositionClient.from_env()
+            if client is not None and client.is_available('Zephyr'):
+                try:
+                    print(f"### run LLM_SAP_batch with zephyr-7b-beta via {client.address} ###")
+                    return client.decompose(prompts_list, 'Zephyr')
+                except (OSError, RuntimeError, ValueError) as e:
+                    print(f"⚠️  Демон декомпозиции недоступен ({e}), Zephyr загружается локально")
+        return LLM_SAP_batch_Zephyr(prompts_list, llm_model)
+    return LLM_SAP_batch_gpt(prompts_list, key)
 
 # Load the Zephyr model once and reuse it
 def load_Zephyr_pipeline():
     from transformers import AutoTokenizer, AutoModelForCausalLM, pipeline
     import torch
 
-    model_id = "HuggingFaceH4/zephyr-7b-beta"
+    model_id = ZEPHYR_MODEL_ID
 
     tokenizer = AutoTokenizer.from_pretrained(model_id)
     model = AutoModelForCausalLM.from_pretrained(
@@ -48,150 +271,335 @@ def load_Zephyr_pipeline():
     )
 
     return pipe
-    
 
-def LLM_SAP_batch_Zephyr(prompts_list, llm_model):
+
+get_registry().register('Zephyr', load_Zephyr_pipeline)
+
+
+def LLM_SAP_batch_Zephyr(prompts_list, llm_model, batch_size=None):
+    """
+    Декомпозиции через Zephyr.
+
+    batch_size: промтов на вызов generate (None - по свободной памяти,
+    SAP_ZEPHYR_BATCH_SIZE задает верхнюю границу; 1 - по одному промту)
+    """
     print("### run LLM_SAP_batch with zephyr-7b-beta###")
 
     # Load templates
-    with open('llm_interface/template/template_SAP_system_short.txt', 'r') as f:
+    system_path, user_path = LLM_TEMPLATES['Zephyr']
+    with open(system_path, 'r') as f:
         template_system = ' '.join(f.readlines())
 
-    with open('llm_interface/template/template_SAP_user.txt', 'r') as f:
+    with open(user_path, 'r') as f:
         template_user = ' '.join(f.readlines())
 
-    # Load Zephyr
+    # Zephyr из общего реестра процесса (загружается один раз, не выгружается во время генерации)
     if llm_model is None:
-        pipe = load_Zephyr_pipeline()
-    else: 
-        pipe = llm_model
+        with get_registry().use('Zephyr') as pipe:
+            return LLM_SAP_batch_Zephyr(prompts_list, pipe, batch_size)
+    pipe = llm_model
 
-    # Process each prompt separately for better reliability with Zephyr
-    all_outputs = []
-    
-    for i, prompt in enumerate(prompts_list):
-        print(f"\n🔄 Обработка промта {i+1}/{len(prompts_list)}: '{prompt[:50]}...'")
-        
-        # Create prompt for single input
-        numbered_prompt = f"### Input 1: {prompt}\n### Output:"
-        full_prompt = template_system + "\n\n" + template_user + "\n\n" + numbered_prompt
-        
+    # Шаблон одинаков для всех промтов: его KV кэш считается один раз на модель
+    template_prefix = template_system + "\n\n" + template_user
+    prefix_cache = None
+    if hasattr(pipe, "model") and hasattr(pipe, "tokenizer"):
         try:
-            # Run inference - increased max_new_tokens for more complete output
-            output = pipe(
-                full_prompt,
-                max_new_tokens=512,
-                temperature=0.5,  # Reduced temperature for more consistent output
-                do_sample=True,
-                top_p=0.95,
-                return_full_text=False
-            )[0]["generated_text"]
-            
-            print(f"  📝 LLM ответ: {output[:100]}...")
-            
-            # Parse single output
+            prefix_cache = get_prefix_cache(pipe, template_prefix)
+        except Exception as e:
+            print(f"⚠️  KV кэш шаблона недоступен ({e}), шаблон обрабатывается для каждого промта")
+
+    stats_before = dict(prefix_cache.stats) if prefix_cache is not None else None
+    numbered_prompts = [f"### Input 1: {prompt}\n### Output:" for prompt in prompts_list]
+
+    if batch_size != 1 and len(prompts_list) > 1 and hasattr(pipe, "model") and hasattr(pipe, "tokenizer"):
+        outputs = generate_batched(
+            pipe, [template_prefix + "\n\n" + p for p in numbered_prompts],
+            prefix_cache=prefix_cache, batch_size=batch_size, **ZEPHYR_GENERATION_KWARGS
+        )
+    else:
+        # Process each prompt separately for better reliability with Zephyr
+        outputs = []
+        for i, numbered_prompt in enumerate(numbered_prompts):
+            print(f"\n🔄 Обработка промта {i+1}/{len(prompts_list)}: '{prompts_list[i][:50]}...'")
             try:
-                result = get_params_dict_SAP(output)
-                if result is not None:
-                    all_outputs.append(result)
-                    print(f"  ✅ Успешно распарсено")
+                # Run inference - increased max_new_tokens for more complete output
+                # Reduced temperature for more consistent output (ZEPHYR_GENERATION_KWARGS)
+                if prefix_cache is not None:
+                    outputs.append(prefix_cache.generate("\n\n" + numbered_prompt, **ZEPHYR_GENERATION_KWARGS))
                 else:
-                    print(f"  ⚠️  Не удалось распарсить, используется fallback")
-                    all_outputs.append(create_fallback_decomposition(prompt))
-            except Exception as parse_error:
-                print(f"  ⚠️  Ошибка парсинга: {parse_error}")
-                print(f"     Используется резервная декомпозиция")
-                all_outputs.append(create_fallback_decomposition(prompt))
-                
-        except Exception as e:
-            print(f"  ❌ Ошибка при вызове LLM: {e}")
-            print(f"     Используется резервная декомпозиция")
-            all_outputs.append(create_fallback_decomposition(prompt))
-    
+                    outputs.append(pipe(
+                        template_prefix + "\n\n" + numbered_prompt,
+                        return_full_text=False,
+                        **ZEPHYR_GENERATION_KWARGS
+                    )[0]["generated_text"])
+            except Exception as e:
+                outputs.append(e)
+
+    all_outputs = [_parse_zephyr_output(i, prompt, output) for i, (prompt, output) in enumerate(zip(prompts_list, outputs))]
+
+    if prefix_cache is not None:
+        stats = {k: v - stats_before[k] for k, v in prefix_cache.stats.items()}
+        print(f"🧠 KV кэш шаблона: переиспользовано {stats['reused_tokens']} токенов, "
+              f"prefill {stats['prefill_tokens']} токенов на {stats['prompts']} промтов")
     return all_outputs
 
-def LLM_SAP_batch_gpt(prompts_list, key):
-    print("### run LLM_SAP_batch with gpt-4o ###")
 
-    url = "https://api.openai.com/v1/chat/completions"
-    api_key = key
+def _parse_zephyr_output(i, prompt, output):
+    """Декомпозиция из ответа Zephyr (ответ может быть исключением вызова)"""
+    if isinstance(output, Exception):
+        print(f"  ❌ Ошибка при вызове LLM для промта {i+1}: {output}")
+        print(f"     Используется резервная декомпозиция")
+        return create_fallback_decomposition(prompt)
+
+    print(f"  📝 LLM ответ {i+1}: {output[:100]}...")
+    try:
+        result = get_params_dict_SAP(output)
+        if result is not None:
+            print(f"  ✅ Успешно распарсено")
+            return result
+        print(f"  ⚠️  Не удалось распарсить, используется fallback")
+    except Exception as parse_error:
+        print(f"  ⚠️  Ошибка парсинга: {parse_error}")
+        print(f"     Используется резервная декомпозиция")
+    return create_fallback_decomposition(prompt)
+
+
+def estimate_tokens(text):
+    """Оценка числа токенов (tiktoken, если установлен, иначе ~4 символа на токен)"""
+    try:
+        import tiktoken
+        return len(tiktoken.get_encoding("o200k_base").encode(text))
+    except Exception:
+        return math.ceil(len(text) / 4)
+
+
+def chunk_prompts(prompts_list, token_budget=GPT_CHUNK_TOKEN_BUDGET, max_prompts=GPT_MAX_PROMPTS_PER_CHUNK):
+    """
+    Делит промты на чанки (списки индексов) по бюджету токенов.
+
+    Бюджет покрывает переменную часть запроса: пронумерованные входы и
+    ожидаемые ответы; шаблоны повторяются в каждом чанке и не учитываются.
+    """
+    chunks, current, used = [], [], 0
+    for i, prompt in enumerate(prompts_list):
+        cost = estimate_tokens(f"### Input {len(current) + 1}: {prompt}\n### Output:") + GPT_OUTPUT_TOKENS_PER_PROMPT
+        if current and (used + cost > token_budget or len(current) >= max_prompts):
+            chunks.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += cost
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def LLM_SAP_batch_gpt(prompts_list, key, base_url=None, max_concurrency=None, token_budget=None,
+                      timeout=None, max_retries=None, deadline=None):
+    """
+    Декомпозиции через GPT: чанки по бюджету токенов, параллельные запросы
+    (не больше max_concurrency), результаты в порядке входа. Если чанк не
+    удалось получить после всех повторов или за deadline секунд (по
+    умолчанию GPT_CHUNK_DEADLINE), его промты получают резервные
+    декомпозиции, остальные чанки не теряются.
+    """
+    if not prompts_list:
+        return []
 
-    with open('llm_interface/template/template_SAP_system.txt', 'r') as f:
+    system_path, user_path = LLM_TEMPLATES['GPT']
+    with open(system_path, 'r') as f:
         template_system=f.readlines()
         prompt_system=' '.join(template_system)
 
-    with open('llm_interface/template/template_SAP_user.txt', 'r') as f:
+    with open(user_path, 'r') as f:
         template_user=f.readlines()
         template_user=' '.join(template_user)
 
-    numbered_prompts = [f"### Input {i + 1}: {p}\n### Output:" for i, p in enumerate(prompts_list)]
-    prompt_user = template_user + "\n\n" + "\n\n".join(numbered_prompts)
-    payload = json.dumps({
-    "model": "gpt-4o", 
-    "messages": [
-        {
-            "role": "system",
-            "content": prompt_system
-        },
-        {
-            "role": "user",
-            "content": prompt_user
-        }
-    ]
-    })
-    headers = {
-        'Accept': 'application/json',
-        'Authorization': f'Bearer {api_key}',
-        'User-Agent': 'Apifox/1.0.0 (https://apifox.com)',
-        'Content-Type': 'application/json'
-    }
-
-    response = requests.request("POST", url, headers=headers, data=payload)
-    obj=response.json()
-    
-    text=obj['choices'][0]['message']['content']
-    print(f"text: {text}")
-    parsed_outputs = parse_batched_llm_output(text, prompts_list)
+    client = get_client(base_url)
+    chunks = chunk_prompts(prompts_list, token_budget or GPT_CHUNK_TOKEN_BUDGET)
+    max_concurrency = max_concurrency or GPT_MAX_CONCURRENCY
+    print(f"### run LLM_SAP_batch with {GPT_MODEL}: {len(prompts_list)} prompts, "
+          f"{len(chunks)} chunk(s), concurrency {min(max_concurrency, len(chunks))} ###")
+
+    def run_chunk(indices):
+        chunk = [prompts_list[i] for i in indices]
+        numbered_prompts = [f"### Input {i + 1}: {p}\n### Output:" for i, p in enumerate(chunk)]
+        prompt_user = template_user + "\n\n" + "\n\n".join(numbered_prompts)
+        messages = [
+            {"role": "system", "content": prompt_system},
+            {"role": "user", "content": prompt_user}
+        ]
+        try:
+            text = client.chat_completion(messages, GPT_MODEL, key=key, timeout=timeout, max_retries=max_retries,
+                                          deadline=deadline or GPT_CHUNK_DEADLINE)
+        except Exception as e:
+            # Неверный ключ или запрос не исправятся повтором - прерываем весь прогон
+            if isinstance(e, OpenAIRequestError) and not e.retryable:
+                raise
+            print(f"❌ Чанк промтов {indices[0] + 1}-{indices[-1] + 1}: {e}")
+            return [create_fallback_decomposition(p) for p in chunk]
+        return parse_batched_llm_output(text, chunk)
 
+    with ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks))) as pool:
+        chunk_results = list(pool.map(run_chunk, chunks))
+    print(f"📊 {client.base_url}: {client.metrics.format()}")
+
+    parsed_outputs = [None] * len(prompts_list)
+    for indices, results in zip(chunks, chunk_results):
+        for i, result in zip(indices, results):
+            parsed_outputs[i] = result
     return parsed_outputs
 
 
+def LLM_SAP_stream_gpt(prompts_list, key, base_url=None, max_concurrency=None, token_budget=None,
+                       timeout=None, max_retries=None, deadline=None):
+    """
+    Потоковые декомпозиции через GPT: те же чанки и параллельность, что в
+    LLM_SAP_batch_gpt, но ответы читаются потоком и каждая декомпозиция
+    отдается парой (индекс промта, декомпозиция), как только ее сегмент
+    "### Input N:" завершен (порядок - по готовности)
+    """
+    if not prompts_list:
+        return
+
+    system_path, user_path = LLM_TEMPLATES['GPT']
+    with open(system_path, 'r') as f:
+        prompt_system = ' '.join(f.readlines())
+
+    with open(user_path, 'r') as f:
+        template_user = ' '.join(f.readlines())
+
+    client = get_client(base_url)
+    chunks = chunk_prompts(prompts_list, token_budget or GPT_CHUNK_TOKEN_BUDGET)
+    max_concurrency = max_concurrency or GPT_MAX_CONCURRENCY
+    print(f"### stream LLM_SAP_batch with {GPT_MODEL}: {len(prompts_list)} prompts, "
+          f"{len(chunks)} chunk(s), concurrency {min(max_concurrency, len(chunks))} ###")
+    ready = queue.Queue()
+
+    def run_chunk(indices):
+        chunk = [prompts_list[i] for i in indices]
+        numbered_prompts = [f"### Input {i + 1}: {p}\n### Output:" for i, p in enumerate(chunk)]
+        messages = [
+            {"role": "system", "content": prompt_system},
+            {"role": "user", "content": template_user + "\n\n" + "\n\n".join(numbered_prompts)}
+        ]
+        parser = IncrementalOutputParser(chunk)
+        try:
+            for delta in client.stream_chat_completion(messages, GPT_MODEL, key=key, timeout=timeout,
+                                                       max_retries=max_retries,
+                                                       deadline=deadline or GPT_CHUNK_DEADLINE):
+                for j, result in parser.feed(delta):
+                    ready.put((indices[j], result))
+            results = parser.close()
+        except Exception as e:
+            if isinstance(e, OpenAIRequestError) and not e.retryable:
+                ready.put(e)
+                return
+            print(f"❌ Чанк промтов {indices[0] + 1}-{indices[-1] + 1}: {e}")
+            results = [(j, create_fallback_decomposition(chunk[j])) for j in range(len(chunk)) if j not in parser.emitted]
+        for j, result in results:
+            ready.put((indices[j], result))
+
+    pool = ThreadPoolExecutor(max_workers=min(max_concurrency, len(chunks)))
+    for indices in chunks:
+        pool.submit(run_chunk, indices)
+    try:
+        for _ in range(len(prompts_list)):
+            item = ready.get()
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
+    print(f"📊 {client.base_url}: {client.metrics.format()}")
+
+
+def split_numbered_outputs(llm_output_text, num_prompts):
+    """
+    Сегменты ответа по номерам "### Input N:" (порядок в ответе не важен).
+    Без нумерации весь ответ относится к первому промту.
+    """
+    parts = re.split(r"### Input (\d+):", llm_output_text)
+    if len(parts) == 1:
+        return [llm_output_text] + [""] * (num_prompts - 1)
+    segments = {}
+    for number, segment in zip(parts[1::2], parts[2::2]):
+        segments.setdefault(int(number), segment)
+    return [segments.get(i + 1, "") for i in range(num_prompts)]
+
+
 def parse_batched_llm_output(llm_output_text, original_prompts):
     """
     llm_output_text: raw string returned by the llm for multiple prompts
     original_prompts: list of the multiple original input strings
     """
-    outputs = re.split(r"### Input \d+: ", llm_output_text)
-    results = []
-
-    for i in range(len(original_prompts)):
-        # Check if we have enough outputs
-        if i >= len(outputs):
-            print(f"⚠️  Не удалось парсить промт {i+1}: недостаточно сегментов (ожидается {len(original_prompts)}, получено {len(outputs)})")
-            # Используем fallback для этого промта
-            results.append(create_fallback_decomposition(original_prompts[i]))
-            continue
-            
-        out = outputs[i]
-        cleaned = out.strip()
-        
-        # Skip empty outputs
-        if not cleaned:
-            print(f"⚠️  Не удалось парсить промт {i+1}: пустой вывод")
-            results.append(create_fallback_decomposition(original_prompts[i]))
-            continue
-            
-        try:
-            result = get_params_dict_SAP(cleaned)
-            if result is None:
-                # Если парсинг вернул None, используем fallback
-                results.append(create_fallback_decomposition(original_prompts[i]))
-            else:
-                results.append(result)
-        except Exception as e:
-            print(f"⚠️  Не удалось парсить промт {i+1}: {e}")
-            results.append(create_fallback_decomposition(original_prompts[i]))
-    return results
+    outputs = split_numbered_outputs(llm_output_text, len(original_prompts))
+    return [parse_llm_segment(out, prompt, i) for i, (out, prompt) in enumerate(zip(outputs, original_prompts))]
+
+
+def parse_llm_segment(segment, prompt, i):
+    """Декомпозиция из ответа на один промт (при ошибке - резервная)"""
+    cleaned = segment.strip()
+
+    # Skip empty outputs
+    if not cleaned:
+        print(f"⚠️  Не удалось парсить промт {i+1}: нет ответа для ### Input {i+1}")
+        return create_fallback_decomposition(prompt)
+
+    try:
+        result = get_params_dict_SAP(cleaned)
+        if result is None:
+            # Если парсинг вернул None, используем fallback
+            return create_fallback_decomposition(prompt)
+        return result
+    except Exception as e:
+        print(f"⚠️  Не удалось парсить промт {i+1}: {e}")
+        return create_fallback_decomposition(prompt)
+
+
+class IncrementalOutputParser:
+    """
+    Разбор потокового ответа на пронумерованные промты: сегмент "### Input N:"
+    разбирается, как только закрыт его итоговый словарь или начался следующий сегмент
+    """
+
+    def __init__(self, prompts):
+        self.prompts = prompts
+        self.buffer = ""
+        self.emitted = set()
+
+    def feed(self, text):
+        """Добавляет кусок ответа, возвращает готовые пары (индекс промта, декомпозиция)"""
+        self.buffer += text
+        return self._ready(final=False)
+
+    def close(self):
+        """Конец ответа: оставшиеся сегменты и резервные декомпозиции для пропущенных промтов"""
+        ready = self._ready(final=True)
+        for i, prompt in enumerate(self.prompts):
+            if i not in self.emitted:
+                self.emitted.add(i)
+                ready.append((i, parse_llm_segment("", prompt, i)))
+        return ready
+
+    def _ready(self, final):
+        matches = list(re.finditer(r"### Input (\d+):", self.buffer))
+        ready = []
+        keep_from = matches[-1].start() if matches else 0
+        for k, match in enumerate(matches):
+            i = int(match.group(1)) - 1
+            end = matches[k + 1].start() if k + 1 < len(matches) else len(self.buffer)
+            segment = self.buffer[match.end():end]
+            is_last = k + 1 == len(matches)
+            if i in self.emitted or not 0 <= i < len(self.prompts):
+                continue
+            if is_last and not final and not decomposition_complete(segment):
+                keep_from = min(keep_from, match.start())
+                continue
+            self.emitted.add(i)
+            ready.append((i, parse_llm_segment(segment, self.prompts[i], i)))
+        # Разобранные сегменты больше не нужны
+        self.buffer = self.buffer[keep_from:]
+        return ready
 
 
 def get_params_dict_SAP(response):
@@ -251,12 +659,13 @@ def create_fallback_decomposition(original_prompt):
         from sap_fallback import create_simple_sap_decomposition
         fallback_result = create_simple_sap_decomposition(original_prompt)
         print(f"  💡 Используется резервная декомпозиция (LLM не смог распарсить ответ)")
-        return fallback_result
+        return {**fallback_result, "source": "fallback"}
     except Exception as e:
         print(f"  ⚠️  Fallback также не сработал: {e}")
         # Просто возвращаем исходный промт
         return {
             "explanation": "Fallback: using original prompt as-is (LLM parsing failed)",
             "prompts_list": [original_prompt],
-            "switch_prompts_steps": []
+            "switch_prompts_steps": [],
+            "source": "fallback"
         }
\ No newline at end of file
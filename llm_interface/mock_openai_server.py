@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI-compatible server
+Локальный сервер /v1/chat/completions для проверки GPT декомпозиции без
+ключа и сети: на каждый "### Input N: ..." отвечает пронумерованной
+декомпозицией (целиком или потоком server-sent events при "stream": true),
+умеет имитировать задержку, 429 с Retry-After и ошибки 5xx
+
+    python llm_interface/mock_openai_server.py --port 8001 --rate-limit-every 3
+    OPENAI_BASE_URL=http://127.0.0.1:8001/v1 python generate_sap_prompts.py ...
+"""
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+INPUT_PATTERN = re.compile(r"### Input (\d+): (.*?)\n### Output:", re.DOTALL)
+
+
+def mock_decomposition(number, prompt):
+    """Ответ в формате шаблона: объяснение и итоговый словарь"""
+    params = {
+        "explanation": "mock decomposition",
+        "prompts_list": [prompt],
+        "switch_prompts_steps": []
+    }
+    return (
+        f"### Input {number}: {prompt}\n### Output:\n"
+        f"a. Explanation: mock decomposition of the prompt.\n"
+        f"b. Final dictionary:\n{json.dumps(params, ensure_ascii=False)}\n"
+    )
+
+
+class MockOpenAIHandler(BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, number, model, content, piece=16):
+        """Ответ server-sent events кусками по piece символов"""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        for start in range(0, len(content), piece):
+            chunk = {
+                "id": f"chatcmpl-mock-{number}",
+                "object": "chat.completion.chunk",
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": content[start:start + piece]}, "finish_reason": None}]
+            }
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+            self.wfile.flush()
+            time.sleep(self.server.stream_delay)
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self._send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        number = self.server.next_request()
+
+        if self.server.rate_limit_every and number % self.server.rate_limit_every == 0:
+            self._send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                            headers={"Retry-After": str(self.server.retry_after)})
+            return
+        if random.random() < self.server.fail_rate:
+            self._send_json(503, {"error": {"message": "Service unavailable"}})
+            return
+        time.sleep(self.server.delay)
+
+        user_message = next((m["content"] for m in reversed(request.get("messages", [])) if m["role"] == "user"), "")
+        # Шаблон содержит примеры без номера, ответ строится только по пронумерованным входам
+        content = "\n".join(mock_decomposition(n, p.strip()) for n, p in INPUT_PATTERN.findall(user_message))
+        if request.get("stream"):
+            self._send_stream(number, request.get("model", "mock"), content)
+            return
+        self._send_json(200, {
+            "id": f"chatcmpl-mock-{number}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model", "mock"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": len(user_message) // 4, "completion_tokens": len(content) // 4}
+        })
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, delay=0.0, rate_limit_every=0, retry_after=1.0, fail_rate=0.0, verbose=False,
+                 stream_delay=0.01):
+        super().__init__(address, MockOpenAIHandler)
+        self.delay = delay
+        self.stream_delay = stream_delay
+        self.rate_limit_every = rate_limit_every
+        self.retry_after = retry_after
+        self.fail_rate = fail_rate
+        self.verbose = verbose
+        self.requests_served = 0
+        self._lock = threading.Lock()
+
+    def next_request(self):
+        with self._lock:
+            self.requests_served += 1
+            return self.requests_served
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный OpenAI-совместимый сервер для проверки декомпозиции")
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="Адрес")
+    parser.add_argument("--port", type=int, default=8001, help="Порт")
+    parser.add_argument("--delay", type=float, default=0.0, help="Задержка ответа в секундах")
+    parser.add_argument("--rate-limit-every", type=int, default=0, help="Каждый N-й запрос получает 429 (0 - никогда)")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Значение Retry-After для 429")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Доля ответов 503")
+    parser.add_argument("--stream-delay", type=float, default=0.01, help="Пауза между кусками потокового ответа")
+    parser.add_argument("--verbose", action="store_true", help="Логировать запросы")
+    args = parser.parse_args()
+
+    server = MockOpenAIServer((args.host, args.port), delay=args.delay, rate_limit_every=args.rate_limit_every,
+                              retry_after=args.retry_after, fail_rate=args.fail_rate, verbose=args.verbose,
+                              stream_delay=args.stream_delay)
+    print(f"🧪 Mock OpenAI сервер: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(f"🛑 Остановлен, обслужено запросов: {server.requests_served}")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
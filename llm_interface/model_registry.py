@@ -0,0 +1,231 @@
+"""
+LLM model registry
+Реестр LLM процесса: каждый бэкенд загружается один раз при первом
+обращении и общий для всех вызывающих. Под бюджет памяти GPU и перед
+генерацией FLUX редко используемые модели выгружаются на CPU (offload) или
+освобождаются целиком (evict); модели, которые сейчас генерируют, не
+трогаются.
+
+    with get_registry().use("Zephyr") as pipe:
+        ...
+    get_registry().make_room()  # перед FLUX: освободить FLUX_HEADROOM_GB на GPU
+"""
+
+import os
+import gc
+import time
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Optional
+
+LLM_MEMORY_BUDGET_GB = float(os.getenv("SAP_LLM_MEMORY_BUDGET_GB", "0")) or None
+LLM_EVICTION_POLICY = os.getenv("SAP_LLM_EVICTION", "offload")
+EVICTION_POLICIES = ("offload", "evict")
+# Сколько свободной памяти устройства оставить FLUX после декомпозиции
+FLUX_HEADROOM_GB = float(os.getenv("SAP_FLUX_HEADROOM_GB", "24"))
+
+
+def _model_of(obj):
+    """torch модель внутри объекта (transformers pipeline или сама модель)"""
+    return getattr(obj, "model", obj)
+
+
+def _gpu_bytes(obj) -> int:
+    model = _model_of(obj)
+    try:
+        return sum(p.numel() * p.element_size() for p in model.parameters() if p.device.type == "cuda")
+    except Exception:
+        return 0
+
+
+def _free_cuda_cache():
+    gc.collect()
+    try:
+        import torch
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except ImportError:
+        pass
+
+
+class ModelRegistry:
+    """Общие загруженные LLM процесса с выгрузкой по LRU"""
+
+    def __init__(self, memory_budget_gb: Optional[float] = LLM_MEMORY_BUDGET_GB,
+                 policy: str = LLM_EVICTION_POLICY):
+        """
+        Args:
+            memory_budget_gb: сколько памяти GPU могут занимать LLM вместе (None - без ограничения)
+            policy: offload - перенос на CPU (быстрый возврат), evict - освобождение целиком
+        """
+        if policy not in EVICTION_POLICIES:
+            raise ValueError(f"Неизвестная политика выгрузки: {policy} (доступны: {', '.join(EVICTION_POLICIES)})")
+        self.memory_budget_gb = memory_budget_gb
+        self.policy = policy
+        self._loaders: Dict[str, Callable[[], Any]] = {}
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.RLock()
+        self._load_locks: Dict[str, threading.Lock] = {}
+        self.stats = {"loads": 0, "hits": 0, "offloads": 0, "restores": 0, "evictions": 0}
+
+    def register(self, name: str, loader: Callable[[], Any]):
+        """Регистрирует бэкенд (загрузка - при первом обращении)"""
+        with self._lock:
+            self._loaders[name] = loader
+            self._load_locks.setdefault(name, threading.Lock())
+
+    def loaded(self, name: str) -> bool:
+        with self._lock:
+            return name in self._entries
+
+    def get(self, name: str) -> Any:
+        """Загруженная модель на своем устройстве (загружается или возвращается с CPU при необходимости)"""
+        return self._acquire(name, pin=False)
+
+    @contextmanager
+    def use(self, name: str):
+        """Модель, закрепленная на устройстве на время блока (не выгружается)"""
+        model = self._acquire(name, pin=True)
+        try:
+            yield model
+        finally:
+            with self._lock:
+                entry = self._entries[name]
+                entry["pins"] -= 1
+                entry["last_used"] = time.monotonic()
+
+    def _acquire(self, name: str, pin: bool) -> Any:
+        if name not in self._loaders:
+            raise KeyError(f"LLM {name} не зарегистрирована (доступны: {', '.join(self._loaders)})")
+        with self._load_locks[name]:
+            with self._lock:
+                entry = self._entries.get(name)
+            if entry is None:
+                print(f"📥 Загрузка {name} (один раз на процесс)...")
+                model = self._loaders[name]()
+                entry = {"model": model, "device": None, "pins": 0, "last_used": time.monotonic()}
+                with self._lock:
+                    self._entries[name] = entry
+                    self.stats["loads"] += 1
+            elif entry["device"] is not None:
+                self._restore(name, entry)
+            else:
+                self.stats["hits"] += 1
+            with self._lock:
+                entry["last_used"] = time.monotonic()
+                entry["pins"] += 1 if pin else 0
+        self._enforce_budget(keep=name)
+        return entry["model"]
+
+    def _restore(self, name: str, entry: Dict):
+        _model_of(entry["model"]).to(entry["device"])
+        entry["device"] = None
+        self.stats["restores"] += 1
+        print(f"♻️  {name} возвращена на {_model_of(entry['model']).device}")
+
+    def _release(self, name: str) -> bool:
+        """Выгружает одну модель по политике реестра; False - если модель занята"""
+        # Модель, которую сейчас загружают или возвращают на GPU, не трогаем
+        if not self._load_locks[name].acquire(blocking=False):
+            return False
+        try:
+            return self._release_locked(name)
+        finally:
+            self._load_locks[name].release()
+
+    def _release_locked(self, name: str) -> bool:
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry["pins"] > 0 or entry["device"] is not None:
+                return False
+            from llm_interface.prefix_cache import clear_prefix_caches
+            model = _model_of(entry["model"])
+            clear_prefix_caches([model])
+            if self.policy == "offload":
+                try:
+                    device = model.device
+                    model.to("cpu")
+                    entry["device"] = device
+                    self.stats["offloads"] += 1
+                    print(f"💤 {name} выгружена на CPU")
+                except Exception as e:
+                    # Модели, распределенные accelerate по устройствам, не переносятся целиком
+                    print(f"⚠️  {name} не переносится на CPU ({e}), освобождается")
+                    self._entries.pop(name)
+                    self.stats["evictions"] += 1
+            else:
+                self._entries.pop(name)
+                self.stats["evictions"] += 1
+                print(f"🗑️  {name} освобождена")
+        _free_cuda_cache()
+        return True
+
+    def _resident(self):
+        """Модели на GPU от давно не использованных к недавним"""
+        with self._lock:
+            return sorted((n for n, e in self._entries.items() if e["device"] is None),
+                          key=lambda n: self._entries[n]["last_used"])
+
+    def _enforce_budget(self, keep: Optional[str] = None):
+        if self.memory_budget_gb is None:
+            return
+        for name in self._resident():
+            used = sum(_gpu_bytes(self._entries[n]["model"]) for n in self._resident()) / 2 ** 30
+            if used <= self.memory_budget_gb:
+                return
+            if name != keep:
+                self._release(name)
+
+    def make_room(self, required_gb: Optional[float] = FLUX_HEADROOM_GB):
+        """
+        Освобождает GPU для других моделей (например, FLUX): выгружает LLM от
+        давно не использованных, пока свободной памяти меньше required_gb
+        (None - выгружает все незанятые)
+        """
+        try:
+            import torch
+            cuda = torch.cuda.is_available()
+        except ImportError:
+            cuda = False
+        for name in self._resident():
+            if required_gb is not None and cuda:
+                free, _ = torch.cuda.mem_get_info()
+                if free / 2 ** 30 >= required_gb:
+                    return
+            self._release(name)
+
+    def evict(self, name: str):
+        """Освобождает модель целиком (следующее обращение загрузит ее заново)"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None and entry["pins"] > 0:
+                raise RuntimeError(f"{name} сейчас используется")
+            if entry is not None:
+                self._entries.pop(name)
+                self.stats["evictions"] += 1
+        _free_cuda_cache()
+
+    def status(self) -> Dict:
+        with self._lock:
+            models = {
+                name: {
+                    "on_gpu": entry["device"] is None,
+                    "gpu_gb": round(_gpu_bytes(entry["model"]) / 2 ** 30, 2),
+                    "in_use": entry["pins"] > 0
+                }
+                for name, entry in self._entries.items()
+            }
+            return {"registered": list(self._loaders), "loaded": models, "stats": dict(self.stats)}
+
+
+_registry: Optional[ModelRegistry] = None
+_registry_lock = threading.Lock()
+
+
+def get_registry() -> ModelRegistry:
+    """Общий реестр процесса (бюджет и политика - SAP_LLM_MEMORY_BUDGET_GB, SAP_LLM_EVICTION)"""
+    global _registry
+    with _registry_lock:
+        if _registry is None:
+            _registry = ModelRegistry()
+        return _registry
@@ -0,0 +1,383 @@
+"""
+OpenAI client layer
+Общий клиент OpenAI-совместимого API для декомпозиции и оценки: пул
+keep-alive соединений (без нового TCP+TLS на каждый запрос), повторы с
+учетом Retry-After, настраиваемые таймауты и base URL, метрики запросов
+и задержек. AsyncOpenAIClient - вариант для asyncio (httpx, если
+установлен, иначе пул синхронного клиента в потоках).
+
+    client = get_client()
+    text = client.chat_completion(messages, model="gpt-4o", key=key)
+    print(client.metrics.summary())
+"""
+
+import os
+import json
+import time
+import random
+import asyncio
+import threading
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+DEFAULT_OPENAI_BASE_URL = "https://api.openai.com/v1"
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL", DEFAULT_OPENAI_BASE_URL)
+OPENAI_TIMEOUT = float(os.getenv("OPENAI_TIMEOUT", "120"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "10"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "5"))
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "16"))
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class OpenAIRequestError(RuntimeError):
+    """Ошибка запроса; retryable=False - повтор не поможет (например, неверный ключ)"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: bool = True):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+
+
+def parse_retry_after(value) -> Optional[float]:
+    """Retry-After в секундах (число или HTTP дата)"""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_delay(attempt: int, retry_after: Optional[float] = None, base: float = 1.0, cap: float = 60.0) -> float:
+    """Пауза перед повтором: Retry-After сервера или экспонента с джиттером"""
+    if retry_after is not None:
+        return min(retry_after, cap)
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+
+def _attempt_timeout(timeout: float, end: Optional[float]) -> float:
+    """Таймаут попытки, не выходящий за общий срок запроса (end - time.monotonic())"""
+    if end is None:
+        return timeout
+    return max(0.001, min(timeout, end - time.monotonic()))
+
+
+def _check_status(status: int, text: str, headers) -> Optional[float]:
+    """Для повторяемого статуса возвращает Retry-After, для прочих ошибок поднимает исключение"""
+    if status not in RETRYABLE_STATUS:
+        raise OpenAIRequestError(f"HTTP {status}: {text[:200]}", status=status, retryable=False)
+    return parse_retry_after(headers.get("Retry-After"))
+
+
+class ClientMetrics:
+    """Счетчики запросов, статусов, повторов, токенов и задержки попыток"""
+
+    def __init__(self, max_samples: int = 10000):
+        self._lock = threading.Lock()
+        self.max_samples = max_samples
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.attempts = 0
+            self.retries = 0
+            self.failures = 0
+            self.status_counts: Dict[str, int] = {}
+            self.prompt_tokens = 0
+            self.completion_tokens = 0
+            self.latencies: List[float] = []
+
+    def record_attempt(self, status, latency: float):
+        with self._lock:
+            self.attempts += 1
+            key = str(status)
+            self.status_counts[key] = self.status_counts.get(key, 0) + 1
+            self.latencies.append(latency)
+            if len(self.latencies) > self.max_samples:
+                del self.latencies[:len(self.latencies) - self.max_samples]
+
+    def record_request(self, retries: int, ok: bool, usage: Optional[Dict] = None):
+        with self._lock:
+            self.requests += 1
+            self.retries += retries
+            self.failures += 0 if ok else 1
+            if usage:
+                self.prompt_tokens += usage.get("prompt_tokens", 0)
+                self.completion_tokens += usage.get("completion_tokens", 0)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            latencies = sorted(self.latencies)
+            summary = {
+                "requests": self.requests,
+                "attempts": self.attempts,
+                "retries": self.retries,
+                "failures": self.failures,
+                "status": dict(self.status_counts),
+                "prompt_tokens": self.prompt_tokens,
+                "completion_tokens": self.completion_tokens,
+            }
+        if latencies:
+            summary["latency_s"] = {
+                "mean": round(sum(latencies) / len(latencies), 3),
+                "p50": round(latencies[len(latencies) // 2], 3),
+                "p95": round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))], 3),
+                "max": round(latencies[-1], 3),
+            }
+        return summary
+
+    def format(self) -> str:
+        s = self.summary()
+        latency = s.get("latency_s")
+        line = f"{s['requests']} запросов, {s['retries']} повторов, {s['failures']} ошибок"
+        if latency:
+            line += f", задержка p50 {latency['p50']} с / p95 {latency['p95']} с"
+        return line
+
+
+class OpenAIClient:
+    """Синхронный клиент с пулом keep-alive соединений (потокобезопасен)"""
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        pool_size: int = OPENAI_POOL_SIZE
+    ):
+        """
+        Args:
+            base_url: адрес API (по умолчанию OPENAI_BASE_URL)
+            api_key: ключ по умолчанию (иначе OPENAI_API_KEY или key при вызове)
+            timeout: таймаут чтения ответа в секундах
+            connect_timeout: таймаут установки соединения
+            max_retries: число повторов повторяемых ошибок
+            pool_size: соединений в пуле (не меньше параллельных запросов)
+        """
+        self.base_url = (base_url or OPENAI_BASE_URL).rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY", "")
+        self.timeout = timeout or OPENAI_TIMEOUT
+        self.connect_timeout = connect_timeout or OPENAI_CONNECT_TIMEOUT
+        self.max_retries = OPENAI_MAX_RETRIES if max_retries is None else max_retries
+        self.metrics = ClientMetrics()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def _headers(self, key: Optional[str]) -> Dict[str, str]:
+        return {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {key or self.api_key}"
+        }
+
+    def post(self, path: str, payload: Dict, key: Optional[str] = None, timeout: Optional[float] = None,
+             max_retries: Optional[int] = None, stream: bool = False, deadline: Optional[float] = None):
+        """
+        POST с повторами, возвращает JSON ответа (stream=True - открытый ответ для чтения событий).
+
+        deadline - общий срок в секундах на все попытки и паузы между ними
+        (timeout ограничивает только одну попытку).
+        """
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        max_retries = self.max_retries if max_retries is None else max_retries
+        end = time.monotonic() + deadline if deadline else None
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            try:
+                response = self.session.post(url, headers=self._headers(key), json=payload,
+                                             timeout=(self.connect_timeout, _attempt_timeout(timeout or self.timeout, end)),
+                                             stream=stream)
+                self.metrics.record_attempt(response.status_code, time.perf_counter() - start)
+                if response.status_code == 200 and stream:
+                    self.metrics.record_request(attempt, True)
+                    return response
+                if response.status_code == 200:
+                    obj = response.json()
+                    self.metrics.record_request(attempt, True, obj.get("usage"))
+                    return obj
+                try:
+                    retry_after = _check_status(response.status_code, response.text, response.headers)
+                finally:
+                    # Ответ с ошибкой (в том числе stream=True) освобождает соединение пула до повтора
+                    response.close()
+                error = f"HTTP {response.status_code}"
+            except (requests.Timeout, requests.ConnectionError) as e:
+                self.metrics.record_attempt(type(e).__name__, time.perf_counter() - start)
+                retry_after, error = None, type(e).__name__
+            except OpenAIRequestError:
+                self.metrics.record_request(attempt, False)
+                raise
+            if attempt == max_retries:
+                self.metrics.record_request(attempt, False)
+                raise OpenAIRequestError(f"Запрос не удался после {max_retries + 1} попыток: {error}")
+            delay = retry_delay(attempt, retry_after)
+            if end is not None and time.monotonic() + delay >= end:
+                self.metrics.record_request(attempt, False)
+                raise OpenAIRequestError(f"Срок запроса {deadline:g} с истек после {attempt + 1} попыток: {error}")
+            print(f"  ⏳ {error}, повтор {attempt + 1}/{max_retries} через {delay:.1f} с")
+            time.sleep(delay)
+
+    def chat_completion(self, messages: List[Dict], model: str, key: Optional[str] = None,
+                        timeout: Optional[float] = None, max_retries: Optional[int] = None,
+                        deadline: Optional[float] = None, **params) -> str:
+        """Текст ответа chat completion"""
+        obj = self.post("chat/completions", {"model": model, "messages": messages, **params},
+                        key=key, timeout=timeout, max_retries=max_retries, deadline=deadline)
+        return obj["choices"][0]["message"]["content"]
+
+    def stream_chat_completion(self, messages: List[Dict], model: str, key: Optional[str] = None,
+                               timeout: Optional[float] = None, max_retries: Optional[int] = None,
+                               deadline: Optional[float] = None, **params) -> Iterator[str]:
+        """
+        Текст ответа по частям (server-sent events). Повторы возможны только
+        до начала ответа; обрыв потока поднимает исключение. deadline
+        ограничивает и попытки, и чтение всего ответа.
+        """
+        end = time.monotonic() + deadline if deadline else None
+        response = self.post("chat/completions", {"model": model, "messages": messages, "stream": True, **params},
+                             key=key, timeout=timeout, max_retries=max_retries, stream=True, deadline=deadline)
+        try:
+            for line in response.iter_lines():
+                if end is not None and time.monotonic() > end:
+                    raise OpenAIRequestError(f"Срок запроса {deadline:g} с истек во время чтения ответа")
+                line = line.decode("utf-8") if isinstance(line, bytes) else line
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                choices = json.loads(data).get("choices") or []
+                delta = choices[0].get("delta", {}).get("content") if choices else None
+                if delta:
+                    yield delta
+        finally:
+            response.close()
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncOpenAIClient:
+    """
+    Асинхронный клиент с тем же интерфейсом (методы - корутины).
+
+    Использует httpx.AsyncClient с пулом соединений; без httpx запросы идут
+    через синхронный OpenAIClient в потоках.
+    """
+
+    def __init__(
+        self,
+        base_url: Optional[str] = None,
+        api_key: Optional[str] = None,
+        timeout: Optional[float] = None,
+        connect_timeout: Optional[float] = None,
+        max_retries: Optional[int] = None,
+        pool_size: int = OPENAI_POOL_SIZE
+    ):
+        self.base_url = (base_url or OPENAI_BASE_URL).rstrip("/")
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY", "")
+        self.timeout = timeout or OPENAI_TIMEOUT
+        self.connect_timeout = connect_timeout or OPENAI_CONNECT_TIMEOUT
+        self.max_retries = OPENAI_MAX_RETRIES if max_retries is None else max_retries
+        self.metrics = ClientMetrics()
+        try:
+            import httpx
+            self._httpx = httpx
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+            self._sync = None
+        except ImportError:
+            self._httpx = self._client = None
+            self._sync = OpenAIClient(self.base_url, self.api_key, self.timeout, self.connect_timeout,
+                                      self.max_retries, pool_size)
+            self.metrics = self._sync.metrics
+
+    async def post(self, path: str, payload: Dict, key: Optional[str] = None, timeout: Optional[float] = None,
+                   max_retries: Optional[int] = None, deadline: Optional[float] = None) -> Dict:
+        if self._sync is not None:
+            return await asyncio.to_thread(self._sync.post, path, payload, key, timeout, max_retries,
+                                           deadline=deadline)
+
+        httpx = self._httpx
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        headers = {
+            "Accept": "application/json",
+            "Content-Type": "application/json",
+            "Authorization": f"Bearer {key or self.api_key}"
+        }
+        max_retries = self.max_retries if max_retries is None else max_retries
+        end = time.monotonic() + deadline if deadline else None
+        for attempt in range(max_retries + 1):
+            start = time.perf_counter()
+            request_timeout = httpx.Timeout(_attempt_timeout(timeout or self.timeout, end), connect=self.connect_timeout)
+            try:
+                response = await self._client.post(url, headers=headers, json=payload, timeout=request_timeout)
+                self.metrics.record_attempt(response.status_code, time.perf_counter() - start)
+                if response.status_code == 200:
+                    obj = response.json()
+                    self.metrics.record_request(attempt, True, obj.get("usage"))
+                    return obj
+                retry_after = _check_status(response.status_code, response.text, response.headers)
+                error = f"HTTP {response.status_code}"
+            except httpx.TransportError as e:
+                self.metrics.record_attempt(type(e).__name__, time.perf_counter() - start)
+                retry_after, error = None, type(e).__name__
+            except OpenAIRequestError:
+                self.metrics.record_request(attempt, False)
+                raise
+            if attempt == max_retries:
+                self.metrics.record_request(attempt, False)
+                raise OpenAIRequestError(f"Запрос не удался после {max_retries + 1} попыток: {error}")
+            delay = retry_delay(attempt, retry_after)
+            if end is not None and time.monotonic() + delay >= end:
+                self.metrics.record_request(attempt, False)
+                raise OpenAIRequestError(f"Срок запроса {deadline:g} с истек после {attempt + 1} попыток: {error}")
+            print(f"  ⏳ {error}, повтор {attempt + 1}/{max_retries} через {delay:.1f} с")
+            await asyncio.sleep(delay)
+
+    async def chat_completion(self, messages: List[Dict], model: str, key: Optional[str] = None,
+                              timeout: Optional[float] = None, max_retries: Optional[int] = None,
+                              deadline: Optional[float] = None, **params) -> str:
+        obj = await self.post("chat/completions", {"model": model, "messages": messages, **params},
+                              key=key, timeout=timeout, max_retries=max_retries, deadline=deadline)
+        return obj["choices"][0]["message"]["content"]
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+        if self._sync is not None:
+            self._sync.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+_clients: Dict[str, OpenAIClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(base_url: Optional[str] = None) -> OpenAIClient:
+    """Общий синхронный клиент процесса для base_url (соединения переиспользуются между вызовами)"""
+    base_url = (base_url or OPENAI_BASE_URL).rstrip("/")
+    with _clients_lock:
+        client = _clients.get(base_url)
+        if client is None:
+            client = _clients[base_url] = OpenAIClient(base_url)
+        return client
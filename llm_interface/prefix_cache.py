@@ -0,0 +1,99 @@
+"""
+Prefix KV cache
+KV кэш общего префикса промтов (системный шаблон + few-shot примеры):
+префикс токенизируется и прогоняется через модель один раз на загруженную
+модель, затем для каждого промта копия кэша дополняется только новым
+входом, так что prefill стоит лишь суффикса.
+"""
+
+import copy
+import hashlib
+import threading
+import weakref
+from typing import Dict, List
+
+# модель -> {хэш префикса: PrefixKVCache}; кэш живет, пока загружена модель
+_prefix_caches: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+_prefix_lock = threading.Lock()
+
+
+class PrefixKVCache:
+    """Предвычисленный KV кэш префикса для одной модели"""
+
+    def __init__(self, model, tokenizer, prefix: str):
+        import torch
+        from transformers import DynamicCache
+
+        self.model = model
+        self.tokenizer = tokenizer
+        self.prefix = prefix
+        self.prefix_ids = tokenizer(prefix, return_tensors="pt").input_ids.to(model.device)
+        with torch.no_grad():
+            self.cache = model(self.prefix_ids, past_key_values=DynamicCache(), use_cache=True).past_key_values
+        self.stats = {"prompts": 0, "reused_tokens": 0, "prefill_tokens": 0}
+
+    @property
+    def prefix_length(self) -> int:
+        return self.prefix_ids.shape[1]
+
+    def common_length(self, ids) -> int:
+        """
+        Сколько первых токенов ids (1-D) совпадает с префиксом; обычно это весь
+        префикс, меньше - если токенизация на стыке с суффиксом разошлась.
+        Хотя бы один токен входа остается для прохода через модель.
+        """
+        head = ids[:self.prefix_length]
+        matches = (head == self.prefix_ids[0, :head.shape[0]].to(ids.device)).long()
+        return min(int(matches.cumprod(0).sum()), ids.shape[0] - 1)
+
+    def expanded(self, length: int, batch_size: int = 1):
+        """Копия кэша первых length токенов префикса для батча из batch_size последовательностей"""
+        cache = copy.deepcopy(self.cache)
+        if length < self.prefix_length:
+            cache.crop(length)
+        if batch_size > 1:
+            cache.batch_repeat_interleave(batch_size)
+        return cache
+
+    def generate(self, suffix: str, **generation_kwargs) -> str:
+        """Генерация продолжения prefix + suffix, возвращает только новый текст"""
+        import torch
+        from llm_interface.zephyr_batch import decoding_kwargs, truncate_decomposition
+
+        input_ids = self.tokenizer(self.prefix + suffix, return_tensors="pt").input_ids.to(self.model.device)
+        reused = self.common_length(input_ids[0])
+        cache = self.expanded(reused)
+        with torch.no_grad():
+            output = self.model.generate(
+                input_ids=input_ids,
+                attention_mask=torch.ones_like(input_ids),
+                past_key_values=cache,
+                pad_token_id=self.tokenizer.eos_token_id,
+                **decoding_kwargs(self.tokenizer, input_ids.shape[1], 1),
+                **generation_kwargs
+            )
+        self.stats["prompts"] += 1
+        self.stats["reused_tokens"] += reused
+        self.stats["prefill_tokens"] += input_ids.shape[1] - reused
+        return truncate_decomposition(self.tokenizer.decode(output[0, input_ids.shape[1]:], skip_special_tokens=True))
+
+
+def get_prefix_cache(pipe, prefix: str) -> PrefixKVCache:
+    """
+    KV кэш префикса для пайплайна text-generation (вычисляется при первом
+    обращении и переиспользуется, пока модель загружена)
+    """
+    key = hashlib.sha256(prefix.encode("utf-8")).hexdigest()
+    with _prefix_lock:
+        per_model: Dict[str, PrefixKVCache] = _prefix_caches.setdefault(pipe.model, {})
+        if key not in per_model:
+            per_model[key] = PrefixKVCache(pipe.model, pipe.tokenizer, prefix)
+            print(f"🧠 KV кэш шаблона: {per_model[key].prefix_length} токенов")
+        return per_model[key]
+
+
+def clear_prefix_caches(models: List = None):
+    """Освобождает KV кэши префиксов (всех моделей или перечисленных)"""
+    with _prefix_lock:
+        for model in list(models if models is not None else _prefix_caches.keys()):
+            _prefix_caches.pop(model, None)
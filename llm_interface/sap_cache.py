@@ -0,0 +1,224 @@
+"""
+SAP decomposition cache
+Постоянный кэш LLM декомпозиций на SQLite: ключ - нормализованный промт,
+LLM (бэкенд и модель), хэш содержимого шаблонов и параметры сэмплирования.
+Безопасен для нескольких потоков и процессов (WAL, таймаут блокировки),
+ведет статистику попаданий и поддерживает TTL.
+
+    python llm_interface/sap_cache.py --stats
+    python llm_interface/sap_cache.py --purge-expired --ttl-days 30
+"""
+
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+import unicodedata
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+DEFAULT_DECOMPOSITION_CACHE = os.getenv(
+    "SAP_DECOMPOSITION_CACHE",
+    os.path.join(os.path.expanduser("~"), ".cache", "sap_generation", "decompositions.sqlite3")
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS decompositions (
+    key TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    template_hash TEXT NOT NULL,
+    params TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    last_hit_at REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Промт без различий в пробелах и юникод-формах"""
+    return " ".join(unicodedata.normalize("NFKC", prompt).split())
+
+
+def template_hash(paths: Iterable[str]) -> str:
+    """Хэш содержимого файлов шаблонов (правка шаблона - новые ключи)"""
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(path, "rb") as f:
+            digest.update(f.read())
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def decomposition_key(prompt: str, backend: str, templates_hash: str, params: Dict) -> str:
+    payload = json.dumps(
+        {"prompt": normalize_prompt(prompt), "backend": backend, "templates": templates_hash, "params": params},
+        sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class DecompositionCache:
+    """Кэш SAP декомпозиций в SQLite (одно соединение на поток)"""
+
+    def __init__(self, path: str = DEFAULT_DECOMPOSITION_CACHE, ttl: Optional[float] = None):
+        """
+        Args:
+            path: файл базы SQLite
+            ttl: срок жизни записи в секундах (None - бессрочно)
+        """
+        self.path = path
+        self.ttl = ttl
+        Path(os.path.dirname(os.path.abspath(path))).mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.session_stats = {"hits": 0, "misses": 0, "writes": 0}
+        with self._connection() as conn:
+            conn.execute(_SCHEMA)
+
+    @classmethod
+    def from_env(cls) -> Optional["DecompositionCache"]:
+        """Кэш по переменным окружения (SAP_DECOMPOSITION_CACHE_DISABLE=1 - без кэша)"""
+        if os.getenv("SAP_DECOMPOSITION_CACHE_DISABLE", "0") == "1":
+            return None
+        ttl = os.getenv("SAP_DECOMPOSITION_CACHE_TTL")
+        return cls(DEFAULT_DECOMPOSITION_CACHE, ttl=float(ttl) if ttl else None)
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Ожидание блокировки вместо ошибки при одновременной записи из нескольких процессов
+            conn = sqlite3.connect(self.path, timeout=30.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _count(self, name: str, value: int = 1):
+        with self._stats_lock:
+            self.session_stats[name] += value
+
+    def get_many(self, keys: List[str]) -> Dict[str, Dict]:
+        """Найденные (и не устаревшие) декомпозиции по ключам"""
+        keys = list(dict.fromkeys(keys))
+        if not keys:
+            return {}
+        now = time.time()
+        found = {}
+        conn = self._connection()
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            rows = conn.execute(
+                f"SELECT key, value, created_at FROM decompositions WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk
+            ).fetchall()
+            for key, value, created_at in rows:
+                if self.ttl is None or now - created_at <= self.ttl:
+                    found[key] = json.loads(value)
+        if found:
+            with conn:
+                conn.executemany(
+                    "UPDATE decompositions SET hits = hits + 1, last_hit_at = ? WHERE key = ?",
+                    [(now, key) for key in found]
+                )
+        self._count("hits", len(found))
+        self._count("misses", len(keys) - len(found))
+        return found
+
+    def get(self, key: str) -> Optional[Dict]:
+        return self.get_many([key]).get(key)
+
+    def put_many(self, entries: List[Dict]):
+        """
+        Сохраняет декомпозиции одной транзакцией.
+
+        entries: словари с key, prompt, backend, template_hash, params, value
+        """
+        if not entries:
+            return
+        now = time.time()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO decompositions "
+                "(key, prompt, backend, template_hash, params, value, created_at, hits) VALUES (?, ?, ?, ?, ?, ?, ?, 0)",
+                [
+                    (e["key"], normalize_prompt(e["prompt"]), e["backend"], e["template_hash"],
+                     json.dumps(e["params"], sort_keys=True), json.dumps(e["value"], ensure_ascii=False), now)
+                    for e in entries
+                ]
+            )
+        self._count("writes", len(entries))
+
+    def purge_expired(self, ttl: Optional[float] = None) -> int:
+        """Удаляет записи старше ttl (по умолчанию - TTL кэша), возвращает их число"""
+        ttl = ttl if ttl is not None else self.ttl
+        if ttl is None:
+            return 0
+        conn = self._connection()
+        with conn:
+            cursor = conn.execute("DELETE FROM decompositions WHERE created_at < ?", (time.time() - ttl,))
+        return cursor.rowcount
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute("DELETE FROM decompositions")
+
+    def stats(self) -> Dict:
+        conn = self._connection()
+        entries, total_hits = conn.execute("SELECT COUNT(*), COALESCE(SUM(hits), 0) FROM decompositions").fetchone()
+        backends = dict(conn.execute("SELECT backend, COUNT(*) FROM decompositions GROUP BY backend").fetchall())
+        with self._stats_lock:
+            session = dict(self.session_stats)
+        lookups = session["hits"] + session["misses"]
+        return {
+            "path": self.path,
+            "entries": entries,
+            "backends": backends,
+            "size_mb": round(os.path.getsize(self.path) / 2 ** 20, 3) if os.path.exists(self.path) else 0.0,
+            "total_hits": total_hits,
+            "session": session,
+            "session_hit_rate": round(session["hits"] / lookups, 3) if lookups else None
+        }
+
+    def close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Кэш SAP декомпозиций")
+    parser.add_argument("--path", type=str, default=DEFAULT_DECOMPOSITION_CACHE, help="Файл базы SQLite")
+    parser.add_argument("--stats", action="store_true", help="Показать статистику")
+    parser.add_argument("--purge-expired", action="store_true", help="Удалить устаревшие записи")
+    parser.add_argument("--ttl-days", type=float, default=None, help="Срок жизни записи в днях")
+    parser.add_argument("--clear", action="store_true", help="Очистить кэш")
+    args = parser.parse_args()
+
+    cache = DecompositionCache(args.path, ttl=args.ttl_days * 86400 if args.ttl_days else None)
+    if args.clear:
+        cache.clear()
+        print("🧹 Кэш декомпозиций очищен")
+    if args.purge_expired:
+        if cache.ttl is None:
+            print("❌ Для --purge-expired нужен --ttl-days")
+            sys.exit(1)
+        print(f"🧹 Удалено устаревших записей: {cache.purge_expired()}")
+    stats = cache.stats()
+    print(f"🗃️  Кэш декомпозиций: {stats['path']}")
+    print(f"  Записей: {stats['entries']} ({stats['size_mb']} МБ), всего попаданий: {stats['total_hits']}")
+    for backend, count in stats["backends"].items():
+        print(f"  {backend}: {count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+"""
+Batched Zephyr generation
+Батчевая генерация декомпозиций: несколько промтов в одном вызове
+generate. Общий префикс шаблона берется из KV кэша (prefix_cache), входы
+промтов выравниваются паддингом слева после префикса, размер батча
+подбирается по свободной памяти, а каждая последовательность
+останавливается отдельно, как только ее ответ завершен. Декодирование
+ограничено грамматикой формата ответа (constrained_decoding,
+SAP_ZEPHYR_CONSTRAINED=0 отключает).
+"""
+
+import os
+from typing import List, Optional
+
+from llm_interface.constrained_decoding import ZEPHYR_CONSTRAINED, decomposition_logits_processor
+
+ZEPHYR_MAX_BATCH_SIZE = int(os.getenv("SAP_ZEPHYR_BATCH_SIZE", "16"))
+CPU_MAX_BATCH_SIZE = 4
+
+
+def decomposition_complete(text: str) -> bool:
+    """Ответ завершен: закрыт итоговый словарь или модель начала следующий пример"""
+    if "### Input" in text:
+        return True
+    if "Final dictionary" not in text:
+        return False
+    depth, opened = 0, False
+    for char in text.split("Final dictionary", 1)[1]:
+        if char == "{":
+            depth, opened = depth + 1, True
+        elif char == "}" and opened:
+            depth -= 1
+            if depth == 0:
+                return True
+    return False
+
+
+def truncate_decomposition(text: str) -> str:
+    """Обрезает начатый моделью следующий пример"""
+    return text.split("### Input", 1)[0]
+
+
+def _stopping_criteria(tokenizer, prompt_length: int):
+    import torch
+    from transformers import StoppingCriteria
+
+    class DecompositionStoppingCriteria(StoppingCriteria):
+        """Останавливает каждую последовательность батча отдельно"""
+
+        def __call__(self, input_ids, scores, **kwargs):
+            texts = tokenizer.batch_decode(input_ids[:, prompt_length:], skip_special_tokens=True)
+            return torch.tensor([decomposition_complete(t) for t in texts], dtype=torch.bool, device=input_ids.device)
+
+    return DecompositionStoppingCriteria()
+
+
+def decoding_kwargs(tokenizer, prompt_length: int, batch_size: int, constrained: bool = ZEPHYR_CONSTRAINED):
+    """
+    Аргументы generate для декомпозиции: остановка каждой последовательности
+    по закрытию словаря и (constrained) декодирование по грамматике формата
+    """
+    from transformers import LogitsProcessorList, StoppingCriteriaList
+
+    kwargs = {"stopping_criteria": StoppingCriteriaList([_stopping_criteria(tokenizer, prompt_length)])}
+    if constrained:
+        kwargs["logits_processor"] = LogitsProcessorList([decomposition_logits_processor(tokenizer, batch_size)])
+    return kwargs
+
+
+def adaptive_batch_size(model, sequence_tokens: int, max_batch_size: int = ZEPHYR_MAX_BATCH_SIZE,
+                        memory_fraction: float = 0.8) -> int:
+    """
+    Размер батча по свободной памяти GPU: KV кэш одной последовательности
+    (с запасом на активации) должен поместиться в долю свободной памяти
+    """
+    import torch
+
+    if not torch.cuda.is_available() or model.device.type != "cuda":
+        return min(max_batch_size, CPU_MAX_BATCH_SIZE)
+    config = model.config
+    head_dim = getattr(config, "head_dim", None) or config.hidden_size // config.num_attention_heads
+    kv_heads = getattr(config, "num_key_value_heads", None) or config.num_attention_heads
+    kv_bytes_per_token = 2 * config.num_hidden_layers * kv_heads * head_dim * model.dtype.itemsize
+    per_sequence = kv_bytes_per_token * sequence_tokens * 1.5
+    free, _ = torch.cuda.mem_get_info(model.device)
+    return max(1, min(max_batch_size, int(free * memory_fraction // per_sequence)))
+
+
+def _generate_group(pipe, prefix_cache, full_prompts: List[str], generation_kwargs) -> List[str]:
+    """Один вызов generate для группы промтов"""
+    import torch
+
+    tokenizer, model = pipe.tokenizer, pipe.model
+    encoded = [tokenizer(text, return_tensors="pt").input_ids[0].to(model.device) for text in full_prompts]
+    batch_size = len(encoded)
+
+    # Общая для всех промтов часть префикса берется из KV кэша
+    reused = min(prefix_cache.common_length(ids) for ids in encoded) if prefix_cache is not None else 0
+    cache = prefix_cache.expanded(reused, batch_size) if reused else None
+
+    # Входы промтов выравниваются паддингом слева между префиксом и текстом промта
+    pad_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+    suffixes = [ids[reused:] for ids in encoded]
+    width = max(len(s) for s in suffixes)
+    input_ids = torch.full((batch_size, reused + width), pad_id, dtype=torch.long, device=model.device)
+    attention_mask = torch.zeros_like(input_ids)
+    for row, suffix in enumerate(suffixes):
+        if reused:
+            input_ids[row, :reused] = prefix_cache.prefix_ids[0, :reused]
+            attention_mask[row, :reused] = 1
+        input_ids[row, reused + width - len(suffix):] = suffix
+        attention_mask[row, reused + width - len(suffix):] = 1
+
+    prompt_length = input_ids.shape[1]
+    with torch.no_grad():
+        output = model.generate(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            past_key_values=cache,
+            pad_token_id=pad_id,
+            **decoding_kwargs(tokenizer, prompt_length, batch_size),
+            **generation_kwargs
+        )
+    if prefix_cache is not None:
+        prefix_cache.stats["prompts"] += batch_size
+        prefix_cache.stats["reused_tokens"] += reused * batch_size
+        prefix_cache.stats["prefill_tokens"] += sum(len(ids) - reused for ids in encoded)
+    texts = tokenizer.batch_decode(output[:, prompt_length:], skip_special_tokens=True)
+    return [truncate_decomposition(text) for text in texts]
+
+
+def generate_batched(pipe, full_prompts: List[str], prefix_cache=None, batch_size: Optional[int] = None,
+                     **generation_kwargs) -> List:
+    """
+    Ответы модели для всех промтов батчами.
+
+    batch_size=None - размер по свободной памяти; при нехватке памяти батч
+    делится пополам. Ошибка группы возвращается как исключение на позициях
+    ее промтов, остальные группы не теряются.
+    """
+    import torch
+
+    if not full_prompts:
+        return []
+    if batch_size is None:
+        longest = max(len(pipe.tokenizer(p).input_ids) for p in full_prompts)
+        batch_size = adaptive_batch_size(pipe.model, longest + generation_kwargs.get("max_new_tokens", 512))
+    print(f"  📦 Батч Zephyr: {batch_size} промтов на вызов generate")
+
+    results: List = [None] * len(full_prompts)
+    start = 0
+    while start < len(full_prompts):
+        group = list(range(start, min(start + batch_size, len(full_prompts))))
+        try:
+            texts = _generate_group(pipe, prefix_cache, [full_prompts[i] for i in group], generation_kwargs)
+        except torch.cuda.OutOfMemoryError as e:
+            torch.cuda.empty_cache()
+            if batch_size > 1:
+                batch_size //= 2
+                print(f"  ⚠️  Нехватка памяти, батч уменьшен до {batch_size}")
+                continue
+            texts = [e]
+        except Exception as e:
+            texts = [e] * len(group)
+        for i, text in zip(group, texts):
+            results[i] = text
+        start = group[-1] + 1
+    return results
@@ -4,17 +4,86 @@ Quick launcher for Combined FLUX + SAP pipeline
 Быстрый запуск с предустановленными конфигурациями
 """
 
+import os
 import sys
 import subprocess
 import argparse
 from pathlib import Path
 
+from generation_client import DEFAULT_SERVER_URL, GenerationClient
+
+# Предустановки (общие с generation_server.py)
+PRESETS = {
+    'compare': {"title": "Быстрое сравнение Direct vs SAP",
+                "mode": "both", "num_inference_steps": 30, "seeds": [30498]},
+    'direct-fast': {"title": "Direct FLUX - Быстро",
+                    "mode": "direct", "num_inference_steps": 20, "seeds": [30498]},
+    'direct-quality': {"title": "Direct FLUX - Качество",
+                       "mode": "direct", "num_inference_steps": 50, "seeds": [30498, 40123]},
+    'sap-quality': {"title": "SAP FLUX - Качество",
+                    "mode": "sap", "llm": "GPT", "num_inference_steps": 50, "seeds": [30498, 40123]},
+    'sap-fast': {"title": "SAP FLUX - Быстро",
+                 "mode": "sap", "llm": "Zephyr", "num_inference_steps": 30, "seeds": [30498]},
+    'full-compare': {"title": "Полное сравнение (Direct vs SAP с разными seeds)",
+                     "mode": "both", "num_inference_steps": 50, "seeds": [30498, 40123, 50456]},
+    'local-zephyr': {"title": "Локальная генерация (Zephyr, без API)",
+                     "mode": "sap", "llm": "Zephyr", "num_inference_steps": 40, "seeds": [30498]},
+    'experimental': {"title": "Экспериментальная (высокое качество)",
+                     "mode": "both", "num_inference_steps": 60, "seeds": [12345, 67890, 11111]},
+}
+
 def run_command(cmd):
     """Запускает команду в терминале"""
     print(f"🚀 Запуск: {' '.join(cmd)}")
     result = subprocess.run(cmd)
     return result.returncode
 
+def build_job(args) -> dict:
+    """Параметры задачи: предустановка + пользовательские параметры (перезаписывают ее)"""
+    job = {k: v for k, v in PRESETS.get(args.preset, {}).items() if k != "title"}
+    for key in ("mode", "llm", "seeds", "height", "width", "num_inference_steps"):
+        value = getattr(args, key)
+        if value:
+            job[key] = value
+    return job
+
+def build_command(job: dict, prompts_file: str) -> list:
+    """Команда combined_flux_sap.py (запуск без сервера)"""
+    cmd = ['python', 'combined_flux_sap.py']
+    for key in ("mode", "llm", "height", "width", "num_inference_steps"):
+        if key in job:
+            cmd.extend([f"--{key.replace('_', '-')}", str(job[key])])
+    if prompts_file != 'prompts.txt':
+        cmd.extend(['--prompts-file', prompts_file])
+    if job.get("seeds"):
+        cmd.append('--seeds')
+        cmd.extend(map(str, job["seeds"]))
+    return cmd
+
+def read_prompts(filepath: str) -> list:
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return [line.strip() for line in f if line.strip()]
+
+def run_on_server(client: GenerationClient, job: dict, wait: bool) -> int:
+    """Отправляет задачу на сервер генерации и (по умолчанию) ждет результата"""
+    job_id = client.submit(job)
+    print(f"📨 Задача поставлена в очередь: {job_id}")
+    if not wait:
+        print(f"💡 Статус: python quick_launch.py --status {job_id}")
+        return 0
+    try:
+        status = client.wait(job_id)
+    except KeyboardInterrupt:
+        client.cancel(job_id)
+        print(f"\n⛔ Задача {job_id} отменена")
+        return 130
+    if status["status"] == "failed":
+        print(f"❌ Задача завершилась с ошибкой: {status.get('error')}")
+        return 1
+    result = client.result(job_id)
+    print(f"📁 Результаты: {result['output_dir']} ({len(result['images'])} изображений)")
+    return 0 if status["status"] == "done" else 1
+
 def main():
     parser = argparse.ArgumentParser(
         description="Quick launcher for Combined FLUX + SAP",
@@ -39,14 +108,17 @@ def main():
 
 6. Пользовательские параметры:
    python quick_launch.py --mode sap --llm GPT --seeds 123 456 789
+
+Если запущен сервер генерации (python generation_server.py), задача
+отправляется в его очередь и модели не загружаются заново; иначе
+запускается combined_flux_sap.py.
         """
     )
     
     parser.add_argument(
         '--preset',
         type=str,
-        choices=['compare', 'direct-fast', 'direct-quality', 'sap-quality', 'sap-fast', 
-                 'full-compare', 'local-zephyr', 'experimental'],
+        choices=list(PRESETS),
         help='Предустановленная конфигурация'
     )
     
@@ -63,71 +135,48 @@ def main():
     parser.add_argument('--steps', type=int, dest='num_inference_steps',
                         help='Количество шагов дифузии')
     
-    args = parser.parse_args()
-    
-    # Базовая команда
-    cmd = ['python', 'combined_flux_sap.py']
-    
-    # Применение предустановок
-    if args.preset == 'compare':
-        print("⚙️  Предустановка: Быстрое сравнение Direct vs SAP")
-        cmd.extend(['--mode', 'both', '--num-inference-steps', '30', '--seeds', '30498'])
-    
-    elif args.preset == 'direct-fast':
-        print("⚙️  Предустановка: Direct FLUX - Быстро")
-        cmd.extend(['--mode', 'direct', '--num-inference-steps', '20', '--seeds', '30498'])
+    server = parser.add_argument_group("Сервер генерации")
+    server.add_argument('--server', type=str, default=DEFAULT_SERVER_URL,
+                        help='Адрес сервера генерации (SAP_SERVER_URL)')
+    server.add_argument('--socket', type=str, default=os.getenv("SAP_SERVER_SOCKET"),
+                        help='Unix-сокет сервера генерации (SAP_SERVER_SOCKET)')
+    server.add_argument('--no-server', action='store_true',
+                        help='Не использовать сервер, запустить combined_flux_sap.py')
+    server.add_argument('--no-wait', action='store_true',
+                        help='Только поставить задачу в очередь сервера')
+    server.add_argument('--status', type=str, metavar='JOB_ID',
+                        help='Показать статус задачи на сервере')
     
-    elif args.preset == 'direct-quality':
-        print("⚙️  Предустановка: Direct FLUX - Качество")
-        cmd.extend(['--mode', 'direct', '--num-inference-steps', '50', '--seeds', '30498', '40123'])
-    
-    elif args.preset == 'sap-quality':
-        print("⚙️  Предустановка: SAP FLUX - Качество")
-        cmd.extend(['--mode', 'sap', '--llm', 'GPT', '--num-inference-steps', '50', 
-                    '--seeds', '30498', '40123'])
-    
-    elif args.preset == 'sap-fast':
-        print("⚙️  Предустановка: SAP FLUX - Быстро")
-        cmd.extend(['--mode', 'sap', '--llm', 'Zephyr', '--num-inference-steps', '30', 
-                    '--seeds', '30498'])
-    
-    elif args.preset == 'full-compare':
-        print("⚙️  Предустановка: Полное сравнение (Direct vs SAP с разными seeds)")
-        cmd.extend(['--mode', 'both', '--num-inference-steps', '50', 
-                    '--seeds', '30498', '40123', '50456'])
-    
-    elif args.preset == 'local-zephyr':
-        print("⚙️  Предустановка: Локальная генерация (Zephyr, без API)")
-        cmd.extend(['--mode', 'sap', '--llm', 'Zephyr', '--num-inference-steps', '40',
-                    '--seeds', '30498'])
-    
-    elif args.preset == 'experimental':
-        print("⚙️  Предустановка: Экспериментальная (высокое качество)")
-        cmd.extend(['--mode', 'both', '--num-inference-steps', '60',
-                    '--seeds', '12345', '67890', '11111'])
-    
-    # Применение пользовательских параметров (перезаписывают предустановку)
-    if args.mode:
-        cmd.extend(['--mode', args.mode])
-    
-    if args.llm:
-        cmd.extend(['--llm', args.llm])
-    
-    if args.prompts_file != 'prompts.txt':
-        cmd.extend(['--prompts-file', args.prompts_file])
-    
-    if args.seeds:
-        cmd.append('--seeds')
-        cmd.extend(map(str, args.seeds))
-    
-    if args.height:
-        cmd.extend(['--height', str(args.height)])
-    
-    if args.width:
-        cmd.extend(['--width', str(args.width)])
+    args = parser.parse_args()
     
-    if args.num_inference_steps:
-        cmd.extend(['--num-inference-steps', str(args.num_inference_steps)])
+    if args.preset:
+        print(f"⚙️  Предустановка: {PRESETS[args.preset]['title']}")
+    job = build_job(args)
+    
+    client = GenerationClient(args.server, socket_path=args.socket)
+    if args.status:
+        try:
+            status = client.status(args.status)
+        except OSError:
+            print(f"❌ Сервер генерации не запущен: {args.socket or args.server}")
+            return 1
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            return 1
+        progress = status["progress"]
+        print(f"📋 {args.status}: {status['status']} ({progress['saved']}/{progress['total']} изображений)")
+        if status.get("error"):
+            print(f"❌ {status['error']}")
+        return 0
+    
+    if not args.no_server and client.is_available():
+        print(f"🖥️  Сервер генерации: {args.socket or args.server}")
+        job["prompts"] = read_prompts(args.prompts_file)
+        return run_on_server(client, job, wait=not args.no_wait)
+    if not args.no_server:
+        print("💡 Сервер генерации не запущен (python generation_server.py) - модели будут загружены заново")
+    
+    cmd = build_command(job, args.prompts_file)
     
     # Запуск команды
     return_code = run_command(cmd)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Request micro-batching
+Сборщик одновременных запросов в батчи: запросы копятся до максимального
+размера батча или до истечения времени ожидания первого запроса, затем
+выполняются одним вызовом, а результаты раздаются вызывающим
+"""
+
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import Any, Callable, Hashable, List, Optional
+
+
+class RequestBatcher:
+    """
+    Динамический микро-батчинг запросов из нескольких потоков.
+
+    run_batch(items) получает список запросов одной группы (batch_key) и
+    возвращает список результатов той же длины. Исключение батча передается
+    всем его запросам.
+    """
+
+    def __init__(
+        self,
+        run_batch: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = 4,
+        max_wait: float = 0.1,
+        batch_key: Optional[Callable[[Any], Hashable]] = None,
+        name: str = "request-batcher"
+    ):
+        """
+        Args:
+            run_batch: выполнение батча запросов
+            max_batch_size: максимальный размер батча
+            max_wait: сколько секунд первый запрос ждет попутчиков
+            batch_key: запросы с разными ключами не объединяются в батч
+            name: имя фонового потока
+        """
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batch_key = batch_key or (lambda item: None)
+        self._pending: deque = deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = {"batches": 0, "requests": 0}
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, item: Any) -> Future:
+        """Ставит запрос в очередь, результат - в Future"""
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Сборщик батчей остановлен")
+            self._pending.append((time.monotonic(), item, future))
+            self._cond.notify()
+        return future
+
+    def __call__(self, item: Any) -> Any:
+        """Блокирующий вызов: ставит запрос и ждет результат"""
+        return self.submit(item).result()
+
+    def _take_batch(self) -> List[tuple]:
+        """Ждет первый запрос, затем попутчиков с тем же ключом (не дольше max_wait)"""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return []
+            first_at, first, _ = self._pending[0]
+            key = self.batch_key(first)
+            deadline = first_at + self.max_wait
+            while not self._closed:
+                same = sum(1 for _, item, _ in self._pending if self.batch_key(item) == key)
+                remaining = deadline - time.monotonic()
+                if same >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(timeout=remaining)
+
+            batch, rest = [], deque()
+            for entry in self._pending:
+                if len(batch) < self.max_batch_size and self.batch_key(entry[1]) == key:
+                    batch.append(entry)
+                else:
+                    rest.append(entry)
+            self._pending = rest
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._take_batch()
+            if not batch:
+                return
+            # Отмененные до начала батча запросы не выполняются
+            batch = [entry for entry in batch if entry[2].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            try:
+                results = self.run_batch([item for _, item, _ in batch])
+                if len(results) != len(batch):
+                    raise RuntimeError(f"Батч из {len(batch)} запросов вернул {len(results)} результатов")
+                for (_, _, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            self.stats["batches"] += 1
+            self.stats["requests"] += len(batch)
+
+    def close(self):
+        """Выполняет оставшиеся запросы и останавливает поток"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
@@ -4,6 +4,7 @@ import argparse
 from pathlib import Path
 from SAP_pipeline_flux import SapFlux
 from llm_interface.llm_SAP import LLM_SAP
+from image_writer import ImageWriter
 BASE_FOLDER = os.getcwd()
 
 ################################
@@ -25,11 +26,17 @@ def load_model():
     model.enable_model_cpu_offload()
     return model
 
-def save_results(images, prompt, seeds_list):
+def save_results(images, prompt, seeds_list, writer=None):
     prompt_model_path = os.path.join(BASE_FOLDER, "results", prompt)
     Path(prompt_model_path).mkdir(parents=True, exist_ok=True)
+    # encode the per-seed images in parallel instead of one after another
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
     for i, seed in enumerate(seeds_list):
-        images[i].save(os.path.join(prompt_model_path, f"Seed{seed}.png"))
+        writer.submit(images[i], os.path.join(prompt_model_path, f"Seed{seed}.png"))
+    if own_writer:
+        writer.close()
 
 def generate_models_params(args, SAP_prompts):
     generators_lst = []
@@ -91,7 +91,8 @@ def generate_with_custom_sap(
     width=1024,
     seeds=None,
         device="cuda",
-        flux_version="1-dev"
+        flux_version="1-dev",
+        fast_decode=False
 ):
     """
     Генерирует изображения с использованием готовой SAP декомпозиции
@@ -104,6 +105,7 @@ def generate_with_custom_sap(
     - height, width: размер изображения
     - seeds: список seeds для воспроизводимости
     - device: cuda или cpu
+    - fast_decode: декодировать крошечным автоэнкодером TAEF1 (быстрые прогоны шагов переключения)
     """
     
     if seeds is None:
@@ -175,8 +177,7 @@ def generate_with_custom_sap(
                 return None
         
         # Генерируем изображения для каждого seed
-                print(f"\n📥 Загружаю FLUX модель (версия: {flux_version})...")
-        
+        results = []
         for seed_idx, seed in enumerate(seeds, 1):
             print(f"\n  [{seed_idx}/{len(seeds)}] Генерирую с seed={seed}...")
             
@@ -199,7 +200,8 @@ def generate_with_custom_sap(
                             "explanation": f"SAP decomposition for: {sap_data['original_prompt']}",
                             "prompts_list": sap_data["prompts_list"],
                             "switch_prompts_steps": sap_data["switch_prompts_steps"]
-                        }
+                        },
+                        decoder="tiny" if fast_decode else "vae"
                     )
                 else:
                     # Direct режим - используем оригинальный промт
@@ -341,6 +343,12 @@ def main():
         default='1-dev',
         help='Версия FLUX: 1-dev или 2-dev (default: 1-dev)'
     )
+    
+    parser.add_argument(
+        '--fast-decode',
+        action='store_true',
+        help='Декодировать крошечным автоэнкодером TAEF1 (быстрее, ниже качество)'
+    )
     args = parser.parse_args()
     
     # Показать список примеров
@@ -382,7 +390,8 @@ def main():
                 width=args.width,
                 seeds=seeds,
                 device=args.device,
-                flux_version=args.flux_version
+                flux_version=args.flux_version,
+                fast_decode=args.fast_decode
             )
             if result:
                 all_results.append(result)
@@ -402,7 +411,8 @@ def main():
             width=args.width,
             seeds=seeds,
             device=args.device,
-            flux_version=args.flux_version
+            flux_version=args.flux_version,
+            fast_decode=args.fast_decode
         )
         
         if result:
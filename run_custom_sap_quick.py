@@ -11,6 +11,8 @@ import torch
 from pathlib import Path
 from datetime import datetime
 
+from run_manifest import RunManifest, params_hash
+
 
 # 📋 ВАШ ГОТОВЫЙ СЛОВАРЬ С SAP ДЕКОМПОЗИЦИЯМИ
 CUSTOM_SAP = {
@@ -67,7 +69,8 @@ CUSTOM_SAP = {
 }
 
 
-def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
+def generate_sap_image(name, num_steps=50, num_images=1, seed=30498,
+                       run_dir="results_custom_sap", resume=True):
     """
     Генерирует одно изображение с SAP декомпозицией
     
@@ -76,6 +79,8 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
     - num_steps: количество шагов дифузии (20-100)
     - num_images: количество изображений (с разными seeds)
     - seed: начальный seed
+    - run_dir: директория результатов с журналом manifest.jsonl
+    - resume: пропускать изображения, уже отмеченные в журнале как готовые
     """
     
     if name not in CUSTOM_SAP:
@@ -92,6 +97,23 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
     print(f"  Переключения на шагах: {sap_data['switch_prompts_steps']}")
     print(f"  Шагов дифузии: {num_steps}")
     
+    # Журнал запуска: уже готовые seeds не перегенерируются
+    output_dir = Path(run_dir) / name
+    manifest = RunManifest(run_dir)
+    phash = params_hash({"mode": "custom_sap", "sap": sap_data, "num_steps": num_steps,
+                         "height": 1024, "width": 1024, "guidance_scale": 3.5})
+    all_seeds = [seed + i * 10000 for i in range(num_images)]
+    pending_seeds = manifest.pending_seeds("sap", name, all_seeds, phash) if resume else all_seeds
+    for current_seed in pending_seeds:
+        manifest.mark_pending("sap", name, current_seed, phash)
+    
+    if not pending_seeds:
+        print(f"\n✅ Все {num_images} изображений уже сгенерированы: {output_dir}/")
+        manifest.close()
+        return [str(output_dir / f"{name}_seed_{s}.png") for s in all_seeds]
+    if len(pending_seeds) < len(all_seeds):
+        print(f"  ⏭️  Уже готово: {len(all_seeds) - len(pending_seeds)}, осталось: {len(pending_seeds)}")
+    
     # Этап 1: Загрузка модели
     print(f"\n📥 Загружаю FLUX модель (это может занять время)...")
     
@@ -111,6 +133,7 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
         print(f"   Проверьте:")
         print(f"   - Установлены ли зависимости: pip install -r requirements.txt")
         print(f"   - Достаточно ли памяти на GPU (нужно минимум 16GB VRAM)")
+        manifest.close()
         return None
     
     # Этап 2: Загрузка SAP pipeline
@@ -134,17 +157,14 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
         use_sap = False
     
     # Этап 3: Генерирование изображений
-    print(f"\n🔄 Генерирую {num_images} изображение(й)...")
+    print(f"\n🔄 Генерирую {len(pending_seeds)} изображение(й)...")
     
-    output_dir = Path(f"results_custom_sap/{name}")
     output_dir.mkdir(parents=True, exist_ok=True)
     
     results = []
     
-    for i in range(num_images):
-        current_seed = seed + i * 10000
-        
-        print(f"  [{i+1}/{num_images}] Seed {current_seed}... ", end="", flush=True)
+    for i, current_seed in enumerate(pending_seeds):
+        print(f"  [{i+1}/{len(pending_seeds)}] Seed {current_seed}... ", end="", flush=True)
         
         try:
             # Создаём генератор с правильным device
@@ -197,6 +217,7 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
             filename = f"{name}_seed_{current_seed}.png"
             filepath = output_dir / filename
             image.save(filepath)
+            manifest.mark_done("sap", name, current_seed, phash, str(filepath))
             
             print(f"✅ Сохранено: {filename}")
             results.append(str(filepath))
@@ -209,6 +230,8 @@ def generate_sap_image(name, num_steps=50, num_images=1, seed=30498):
             print(f"❌ Ошибка: {e}")
             continue
     
+    manifest.close()
+    
     print(f"\n✅ Генерирование завершено!")
     print(f"   Результаты в: {output_dir}/")
     print(f"   Всего изображений: {len(results)}")
@@ -12,6 +12,10 @@ import argparse
 from pathlib import Path
 from datetime import datetime
 
+from image_writer import ImageWriter, add_image_writer_arguments
+from run_manifest import RunManifest, params_hash
+from generation_cache import GenerationCache, add_generation_cache_arguments, make_cache_key, model_fingerprint
+
 # Примеры для генерирования
 EXAMPLES = {
     "grown_man": "A grown man wearing a pacifier",
@@ -28,7 +32,12 @@ def generate_flux_direct(
     height=1024,
     width=1024,
     seeds=None,
-    num_seeds=4
+    num_seeds=4,
+    flux_version="1-dev",
+    writer=None,
+    run_dir="results_flux_direct",
+    resume=True,
+    cache=None
 ):
     """
     Генерирует изображения с Direct FLUX для всех примеров
@@ -38,11 +47,66 @@ def generate_flux_direct(
     - height, width: размер изображения
     - seeds: список seed'ов (если None, будут сгенерированы)
     - num_seeds: количество seed'ов для каждого примера
+    - flux_version: версия FLUX (1-dev или 2-dev)
+    - writer: фоновый пул записи ImageWriter (если None, создается PNG по умолчанию)
+    - run_dir: директория результатов с журналом manifest.jsonl
+    - resume: пропускать изображения, уже отмеченные в журнале как готовые
+    - cache: кэш результатов GenerationCache (общий с combined_flux_sap.py)
     """
     
     if seeds is None:
         seeds = [30498 + i * 1000 for i in range(num_seeds)]
     
+    # Журнал запуска: повторный запуск догенерирует только недостающее
+    own_writer = writer is None
+    if own_writer:
+        writer = ImageWriter()
+    manifest = RunManifest(run_dir)
+    phash = params_hash({
+        "mode": "direct",
+        "flux_version": flux_version,
+        "num_steps": num_steps,
+        "height": height,
+        "width": width,
+        "guidance_scale": 3.5,
+        "extension": writer.extension
+    })
+    pending = {}
+    for name, prompt in EXAMPLES.items():
+        pending[name] = manifest.pending_seeds("direct", prompt, seeds, phash) if resume else list(seeds)
+        for seed in pending[name]:
+            manifest.mark_pending("direct", prompt, seed, phash)
+    
+    # Кэш результатов: ключ совпадает с Direct режимом combined_flux_sap.py
+    # (одностадийное SAP расписание исходного промта)
+    model_repo = f"black-forest-labs/FLUX.{flux_version}"
+    fingerprint = model_fingerprint(model_repo, torch.bfloat16) if cache is not None else ""
+    gen_device = "cuda" if torch.cuda.is_available() else "cpu"
+    cache_params = {"height": height, "width": width, "num_inference_steps": num_steps,
+                    "guidance_scale": 3.5, "generator_device": gen_device}
+    
+    def cache_key(prompt, seed):
+        return make_cache_key(fingerprint, {"prompts_list": [prompt], "switch_prompts_steps": []}, seed, cache_params)
+    
+    from_cache = 0
+    if cache is not None:
+        for name, prompt in EXAMPLES.items():
+            misses = []
+            for seed in pending[name]:
+                image = cache.get(cache_key(prompt, seed))
+                if image is None:
+                    misses.append(seed)
+                    continue
+                output_dir = Path(run_dir) / name
+                output_dir.mkdir(parents=True, exist_ok=True)
+                writer.submit(
+                    image, output_dir / f"{name}_seed_{seed}.png",
+                    on_written=lambda path, p=prompt, sd=seed: manifest.mark_done("direct", p, sd, phash, path)
+                )
+                from_cache += 1
+            pending[name] = misses
+    num_pending = sum(len(v) for v in pending.values())
+    
     print(f"\n{'='*80}")
     print(f"🎨 FLUX Direct Generation")
     print(f"{'='*80}")
@@ -51,22 +115,27 @@ def generate_flux_direct(
     print(f"  Шагов дифузии: {num_steps}")
     print(f"  Размер: {height}x{width}")
     print(f"  Всего изображений: {len(EXAMPLES) * len(seeds)}")
+    if from_cache:
+        print(f"  Взято из кэша: {from_cache}")
+    print(f"  Осталось сгенерировать: {num_pending}")
+    
+    if num_pending == 0:
+        print(f"\n✅ Все изображения уже сгенерированы: {run_dir}/")
+        if own_writer:
+            writer.close()
+        else:
+            writer.flush()
+        manifest.close()
+        return
     
     # Загружаем FLUX
     print(f"\n📥 Загружаю FLUX модель...")
     try:
         from diffusers import FluxPipeline
         pipeline = FluxPipeline.from_pretrained(
-            parser = argparse.ArgumentParser()
-            parser.add_argument('--flux-version', type=str, default='1-dev', help='Версия FLUX: 1-dev или 2-dev')
-            # ...добавьте остальные аргументы, если нужно...
-            args = parser.parse_args()
-
-            model_repo = f"black-forest-labs/FLUX.{args.flux_version}"
-            pipeline = FluxPipeline.from_pretrained(
-                model_repo,
-                torch_dtype=torch.bfloat16
-            )
+            model_repo,
+            torch_dtype=torch.bfloat16
+        )
         pipeline = pipeline.to("cuda")
         # Оптимизируем для памяти
         pipeline.enable_attention_slicing()
@@ -74,6 +143,11 @@ def generate_flux_direct(
         
     except Exception as e:
         print(f"❌ Ошибка при загрузке FLUX: {e}")
+        if own_writer:
+            writer.close()
+        else:
+            writer.flush()
+        manifest.close()
         return
     
     # Генерируем для каждого примера
@@ -85,18 +159,22 @@ def generate_flux_direct(
         print(f"[{example_idx}/{len(EXAMPLES)}] 🎨 {name.upper()}")
         print(f"{'─'*80}")
         print(f"  Промт: {prompt}")
-        print(f"  Генерирую {len(seeds)} изображений...")
+        
+        example_seeds = pending[name]
+        if not example_seeds:
+            print(f"  ⏭️  Все {len(seeds)} изображений уже готовы, пропускаю")
+            continue
+        print(f"  Генерирую {len(example_seeds)} изображений...")
         
         # Создаём директорию для результатов
-        output_dir = Path(f"results_flux_direct/{name}")
+        output_dir = Path(run_dir) / name
         output_dir.mkdir(parents=True, exist_ok=True)
         
-        for seed_idx, seed in enumerate(seeds, 1):
+        for seed_idx, seed in enumerate(example_seeds, 1):
             try:
-                print(f"    [{seed_idx}/{len(seeds)}] Seed {seed}... ", end="", flush=True)
+                print(f"    [{seed_idx}/{len(example_seeds)}] Seed {seed}... ", end="", flush=True)
                 
                 # Создаём генератор
-                gen_device = "cuda" if torch.cuda.is_available() else "cpu"
                 generator = torch.Generator(device=gen_device)
                 generator.manual_seed(seed)
                 
@@ -112,31 +190,45 @@ def generate_flux_direct(
                 
                 # Сохраняем
                 image = output.images[0]
-                filename = f"{name}_seed_{seed}.png"
-                filepath = output_dir / filename
-                image.save(filepath)
+                if cache is not None:
+                    cache.put(cache_key(prompt, seed), image, metadata={
+                        "model": fingerprint, "prompt": prompt, "seed": seed, "params": cache_params
+                    })
+                filepath = writer.output_path(output_dir / f"{name}_seed_{seed}.png")
+                writer.submit(
+                    image, filepath,
+                    on_written=lambda path, p=prompt, sd=seed: manifest.mark_done("direct", p, sd, phash, path)
+                )
                 
-                print(f"✅ {filename}")
+                print(f"✅ {Path(filepath).name}")
                 total_generated += 1
                 
             except Exception as e:
                 print(f"❌ Ошибка: {str(e)[:50]}")
                 failed.append((name, seed, str(e)))
         
-        print(f"  ✅ Завершено: {len(seeds)} изображений в {output_dir}")
+        print(f"  ✅ Завершено: {len(example_seeds)} изображений в {output_dir}")
+    
+    if own_writer:
+        writer.close()
+    else:
+        writer.flush()
+    manifest.close()
     
     # Итоги
     print(f"\n{'='*80}")
     print(f"📊 ИТОГИ ГЕНЕРИРОВАНИЯ")
     print(f"{'='*80}")
     print(f"  ✅ Успешно: {total_generated} изображений")
+    if cache is not None:
+        cache.print_stats()
     if failed:
         print(f"  ❌ Ошибок: {len(failed)}")
         for name, seed, error in failed[:5]:
             print(f"     - {name} (seed {seed}): {error[:40]}")
     else:
         print(f"  ❌ Ошибок: 0")
-    print(f"  📁 Результаты: results_flux_direct/")
+    print(f"  📁 Результаты: {run_dir}/")
     print(f"{'='*80}\n")
 
 if __name__ == "__main__":
@@ -147,12 +239,25 @@ if __name__ == "__main__":
     parser.add_argument("--num-seeds", type=int, default=4, help="Seed'ов на пример")
     parser.add_argument("--height", type=int, default=1024, help="Высота изображения")
     parser.add_argument("--width", type=int, default=1024, help="Ширина изображения")
+    parser.add_argument("--flux-version", type=str, default="1-dev", help="Версия FLUX: 1-dev или 2-dev")
+    parser.add_argument("--run-dir", type=str, default="results_flux_direct",
+                        help="Директория результатов (с журналом manifest.jsonl для продолжения)")
+    parser.add_argument("--overwrite", action="store_true",
+                        help="Перегенерировать все изображения, игнорируя журнал")
+    add_image_writer_arguments(parser)
+    add_generation_cache_arguments(parser)
     
     args = parser.parse_args()
     
-    generate_flux_direct(
-        num_steps=args.num_steps,
-        height=args.height,
-        width=args.width,
-        num_seeds=args.num_seeds
-    )
+    with ImageWriter.from_args(args) as writer:
+        generate_flux_direct(
+            num_steps=args.num_steps,
+            height=args.height,
+            width=args.width,
+            num_seeds=args.num_seeds,
+            flux_version=args.flux_version,
+            writer=writer,
+            run_dir=args.run_dir,
+            resume=not args.overwrite,
+            cache=GenerationCache.from_args(args)
+        )
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+"""
+Resumable run manifest
+Журнал единиц работы (режим, промт, seed, хэш параметров) в директории
+запуска: позволяет после падения или изменения промтов догенерировать
+только недостающие изображения
+"""
+
+import os
+import json
+import hashlib
+import threading
+from pathlib import Path
+from datetime import datetime
+from typing import Dict, List, Optional
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+
+def params_hash(params: Dict) -> str:
+    """Стабильный короткий хэш параметров генерации"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def unit_key(mode: str, prompt: str, seed: int, phash: str) -> str:
+    """Ключ единицы работы"""
+    payload = json.dumps([mode, prompt, int(seed), phash], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class RunManifest:
+    """
+    Журнал единиц работы в формате JSON Lines.
+
+    Каждое изменение статуса - одна дописанная строка (с fsync), поэтому
+    запись атомарна на уровне единицы работы: после падения недописанная
+    последняя строка просто игнорируется. При открытии журнал сжимается до
+    последнего состояния каждой единицы.
+    """
+
+    def __init__(self, run_dir: str, filename: str = MANIFEST_FILENAME):
+        """
+        Args:
+            run_dir: постоянная директория запуска
+            filename: имя файла журнала внутри run_dir
+        """
+        self.run_dir = str(run_dir)
+        Path(self.run_dir).mkdir(parents=True, exist_ok=True)
+        self.path = os.path.join(self.run_dir, filename)
+        self.units: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._load()
+        self._compact()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def _load(self):
+        """Восстанавливает состояние из журнала"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # Недописанная строка после падения
+                    continue
+                self.units[record["key"]] = record
+
+    def _compact(self):
+        """Атомарно переписывает журнал, оставляя последнюю запись каждой единицы"""
+        if not self.units:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.units.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+
+    def _append(self, record: Dict):
+        record["updated_at"] = datetime.now().isoformat()
+        self.units[record["key"]] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def is_done(self, key: str) -> bool:
+        """Единица выполнена и ее файл существует"""
+        with self._lock:
+            record = self.units.get(key)
+        if record is None or record.get("status") != "done":
+            return False
+        return os.path.exists(os.path.join(self.run_dir, record["output"]))
+
+    def pending_seeds(self, mode: str, prompt: str, seeds: List[int], phash: str) -> List[int]:
+        """Seeds промта, которые еще нужно сгенерировать"""
+        return [seed for seed in seeds if not self.is_done(unit_key(mode, prompt, seed, phash))]
+
+    def mark_pending(self, mode: str, prompt: str, seed: int, phash: str) -> str:
+        """Регистрирует единицу работы (если она еще не выполнена)"""
+        key = unit_key(mode, prompt, seed, phash)
+        if self.is_done(key):
+            return key
+        with self._lock:
+            if self.units.get(key, {}).get("status") == "pending":
+                return key
+            self._append({
+                "key": key,
+                "mode": mode,
+                "prompt": prompt,
+                "seed": int(seed),
+                "params_hash": phash,
+                "status": "pending",
+                "output": None
+            })
+        return key
+
+    def mark_done(self, mode: str, prompt: str, seed: int, phash: str, output_path: str, **extra):
+        """Отмечает единицу выполненной (вызывать после записи файла на диск)"""
+        key = unit_key(mode, prompt, seed, phash)
+        with self._lock:
+            record = {
+                "key": key,
+                "mode": mode,
+                "prompt": prompt,
+                "seed": int(seed),
+                "params_hash": phash,
+                "status": "done",
+                "output": os.path.relpath(output_path, self.run_dir)
+            }
+            record.update(extra)
+            self._append(record)
+
+    def summary(self) -> Dict[str, int]:
+        """Количество единиц по статусам"""
+        with self._lock:
+            records = list(self.units.values())
+        counts = {"pending": 0, "done": 0}
+        for record in records:
+            counts[record.get("status", "pending")] = counts.get(record.get("status", "pending"), 0) + 1
+        return counts
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Sharded execution
+Детерминированное разбиение единиц работы (режим, промт, seed) между
+задачами SLURM array (или --num-shards/--shard-index) с балансировкой по
+оценке стоимости, и слияние результатов шардов в одно дерево с проверкой
+полноты
+"""
+
+import os
+import sys
+import json
+import heapq
+import shutil
+import hashlib
+import argparse
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+from run_manifest import MANIFEST_FILENAME, RunManifest, unit_key
+
+SHARD_FILENAME = "shard.json"
+MERGED_DIRNAME = "merged"
+
+# Стоимость LLM декомпозиции в эквиваленте шагов дифузии 1024x1024
+SAP_DECOMPOSITION_COST = 5.0
+
+
+def resolve_shard(num_shards: Optional[int] = None, shard_index: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Определяет (количество шардов, индекс шарда).
+
+    Явные аргументы имеют приоритет; иначе используются переменные
+    SLURM array (SLURM_ARRAY_TASK_COUNT, SLURM_ARRAY_TASK_ID,
+    SLURM_ARRAY_TASK_MIN). Без них - один шард.
+    """
+    if num_shards is None and "SLURM_ARRAY_TASK_COUNT" in os.environ:
+        num_shards = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    if shard_index is None and "SLURM_ARRAY_TASK_ID" in os.environ:
+        shard_index = int(os.environ["SLURM_ARRAY_TASK_ID"]) - int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+
+    num_shards = num_shards or 1
+    shard_index = shard_index or 0
+    if not 0 <= shard_index < num_shards:
+        raise ValueError(f"Индекс шарда {shard_index} вне диапазона [0, {num_shards})")
+    return num_shards, shard_index
+
+
+def shard_dir_name(shard_index: int, num_shards: int) -> str:
+    return f"shard_{shard_index:04d}_of_{num_shards:04d}"
+
+
+def sharded_run_dir(output_dir: str, run_dir: Optional[str] = None) -> str:
+    """
+    Общая директория запуска для всех шардов.
+
+    Задачи массива стартуют в разное время, поэтому директория с временной
+    меткой не подходит: используется --run-dir или идентификатор массива.
+    """
+    if run_dir:
+        return run_dir
+    job_id = os.environ.get("SLURM_ARRAY_JOB_ID", "local")
+    return os.path.join(output_dir, f"sharded_{job_id}")
+
+
+def estimate_generation_cost(height: int, width: int, num_inference_steps: int, mode: str = "direct") -> float:
+    """Оценка стоимости одного изображения в шагах дифузии 1024x1024"""
+    cost = num_inference_steps * (height * width) / (1024 * 1024)
+    if mode == "sap":
+        cost += SAP_DECOMPOSITION_COST
+    return cost
+
+
+def make_unit(mode: str, prompt: str, seed: int, phash: str, cost: float = 1.0, group: Optional[str] = None) -> Dict:
+    """
+    Единица работы.
+
+    Единицы с одинаковой группой всегда попадают в один шард (например,
+    все seeds промта, чтобы не повторять LLM декомпозицию и не терять батч).
+    """
+    return {
+        "key": unit_key(mode, prompt, seed, phash),
+        "mode": mode,
+        "prompt": prompt,
+        "seed": int(seed),
+        "params_hash": phash,
+        "cost": cost,
+        "group": group if group is not None else f"{mode}|{prompt}|{seed}"
+    }
+
+
+def partition_units(units: List[Dict], num_shards: int) -> List[List[Dict]]:
+    """
+    Детерминированно разбивает единицы на шарды с балансировкой по стоимости.
+
+    Группы распределяются жадно (LPT): по убыванию стоимости, каждая - в
+    наименее загруженный шард. Порядок при равной стоимости задается ключом
+    группы, поэтому все задачи массива получают одно и то же разбиение.
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for unit in units:
+        groups.setdefault(unit["group"], []).append(unit)
+    order = sorted(groups.items(), key=lambda kv: (-sum(u["cost"] for u in kv[1]), kv[0]))
+
+    shards: List[List[Dict]] = [[] for _ in range(num_shards)]
+    loads = [(0.0, i) for i in range(num_shards)]
+    heapq.heapify(loads)
+    for _, group_units in order:
+        load, index = heapq.heappop(loads)
+        shards[index].extend(group_units)
+        heapq.heappush(loads, (load + sum(u["cost"] for u in group_units), index))
+    return shards
+
+
+def plan_hash(units: List[Dict]) -> str:
+    """Хэш полного плана (одинаков во всех шардах одного запуска)"""
+    payload = json.dumps(sorted(u["key"] for u in units))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def select_shard(units: List[Dict], num_shards: int, shard_index: int, shard_dir: str) -> List[Dict]:
+    """
+    Возвращает единицы текущего шарда и записывает план шарда в shard.json.
+    """
+    shards = partition_units(units, num_shards)
+    owned = shards[shard_index]
+    Path(shard_dir).mkdir(parents=True, exist_ok=True)
+    info = {
+        "shard_index": shard_index,
+        "num_shards": num_shards,
+        "plan_hash": plan_hash(units),
+        "total_units": len(units),
+        "estimated_cost": round(sum(u["cost"] for u in owned), 3),
+        "units": [{k: u[k] for k in ("key", "mode", "prompt", "seed")} for u in owned]
+    }
+    tmp_path = os.path.join(shard_dir, SHARD_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, os.path.join(shard_dir, SHARD_FILENAME))
+
+    loads = [round(sum(u["cost"] for u in shard), 1) for shard in shards]
+    print(f"🧩 Шард {shard_index + 1}/{num_shards}: {len(owned)}/{len(units)} единиц работы "
+          f"(оценка нагрузки по шардам: min {min(loads)}, max {max(loads)})")
+    return owned
+
+
+def _link_or_copy(src: str, dst: str):
+    Path(os.path.dirname(dst)).mkdir(parents=True, exist_ok=True)
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def _merge_text(paths: List[str], dst: str):
+    """Сливает метаданные шардов: JSON словари объединяются, текст - по уникальным строкам"""
+    contents = [Path(p).read_text(encoding="utf-8") for p in paths]
+    if len(set(contents)) == 1:
+        merged = contents[0]
+    elif dst.endswith(".json"):
+        data = {}
+        for content in contents:
+            data.update(json.loads(content))
+        merged = json.dumps(data, ensure_ascii=False, indent=2)
+    else:
+        lines = []
+        for content in contents:
+            lines.extend(line for line in content.splitlines() if line not in lines)
+        merged = "\n".join(lines) + "\n"
+    Path(os.path.dirname(dst)).mkdir(parents=True, exist_ok=True)
+    Path(dst).write_text(merged, encoding="utf-8")
+
+
+def merge_shards(run_dir: str, output_dir: Optional[str] = None) -> Dict:
+    """
+    Сливает результаты шардов в одно дерево и проверяет полноту.
+
+    Изображения переносятся жесткими ссылками (или копируются) с теми же
+    относительными путями, метаданные сливаются, в итоговой директории
+    создается общий manifest.jsonl.
+
+    Returns:
+        Отчет: количество единиц, недостающие единицы, ошибки плана
+    """
+    output_dir = output_dir or os.path.join(run_dir, MERGED_DIRNAME)
+    shard_dirs = sorted(
+        str(p.parent) for p in Path(run_dir).glob(f"shard_*/{SHARD_FILENAME}")
+    )
+    if not shard_dirs:
+        raise FileNotFoundError(f"В {run_dir} не найдено ни одного шарда ({SHARD_FILENAME})")
+
+    infos = []
+    for shard_dir in shard_dirs:
+        with open(os.path.join(shard_dir, SHARD_FILENAME), "r", encoding="utf-8") as f:
+            infos.append((shard_dir, json.load(f)))
+
+    errors = []
+    num_shards = infos[0][1]["num_shards"]
+    if len({info["plan_hash"] for _, info in infos}) > 1:
+        errors.append("Шарды принадлежат разным планам (plan_hash отличается)")
+    present = {info["shard_index"] for _, info in infos}
+    missing_shards = sorted(set(range(num_shards)) - present)
+    if missing_shards:
+        errors.append(f"Нет шардов: {missing_shards}")
+
+    merged_manifest = RunManifest(output_dir)
+    expected, done, missing = 0, 0, []
+    text_files: Dict[str, List[str]] = {}
+    for shard_dir, info in infos:
+        manifest = RunManifest(shard_dir)
+        for unit in info["units"]:
+            expected += 1
+            record = manifest.units.get(unit["key"])
+            if record is None or not manifest.is_done(unit["key"]):
+                missing.append(unit)
+                continue
+            relative = record["output"]
+            _link_or_copy(os.path.join(shard_dir, relative), os.path.join(output_dir, relative))
+            merged_manifest.mark_done(
+                record["mode"], record["prompt"], record["seed"], record["params_hash"],
+                os.path.join(output_dir, relative), shard=info["shard_index"]
+            )
+            done += 1
+        manifest.close()
+
+        # Метаданные и прочие файлы шарда (кроме изображений и служебных)
+        outputs = {r["output"] for r in manifest.units.values() if r.get("output")}
+        for path in Path(shard_dir).rglob("*"):
+            relative = os.path.relpath(path, shard_dir)
+            if path.is_file() and relative not in outputs and path.name not in (SHARD_FILENAME, MANIFEST_FILENAME) \
+                    and not path.name.endswith(".tmp"):
+                text_files.setdefault(relative, []).append(str(path))
+    merged_manifest.close()
+
+    for relative, paths in text_files.items():
+        try:
+            _merge_text(paths, os.path.join(output_dir, relative))
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            _link_or_copy(paths[0], os.path.join(output_dir, relative))
+
+    if infos and expected != infos[0][1]["total_units"] and not missing_shards:
+        errors.append(f"Шарды покрывают {expected} единиц из {infos[0][1]['total_units']}")
+
+    report = {
+        "num_shards": num_shards,
+        "shards_found": len(infos),
+        "total_units": infos[0][1]["total_units"],
+        "done": done,
+        "missing": [{k: u[k] for k in ("mode", "prompt", "seed")} for u in missing],
+        "errors": errors,
+        "complete": not errors and not missing and done == infos[0][1]["total_units"]
+    }
+    with open(os.path.join(output_dir, "merge_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return report
+
+
+def add_sharding_arguments(parser):
+    """Добавляет в argparse параметры шардирования"""
+    group = parser.add_argument_group("Шардирование")
+    group.add_argument(
+        '--num-shards',
+        type=int,
+        default=None,
+        help='Количество шардов (по умолчанию SLURM_ARRAY_TASK_COUNT или 1)'
+    )
+    group.add_argument(
+        '--shard-index',
+        type=int,
+        default=None,
+        help='Индекс шарда с 0 (по умолчанию SLURM_ARRAY_TASK_ID - SLURM_ARRAY_TASK_MIN)'
+    )
+    return parser
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Слияние результатов шардов")
+    parser.add_argument("run_dir", type=str, help="Общая директория запуска с поддиректориями shard_*")
+    parser.add_argument("--output-dir", type=str, default=None,
+                        help=f"Итоговая директория (по умолчанию <run_dir>/{MERGED_DIRNAME})")
+    args = parser.parse_args()
+
+    report = merge_shards(args.run_dir, args.output_dir)
+    print(f"🧩 Шардов: {report['shards_found']}/{report['num_shards']}, "
+          f"изображений: {report['done']}/{report['total_units']}")
+    for error in report["errors"]:
+        print(f"❌ {error}")
+    for unit in report["missing"][:20]:
+        print(f"  ⚠️  Нет результата: [{unit['mode']}] {unit['prompt']} (seed {unit['seed']})")
+    if report["complete"]:
+        print("✅ Все шарды завершены, результаты объединены")
+    else:
+        print("❌ Результаты неполные: перезапустите недостающие задачи массива")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+=============================================================================
+                ТЕСТИРОВАНИЕ GPT ДЕКОМПОЗИЦИИ ЧАНКАМИ
+=============================================================================
+
+Проверяет LLM_SAP_batch_gpt на локальном mock сервере (без ключа и сети):
+порядок результатов при параллельных чанках, повторы 429 с Retry-After,
+резервные декомпозиции и общий срок чанка
+"""
+
+import sys
+import time
+import threading
+
+from llm_interface.llm_SAP import LLM_SAP_batch_gpt
+from llm_interface.mock_openai_server import MockOpenAIServer
+from llm_interface.openai_client import get_client
+
+PROMPTS = [f"a {animal} riding a bicycle number {i}" for i, animal in
+           enumerate(["bear", "cat", "horse", "penguin", "fox", "owl"] * 5)]
+
+
+def start_server(**kwargs):
+    """Mock сервер на свободном порту (у каждого теста свой клиент и метрики)"""
+    server = MockOpenAIServer(("127.0.0.1", 0), stream_delay=0.0, **kwargs)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def check_order(results):
+    wrong = [i for i, result in enumerate(results) if result is None or result["prompts_list"] != [PROMPTS[i]]]
+    if wrong:
+        print(f"❌ Результаты не совпадают с промтами: {wrong}")
+        return False
+    return True
+
+
+def test_chunk_order():
+    """Тест 1: Порядок результатов при параллельных чанках"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 1: ПОРЯДОК РЕЗУЛЬТАТОВ ЧАНКОВ")
+    print("=" * 70)
+
+    server = start_server(delay=0.05)
+    try:
+        results = LLM_SAP_batch_gpt(PROMPTS, "test-key", base_url=server.base_url, token_budget=1200,
+                                    max_concurrency=4)
+    finally:
+        server.shutdown()
+
+    if server.requests_served < 2:
+        print(f"❌ Ожидалось несколько чанков, запросов: {server.requests_served}")
+        return False
+    if not check_order(results):
+        return False
+    print(f"✅ {len(results)} декомпозиций в порядке входа ({server.requests_served} чанков)")
+    return True
+
+
+def test_rate_limit_retry():
+    """Тест 2: Повтор 429 с паузой Retry-After"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 2: 429 И RETRY-AFTER")
+    print("=" * 70)
+
+    retry_after = 0.3
+    server = start_server(rate_limit_every=2, retry_after=retry_after)
+    try:
+        start = time.perf_counter()
+        results = LLM_SAP_batch_gpt(PROMPTS[:4], "test-key", base_url=server.base_url, token_budget=400,
+                                    max_concurrency=1)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    metrics = get_client(server.base_url).metrics.summary()
+    if metrics["retries"] == 0 or metrics["status"].get("429", 0) == 0:
+        print(f"❌ Повторов после 429 не было: {metrics}")
+        return False
+    if elapsed < retry_after * metrics["retries"]:
+        print(f"❌ Пауза Retry-After не соблюдена: {elapsed:.2f} с на {metrics['retries']} повторов")
+        return False
+    if not check_order(results) or any(r.get("source") == "fallback" for r in results):
+        print("❌ После повторов остались резервные декомпозиции")
+        return False
+    print(f"✅ {metrics['retries']} повторов после 429, все декомпозиции получены ({elapsed:.2f} с)")
+    return True
+
+
+def test_fallback():
+    """Тест 3: Резервные декомпозиции, если сервер не отвечает"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 3: РЕЗЕРВНЫЕ ДЕКОМПОЗИЦИИ")
+    print("=" * 70)
+
+    server = start_server(fail_rate=1.0)
+    try:
+        results = LLM_SAP_batch_gpt(PROMPTS[:3], "test-key", base_url=server.base_url, max_retries=0)
+    finally:
+        server.shutdown()
+
+    if len(results) != 3 or any(r.get("source") != "fallback" for r in results):
+        print(f"❌ Ожидались 3 резервные декомпозиции: {results}")
+        return False
+    print("✅ Промты неудачного чанка получили резервные декомпозиции")
+    return True
+
+
+def test_chunk_deadline():
+    """Тест 4: Общий срок чанка ограничивает повторы"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 4: СРОК ЧАНКА")
+    print("=" * 70)
+
+    deadline = 1.0
+    server = start_server(rate_limit_every=1, retry_after=0.4)
+    try:
+        start = time.perf_counter()
+        results = LLM_SAP_batch_gpt(PROMPTS[:2], "test-key", base_url=server.base_url, max_retries=50,
+                                    deadline=deadline)
+        elapsed = time.perf_counter() - start
+    finally:
+        server.shutdown()
+
+    if elapsed > deadline + 0.5:
+        print(f"❌ Чанк повторялся {elapsed:.2f} с при сроке {deadline} с")
+        return False
+    if any(r.get("source") != "fallback" for r in results):
+        print("❌ Ожидались резервные декомпозиции после истечения срока")
+        return False
+    print(f"✅ Чанк остановлен через {elapsed:.2f} с (срок {deadline} с, {server.requests_served} попыток)")
+    return True
+
+
+def main():
+    """Главная функция тестирования"""
+    tests = [
+        ("Порядок чанков", test_chunk_order),
+        ("429 и Retry-After", test_rate_limit_retry),
+        ("Резервные декомпозиции", test_fallback),
+        ("Срок чанка", test_chunk_deadline),
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        try:
+            results.append((test_name, test_func()))
+        except Exception as e:
+            print(f"\n❌ Исключение в тесте '{test_name}': {e}")
+            import traceback
+            traceback.print_exc()
+            results.append((test_name, False))
+
+    print("\n" + "=" * 70)
+    print("ФИНАЛЬНЫЙ ОТЧЕТ")
+    print("=" * 70)
+    for test_name, result in results:
+        status = "✅ PASS" if result else "❌ FAIL"
+        print(f"{status:<10} - {test_name}")
+
+    passed = sum(1 for _, result in results if result)
+    print("-" * 70)
+    print(f"Результат: {passed}/{len(results)} тестов пройдено")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""
+=============================================================================
+                    ТЕСТИРОВАНИЕ ПУЛА ВОРКЕРОВ
+=============================================================================
+
+Проверяет worker_pool.WorkerPool на нескольких CPU воркерах: генерацию
+combined_flux_sap на маленькой FLUX модели (нужны torch и diffusers) и
+повтор задач упавшего воркера на игрушечной "модели" без весов
+"""
+
+import os
+import sys
+import time
+import queue
+import tempfile
+from functools import partial
+
+from worker_pool import WorkerPool
+
+NUM_WORKERS = 2
+MAX_BATCH_SIZE = 4
+# Маленькая FLUX модель со случайными весами для проверки на CPU
+TINY_FLUX_REPO = os.getenv("SAP_TEST_FLUX_REPO", "hf-internal-testing/tiny-flux-pipe")
+FLUX_SIZE = 32
+FLUX_STEPS = 3
+
+
+def load_toy_pipeline(device):
+    """Игрушечная реплика: множитель вместо весов"""
+    return {"device": device, "factor": 2}
+
+
+def run_toy_batch(pipeline, tasks, device):
+    """Батч задач: значение * множитель, размер батча и pid воркера"""
+    for task in tasks:
+        marker = task.get("crash_marker")
+        if marker and not os.path.exists(marker):
+            # Первая попытка падает вместе с процессом воркера
+            open(marker, "w").close()
+            os._exit(1)
+    # Пока воркер занят, в общей очереди накапливаются задачи следующего батча
+    time.sleep(0.1)
+    return [
+        {"value": task["value"] * pipeline["factor"], "batch_size": len(tasks), "key": task["key"], "pid": os.getpid()}
+        for task in tasks
+    ]
+
+
+def toy_batch_key(task):
+    return task["key"]
+
+
+def make_tasks(count, crash_marker=None):
+    tasks = [{"value": i, "key": i % 2} for i in range(count)]
+    if crash_marker:
+        tasks[count // 2]["crash_marker"] = crash_marker
+    return tasks
+
+
+def make_pool():
+    return WorkerPool(load_toy_pipeline, run_toy_batch, devices=["cpu"] * NUM_WORKERS,
+                      max_batch_size=MAX_BATCH_SIZE, batch_key=toy_batch_key)
+
+
+def flux_pool_tasks():
+    """Задачи пула с разными расписаниями и seeds (как в generate_pooled)"""
+    schedules = [
+        {"prompts_list": ["a red cube"], "switch_prompts_steps": []},
+        {"prompts_list": ["a blue sphere", "a blue sphere on a table"], "switch_prompts_steps": [1]},
+        {"prompts_list": ["a cat", "a cat", "a cat wearing a hat"], "switch_prompts_steps": [1, 2]},
+        {"prompts_list": ["a red cube"], "switch_prompts_steps": []},
+    ]
+    return [
+        {"sap_prompts": schedule, "seed": seed, "height": FLUX_SIZE, "width": FLUX_SIZE,
+         "num_inference_steps": FLUX_STEPS, "guidance_scale": 3.5}
+        for schedule, seed in zip(schedules, [0, 1, 2, 3])
+    ]
+
+
+def test_flux_pool():
+    """Тест 1: Пул с маленькой FLUX моделью - изображение на задачу в исходном порядке"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 1: ПУЛ С МАЛЕНЬКОЙ FLUX МОДЕЛЬЮ")
+    print("=" * 70)
+
+    try:
+        import numpy as np
+        import diffusers  # noqa: F401
+        from combined_flux_sap import load_pool_pipeline, pool_batch_key, run_pool_batch
+    except ImportError as e:
+        print(f"⚠️  Пропущен: {e}")
+        return True
+
+    tasks = flux_pool_tasks()
+    pool = WorkerPool(partial(load_pool_pipeline, model_repo=TINY_FLUX_REPO), run_pool_batch,
+                      devices=["cpu"] * NUM_WORKERS, max_batch_size=MAX_BATCH_SIZE, batch_key=pool_batch_key)
+    with pool:
+        outputs = list(pool.map(tasks))
+
+    if [task["seed"] for task, _ in outputs] != [task["seed"] for task in tasks]:
+        print("❌ Нарушен порядок задач")
+        return False
+    if any(image is None for _, image in outputs):
+        print("❌ Не для всех задач получено изображение")
+        return False
+    print(f"✅ {len(outputs)} изображений, по одному на задачу")
+
+    # Эталон - каждая задача отдельно в основном процессе: изображение пула
+    # должно быть ближе всего к эталону своей задачи
+    pipeline = load_pool_pipeline("cpu", model_repo=TINY_FLUX_REPO)
+    references = [np.asarray(run_pool_batch(pipeline, [task], "cpu")[0], dtype=np.float32) for task in tasks]
+    for i, (_, image) in enumerate(outputs):
+        pixels = np.asarray(image, dtype=np.float32)
+        distances = [float(np.abs(pixels - reference).mean()) for reference in references]
+        if distances.index(min(distances)) != i:
+            print(f"❌ Изображение {i} не соответствует своей задаче: {distances}")
+            return False
+    print("✅ Изображения соответствуют расписаниям и seeds своих задач")
+    return True
+
+
+def test_crash_requeue():
+    """Тест 2: Повтор задач упавшего воркера"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 2: ПОВТОР ЗАДАЧ УПАВШЕГО ВОРКЕРА")
+    print("=" * 70)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tasks = make_tasks(12, crash_marker=os.path.join(tmp, "crashed"))
+        with make_pool() as pool:
+            outputs = list(pool.map(tasks))
+            crashed = os.path.exists(os.path.join(tmp, "crashed"))
+
+    if not crashed:
+        print("❌ Воркер не упал, тест ничего не проверил")
+        return False
+    values = [task["value"] for task, _ in outputs]
+    if values != list(range(len(tasks))):
+        print(f"❌ Нарушен порядок задач: {values}")
+        return False
+    missing = [task["value"] for task, result in outputs if result is None]
+    if missing:
+        print(f"❌ Задачи упавшего воркера не выполнены: {missing}")
+        return False
+    print(f"✅ Все {len(outputs)} задач выполнены после падения воркера, порядок сохранен")
+    return True
+
+
+def test_requeue_skips_completed():
+    """Тест 3: Задачи с полученным результатом не повторяются"""
+    print("\n" + "=" * 70)
+    print("ТЕСТ 3: ПОВТОР ТОЛЬКО НЕЗАВЕРШЕННЫХ ЗАДАЧ")
+    print("=" * 70)
+
+    pool = make_pool()
+    # Воркер 0 отправил результат задачи 1 и упал до сообщения "finished"
+    pool._tasks = {2: {"value": 2, "key": 0}}
+    pool._in_flight = {0: [1, 2]}
+    pool._completed = {1}
+    pool._requeue(0)
+
+    requeued = []
+    try:
+        while True:
+            requeued.append(pool.task_queue.get(timeout=1.0)[0])
+    except queue.Empty:
+        pass
+    if requeued != [2]:
+        print(f"❌ Повторены задачи {requeued}, ожидалась только 2")
+        return False
+    print("✅ Повторена только незавершенная задача")
+    return True
+
+
+def main():
+    """Главная функция тестирования"""
+    tests = [
+        ("Пул с FLUX", test_flux_pool),
+        ("Падение воркера", test_crash_requeue),
+        ("Повтор незавершенных", test_requeue_skips_completed),
+    ]
+
+    results = []
+    for test_name, test_func in tests:
+        try:
+            results.append((test_name, test_func()))
+        except Exception as e:
+            print(f"\n❌ Исключение в тесте '{test_name}': {e}")
+            import traceback
+            traceback.print_exc()
+            results.append((test_name, False))
+
+    print("\n" + "=" * 70)
+    print("ФИНАЛЬНЫЙ ОТЧЕТ")
+    print("=" * 70)
+    for test_name, result in results:
+        status = "✅ PASS" if result else "❌ FAIL"
+        print(f"{status:<10} - {test_name}")
+
+    passed = sum(1 for _, result in results if result)
+    print("-" * 70)
+    print(f"Результат: {passed}/{len(results)} тестов пройдено")
+    return 0 if passed == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
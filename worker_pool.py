@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Multi-device worker pool
+Пул процессов: по реплике модели на каждое устройство (GPU или NUMA узел
+для CPU), общая очередь задач, батчи внутри воркера и выдача результатов
+в исходном порядке
+"""
+
+import os
+import glob
+import queue
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from collections import deque
+from typing import Any, Callable, Dict, Hashable, Iterable, Iterator, List, Optional, Tuple
+
+# (устройство) -> пайплайн; (пайплайн, задачи, устройство) -> результаты
+LoadPipelineFn = Callable[[str], Any]
+RunBatchFn = Callable[[Any, List[Dict], str], List[Any]]
+
+
+def _parse_cpulist(cpulist: str) -> List[int]:
+    """'0-3,8-11' -> [0, 1, 2, 3, 8, 9, 10, 11]"""
+    cpus = []
+    for part in cpulist.strip().split(","):
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def numa_cpu_sets(num_workers: Optional[int] = None) -> List[List[int]]:
+    """
+    Наборы CPU для воркеров: по одному на NUMA узел.
+
+    Если количество воркеров задано и не совпадает с количеством узлов,
+    доступные CPU делятся поровну.
+    """
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    cpu_sets = []
+    for node in sorted(glob.glob("/sys/devices/system/node/node[0-9]*")):
+        try:
+            with open(os.path.join(node, "cpulist"), "r") as f:
+                cpus = [cpu for cpu in _parse_cpulist(f.read()) if cpu in available]
+        except OSError:
+            continue
+        if cpus:
+            cpu_sets.append(cpus)
+    if not cpu_sets:
+        cpu_sets = [available]
+
+    if num_workers is not None and num_workers != len(cpu_sets):
+        # Делим все доступные CPU на num_workers непрерывных частей
+        cpus = [cpu for cpu_set in cpu_sets for cpu in cpu_set]
+        num_workers = max(1, num_workers)
+        if num_workers > len(cpus):
+            # Воркеров больше, чем CPU: по одному CPU на воркер по кругу
+            return [[cpus[i % len(cpus)]] for i in range(num_workers)]
+        chunk = len(cpus) // num_workers
+        cpu_sets = [cpus[i * chunk:(i + 1) * chunk if i < num_workers - 1 else len(cpus)] for i in range(num_workers)]
+    return cpu_sets
+
+
+def default_devices(cpu_workers: Optional[int] = None) -> List[str]:
+    """Все доступные GPU, иначе по CPU воркеру на NUMA узел"""
+    if cpu_workers is None:
+        try:
+            import torch
+            if torch.cuda.is_available():
+                return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+        except ImportError:
+            pass
+    return ["cpu"] * len(numa_cpu_sets(cpu_workers))
+
+
+def _worker_main(worker_id: int, device: str, cpus: Optional[List[int]], load_pipeline: LoadPipelineFn,
+                 run_batch: RunBatchFn, batch_key: Optional[Callable[[Dict], Hashable]], max_batch_size: int,
+                 task_queue, result_conn):
+    """
+    Цикл воркера: загрузка реплики и обработка задач батчами.
+
+    Сообщения уходят в собственный канал воркера синхронно: если процесс
+    упадет посреди батча, основной процесс уже знает, какие задачи он взял.
+    """
+    if cpus:
+        os.environ["OMP_NUM_THREADS"] = str(len(cpus))
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpus)
+    try:
+        pipeline = load_pipeline(device)
+        if cpus:
+            try:
+                import torch
+                torch.set_num_threads(len(cpus))
+            except ImportError:
+                pass
+    except Exception as e:
+        result_conn.send(("failed", worker_id, repr(e)))
+        return
+    result_conn.send(("ready", worker_id, device))
+
+    pending = deque()
+    stopping = False
+    while True:
+        taken = []
+        if not pending:
+            if stopping:
+                break
+            item = task_queue.get()
+            if item is None:
+                break
+            taken.append(item)
+
+        # Добираем задачи из общей очереди без ожидания, не больше батча
+        while not stopping and len(pending) + len(taken) < max_batch_size:
+            try:
+                item = task_queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                stopping = True
+                break
+            taken.append(item)
+        if taken:
+            # Взятые задачи (в том числе отложенные до следующего батча)
+            result_conn.send(("taken", worker_id, [task_id for task_id, _ in taken]))
+            pending.extend(taken)
+
+        # Батч - задачи, совместимые с первой (одинаковый batch_key)
+        key = batch_key(pending[0][1]) if batch_key else None
+        batch = [item for item in pending if not batch_key or batch_key(item[1]) == key][:max_batch_size]
+        for item in batch:
+            pending.remove(item)
+
+        task_ids = [task_id for task_id, _ in batch]
+        try:
+            outputs = run_batch(pipeline, [task for _, task in batch], device)
+            for task_id, output in zip(task_ids, outputs):
+                result_conn.send(("result", task_id, output))
+        except Exception as e:
+            for task_id in task_ids:
+                result_conn.send(("error", task_id, repr(e)))
+        result_conn.send(("finished", worker_id, task_ids))
+
+
+class WorkerPool:
+    """
+    Пул процессов с репликой пайплайна на каждом устройстве.
+
+    load_pipeline и run_batch должны быть функциями уровня модуля: процессы
+    запускаются через spawn (CUDA не работает после fork).
+    """
+
+    def __init__(
+        self,
+        load_pipeline: LoadPipelineFn,
+        run_batch: RunBatchFn,
+        devices: Optional[List[str]] = None,
+        max_batch_size: int = 4,
+        batch_key: Optional[Callable[[Dict], Hashable]] = None,
+        cpu_workers: Optional[int] = None,
+        start_method: str = "spawn"
+    ):
+        """
+        Args:
+            load_pipeline: создает реплику пайплайна на устройстве
+            run_batch: обрабатывает батч задач, возвращает результат на каждую задачу
+            devices: устройства воркеров (по умолчанию default_devices)
+            max_batch_size: максимум задач в одном батче воркера
+            batch_key: задачи с одинаковым ключом можно объединять в батч
+            cpu_workers: количество CPU воркеров (по умолчанию - по NUMA узлам)
+            start_method: способ запуска процессов multiprocessing
+        """
+        self.devices = devices or default_devices(cpu_workers)
+        num_cpu = sum(1 for device in self.devices if device == "cpu")
+        cpu_sets = iter(numa_cpu_sets(num_cpu)) if num_cpu else iter(())
+        self.cpu_sets = [next(cpu_sets, None) if device == "cpu" else None for device in self.devices]
+
+        self.load_pipeline = load_pipeline
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.batch_key = batch_key
+        self.ctx = mp.get_context(start_method)
+        self.task_queue = self.ctx.Queue()
+        self.connections: List[Any] = []
+        self.processes: List[Any] = []
+        self._messages = deque()
+        self.ready: List[int] = []
+        self._next_id = 0
+        self._tasks: Dict[int, Dict] = {}
+        self._in_flight: Dict[int, List[int]] = {}
+        self._retried = set()
+        self._completed = set()
+        self._lost = set()
+        self._dead = set()
+
+    def start(self) -> "WorkerPool":
+        """Запускает воркеры и ждет загрузки реплик"""
+        for worker_id, (device, cpus) in enumerate(zip(self.devices, self.cpu_sets)):
+            recv_conn, send_conn = self.ctx.Pipe(duplex=False)
+            process = self.ctx.Process(
+                target=_worker_main,
+                args=(worker_id, device, cpus, self.load_pipeline, self.run_batch, self.batch_key,
+                      self.max_batch_size, self.task_queue, send_conn),
+                daemon=True
+            )
+            process.start()
+            send_conn.close()
+            self.connections.append(recv_conn)
+            self.processes.append(process)
+
+        failed = set()
+        while len(self.ready) + len(failed) < len(self.processes):
+            kind, worker_id, payload = self._get_message()
+            if kind == "ready":
+                self.ready.append(worker_id)
+                cpus = self.cpu_sets[worker_id]
+                print(f"🧵 Воркер {worker_id} готов: {payload}" + (f" (CPU: {len(cpus)})" if cpus else ""))
+            elif kind == "failed" and worker_id not in failed:
+                failed.add(worker_id)
+                print(f"❌ Воркер {worker_id} не загрузил модель: {payload}")
+        if not self.ready:
+            self.close()
+            raise RuntimeError("Ни один воркер не смог загрузить модель")
+        return self
+
+    def _drain(self, worker_id: int):
+        """Забирает все сообщения из канала воркера"""
+        connection = self.connections[worker_id]
+        try:
+            while connection.poll():
+                self._messages.append(connection.recv())
+        except (EOFError, OSError):
+            pass
+
+    def _get_message(self) -> Tuple[str, int, Any]:
+        """Следующее сообщение воркеров; обнаруживает упавшие процессы"""
+        while not self._messages:
+            alive = [worker_id for worker_id in range(len(self.processes)) if worker_id not in self._dead]
+            if not alive:
+                raise RuntimeError("Все воркеры завершились")
+            wait([self.connections[i] for i in alive] + [self.processes[i].sentinel for i in alive], timeout=1.0)
+            for worker_id in alive:
+                self._drain(worker_id)
+                process = self.processes[worker_id]
+                if process.exitcode is None:
+                    continue
+                # Процесс завершился: сообщения из канала уже прочитаны
+                self._dead.add(worker_id)
+                if worker_id in self.ready:
+                    self.ready.remove(worker_id)
+                    print(f"❌ Воркер {worker_id} завершился с кодом {process.exitcode}")
+                    # Повтор задач - после уже прочитанных сообщений воркера ("taken" и др.)
+                    self._messages.append(("died", worker_id, process.exitcode))
+                elif not any(m[0] in ("ready", "failed") and m[1] == worker_id for m in self._messages):
+                    self._messages.append(("failed", worker_id, f"код завершения {process.exitcode}"))
+        return self._messages.popleft()
+
+    def _requeue(self, worker_id: int):
+        """Возвращает в очередь задачи упавшего воркера; повторно упавшие считаются ошибкой"""
+        for task_id in self._in_flight.pop(worker_id, []):
+            if task_id in self._completed:
+                # Результат уже получен (воркер упал между "result" и "finished")
+                continue
+            if task_id in self._retried:
+                self._lost.add(task_id)
+            else:
+                self._retried.add(task_id)
+                self.task_queue.put((task_id, self._tasks[task_id]))
+
+    def map(self, tasks: Iterable[Dict]) -> Iterator[Tuple[Dict, Any]]:
+        """
+        Обрабатывает задачи и отдает (задача, результат) в исходном порядке.
+
+        Для задач, завершившихся ошибкой, результат - None.
+        """
+        if not self.processes:
+            self.start()
+        task_ids = []
+        for task in tasks:
+            task_id = self._next_id
+            self._next_id += 1
+            self._tasks[task_id] = task
+            task_ids.append(task_id)
+            self.task_queue.put((task_id, task))
+
+        results: Dict[int, Any] = {}
+        next_index = 0
+        while next_index < len(task_ids):
+            task_id = task_ids[next_index]
+            if task_id in results:
+                yield self._tasks.pop(task_id), results.pop(task_id)
+                next_index += 1
+                continue
+
+            kind, ref, payload = self._get_message()
+            if kind == "taken":
+                self._in_flight.setdefault(ref, []).extend(payload)
+            elif kind == "finished":
+                self._in_flight[ref] = [t for t in self._in_flight.get(ref, []) if t not in payload]
+            elif kind == "died":
+                self._requeue(ref)
+            elif kind in ("result", "error") and ref not in self._completed:
+                self._completed.add(ref)
+                if kind == "error":
+                    print(f"❌ Ошибка задачи {ref}: {payload}")
+                results[ref] = payload if kind == "result" else None
+            for lost in list(self._lost):
+                self._lost.discard(lost)
+                print(f"❌ Задача {lost} потеряна вместе с воркером")
+                results[lost] = None
+            if not self.ready:
+                raise RuntimeError("Не осталось работающих воркеров")
+
+    def close(self):
+        """Останавливает воркеры"""
+        for process in self.processes:
+            if process.is_alive():
+                self.task_queue.put(None)
+        for process in self.processes:
+            process.join(timeout=30)
+            if process.is_alive():
+                process.terminate()
+        for connection in self.connections:
+            connection.close()
+        self.processes = []
+        self.connections = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
+
+
+def add_worker_pool_arguments(parser):
+    """Добавляет в argparse параметры пула воркеров"""
+    group = parser.add_argument_group("Пул воркеров")
+    group.add_argument(
+        '--devices',
+        nargs='+',
+        type=str,
+        default=None,
+        help='Устройства воркеров, например cuda:0 cuda:1 (по реплике модели на устройство)'
+    )
+    group.add_argument(
+        '--cpu-workers',
+        type=int,
+        default=None,
+        help='Количество CPU воркеров (по умолчанию - по одному на NUMA узел)'
+    )
+    group.add_argument(
+        '--pool-batch-size',
+        type=int,
+        default=4,
+        help='Максимум сэмплов в одном батче воркера'
+    )
+    return parser
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Zephyr batching benchmark
+Сравнение последовательной декомпозиции (по одному промту на generate) и
+батчевой (несколько промтов на generate, размер батча по свободной памяти):
+промтов в секунду, ускорение и доля успешно распарсенных ответов
+
+    python zephyr_batch_benchmark.py --num-prompts 32 --batch-sizes 1 auto 8
+"""
+
+import json
+import time
+import argparse
+from typing import Dict, List, Optional
+
+import torch
+
+from combined_flux_sap import read_prompts_from_file
+from llm_interface.llm_SAP import LLM_SAP_batch_Zephyr
+from llm_interface.model_registry import get_registry
+
+
+def run_mode(pipe, prompts: List[str], batch_size: Optional[int]) -> Dict:
+    """Декомпозиция всех промтов с заданным размером батча"""
+    sync = torch.cuda.synchronize if torch.cuda.is_available() else (lambda: None)
+    sync()
+    start = time.perf_counter()
+    results = LLM_SAP_batch_Zephyr(prompts, pipe, batch_size=batch_size)
+    sync()
+    elapsed = time.perf_counter() - start
+    parsed = sum(1 for r in results if r.get("source") != "fallback")
+    return {
+        "batch_size": "auto" if batch_size is None else batch_size,
+        "seconds": round(elapsed, 2),
+        "prompts_per_s": round(len(prompts) / elapsed, 3),
+        "parsed": parsed,
+        "parse_rate": round(parsed / len(prompts), 3)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Пропускная способность Zephyr: последовательно vs батчами")
+    parser.add_argument('--prompts-file', type=str, default='prompts.txt', help='Файл с промтами')
+    parser.add_argument('--num-prompts', type=int, default=16, help='Сколько промтов взять из файла')
+    parser.add_argument('--batch-sizes', nargs='+', default=['1', 'auto'],
+                        help='Размеры батча для сравнения (1 - последовательный цикл, auto - по памяти)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed сэмплирования')
+    parser.add_argument('--output', type=str, default=None, help='JSON файл для отчета')
+    args = parser.parse_args()
+
+    prompts = read_prompts_from_file(args.prompts_file)[:args.num_prompts]
+    pipe = get_registry().get("Zephyr")
+    # Прогрев: загрузка весов и KV кэш шаблона не входят в замер
+    LLM_SAP_batch_Zephyr(prompts[:1], pipe, batch_size=1)
+
+    report = []
+    for value in args.batch_sizes:
+        torch.manual_seed(args.seed)
+        report.append(run_mode(pipe, prompts, None if value == 'auto' else int(value)))
+
+    baseline = report[0]["prompts_per_s"]
+    print(f"\n📊 Декомпозиция {len(prompts)} промтов Zephyr")
+    print(f"  {'Батч':<8}{'секунд':>10}{'промтов/с':>12}{'ускорение':>12}{'распарсено':>12}")
+    for r in report:
+        r["speedup"] = round(r["prompts_per_s"] / baseline, 2)
+        print(f"  {str(r['batch_size']):<8}{r['seconds']:>10}{r['prompts_per_s']:>12}{r['speedup']:>12}"
+              f"{r['parsed']:>8}/{len(prompts)}")
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"num_prompts": len(prompts), "modes": report}, f, ensure_ascii=False, indent=2)
+        print(f"📁 Отчет: {args.output}")
+
+
+if __name__ == "__main__":
+    main()